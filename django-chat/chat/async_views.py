@@ -0,0 +1,78 @@
+"""
+Async-native variants of the chat REST endpoints (ASYNC_VIEWS=True).
+
+Under ASGI every sync view goes through Django's thread-sensitive
+sync_to_async hop, i.e. one shared thread: a request waiting on pymongo
+holds up every other sync view in the worker. These views stay on the
+event loop instead:
+
+- The view body is the same function as the DRF view (views.shared_handlers),
+  run on the bounded Mongo executor via run_mongo, so as many requests
+  wait on Mongo at once as MONGO_EXECUTOR_WORKERS allows.
+- channel-layer sends are collected while it runs (views.notify) and then
+  awaited here directly, instead of one async_to_sync per send.
+- Exceptions go through DRF's EXCEPTION_HANDLER, as in APIView: Http404,
+  PermissionDenied and APIExceptions get the same response as the sync
+  views, anything else propagates to Django's 500 handling.
+
+pymongo 4.6 has no asyncio client, so run_mongo is the async Mongo access
+here as it is for ChatConsumer.
+"""
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from channels.layers import get_channel_layer
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+from . import presence
+from .mongo_client import run_mongo
+from .views import shared_handlers
+
+
+def to_django_response(response):
+    """ An unrendered DRF Response as a plain JsonResponse, with the same JSON encoding and headers """
+    if response.data is None:
+        django_response = HttpResponse(status=response.status_code)
+    else:
+        django_response = JsonResponse(response.data, status=response.status_code, encoder=JSONEncoder, safe=False)
+    for header, value in response.headers.items():
+        if header.lower() != 'content-type':
+            django_response[header] = value
+    return django_response
+
+
+def async_view(name, methods):
+    handler = shared_handlers[name]
+
+    @csrf_exempt
+    async def view(request, **kwargs):
+        if request.method not in methods:
+            return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+        api_request = Request(request, parsers=[JSONParser(), FormParser(), MultiPartParser()])
+        api_request.outbox = []
+        try:
+            response = await run_mongo(handler, api_request, **kwargs)
+        except Exception as exc:
+            context = {"view": None, "args": (), "kwargs": kwargs, "request": api_request}
+            response = api_settings.EXCEPTION_HANDLER(exc, context)
+            if response is None:
+                raise
+            return to_django_response(response)
+
+        layer = get_channel_layer()
+        for user_id, event in api_request.outbox:
+            await presence.send_to_user(layer, user_id, event)
+        return to_django_response(response)
+
+    view.__name__ = name
+    return view
+
+
+get_recent_chats = async_view('get_recent_chats', ['GET'])
+search_users = async_view('search_users', ['GET'])
+toggle_chat = async_view('toggle_chat', ['POST'])
+get_chat_history = async_view('get_chat_history', ['GET'])
+get_total_unread = async_view('get_total_unread', ['GET'])
+delete_conversation = async_view('delete_conversation', ['DELETE'])
+manage_message = async_view('manage_message', ['PUT', 'DELETE'])
@@ -0,0 +1,48 @@
+"""
+One place to turn a JWT from the Node backend into a user id.
+
+Verified tokens are remembered until their `exp` (or AUTH_TOKEN_CACHE_TTL
+seconds for tokens without one), so a reconnect storm or a dashboard
+polling every few seconds costs a dict lookup instead of an HMAC check
+and a JSON decode. Failed verifications are never cached.
+"""
+import time
+import jwt
+from django.conf import settings
+from .directory import TTLCache
+
+token_cache = TTLCache(settings.AUTH_TOKEN_CACHE_SIZE, settings.AUTH_TOKEN_CACHE_TTL)
+
+
+def clean_token(token):
+    # Some clients send the token JSON-quoted
+    return token.strip().strip('"').strip("'")
+
+
+def verify_token(token):
+    """
+    User id (str) carried by `token`, or None when the payload has no id.
+    Raises jwt.ExpiredSignatureError / jwt.InvalidTokenError like jwt.decode.
+    """
+    token = clean_token(token)
+    cached = token_cache.get(token)
+    if cached is not None:
+        user_id, expires_at = cached
+        if expires_at is None or expires_at > time.time():
+            return user_id
+        token_cache.invalidate(token)
+
+    payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+    # 'userId' first: that is what the Node.js authController signs
+    user_id = payload.get('userId', payload.get('id', payload.get('_id')))
+    if user_id is None:
+        return None
+    user_id = str(user_id)
+
+    expires_at = payload.get('exp')
+    ttl = settings.AUTH_TOKEN_CACHE_TTL
+    if expires_at is not None:
+        ttl = min(ttl, expires_at - time.time())
+    if ttl > 0:
+        token_cache.set(token, (user_id, expires_at), ttl=ttl)
+    return user_id
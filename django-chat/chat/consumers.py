@@ -1,40 +1,86 @@
+import asyncio
 import json
-import jwt
-import os
 import datetime
+import time
+from collections import deque
 from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from .mongo_client import messages_collection, conversations_collection
-from .permissions import check_chat_permission
+from .mongo_client import messages_collection, conversations_collection, run_mongo, pair_key
+from .permissions import check_chat_permission, PermissionCache
+from .receipts import mark_read
+from .writebehind import get_message_writer
+from . import frames, metrics, presence, ratelimit, sync
 from django.conf import settings
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        query_string = self.scope['query_string'].decode()
-        parsed_qs = parse_qs(query_string)
-        token = parsed_qs.get('token', [None])[0]
+def save_message(sender_id, receiver_id, message_text, now_aware):
+    """ Persist a message and bump its conversation. Blocking - run via run_mongo """
+    msg_doc = {
+        "sender_id": sender_id,
+        "receiver_id": receiver_id,
+        "message": message_text,
+        "timestamp": now_aware,
+        "is_read": False
+    }
+    
+    result = messages_collection.insert_one(msg_doc)
 
-        if not token:
-            print("WebSocket Rejected: No Token")
-            await self.close(code=4001)
-            return
+    # Single upsert on the unique pair_key: no find-then-insert race, no duplicates
+    conversations_collection.update_one(
+        { "pair_key": pair_key(sender_id, receiver_id) },
+        {
+            "$set": { "last_message": message_text, "updated_at": now_aware, "changed_at": now_aware },
+            "$inc": { f"unread_counts.{receiver_id}": 1 },
+            "$setOnInsert": { "participants": [sender_id, receiver_id], "is_disabled": False }
+        },
+        upsert=True
+    )
+    sync.bump(sender_id, receiver_id)
 
-        token = token.strip('"').strip("'")
-        secret = settings.SECRET_KEY
+    return str(result.inserted_id)
 
-        try:
-            payload = jwt.decode(token, secret, algorithms=["HS256"])
-            
-            # FIX: Look for 'userId' first
-            self.user_id = str(payload.get('userId', payload.get('id', payload.get('_id'))))
-            
-            if self.user_id == 'None':
-                raise ValueError("Payload missing user ID")
-                
-        except Exception as e:
-            print(f"WebSocket Rejected: Invalid Token. Error: {str(e)}")
-            await self.close(code=4003)
+
+def rejected(data):
+    """ Error frame fields that hand an unsent chat message back to the client for a resend """
+    if 'message' not in data:
+        return {}
+    return {"rejected": {"message": data.get('message'), "receiverId": data.get('receiverId')}}
+
+
+def iso(ts):
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=datetime.timezone.utc)
+    return ts.isoformat()
+
+
+def message_payload(doc):
+    """ A stored message in the same shape as the live chat_message frame """
+    payload = {
+        "id": str(doc['_id']),
+        "sender_id": doc['sender_id'],
+        "receiver_id": doc['receiver_id'],
+        "message": doc['message'],
+        "timestamp": iso(doc['timestamp'])
+    }
+    if doc.get('edited_at'):
+        payload["edited_at"] = iso(doc['edited_at'])
+    return payload
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    @metrics.timed
+    async def connect(self):
+        metrics.instrument_channel_layer(self.channel_layer)
+        # JWTAuthMiddleware already verified the token
+        self.user_id = self.scope.get('user_id')
+
+        if not self.user_id:
+            if 'auth_error' in self.scope:
+                print(f"WebSocket Rejected: Invalid Token. Error: {self.scope['auth_error']}")
+                await self.close(code=4003)
+            else:
+                print("WebSocket Rejected: No Token")
+                await self.close(code=4001)
             return
 
         self.room_group_name = f"user_{self.user_id}"
@@ -43,20 +89,284 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        # check_chat_permission decisions for this socket, by receiver
+        self.permissions = PermissionCache()
+        # Pending mark_read frames per conversation, flushed after READ_RECEIPT_DEBOUNCE
+        self.pending_reads = {}
+        self.read_flush_tasks = {}
+
+        # presence_<id> groups this socket follows (presence_subscribe)
+        self.presence_groups = set()
+        # Sec-WebSocket-Protocol: chat.msgpack -> binary MessagePack frames (chat/frames.py)
+        self.subprotocol = frames.negotiate(self.scope.get("subprotocols"))
+        self.binary = self.subprotocol is not None
+        # ?batch=1: frames are coalesced into arrays (see send_frame)
+        query = parse_qs(self.scope["query_string"].decode("utf8"))
+        self.batching = query.get("batch", ["0"])[0] in ("1", "true")
+        self.outbox = deque()
+        self.outbox_ready = asyncio.Event()
+        self.outbox_bytes = 0
+        self.dropped_frames = 0
+        self.closing = False
+        if self.batching:
+            self.outbox_task = asyncio.create_task(self.drain_outbox())
+        # receive only checks the limits (chat/ratelimit.py); frames wait here for handle_frame
+        self.socket_bucket = ratelimit.socket_bucket()
+        self.muted_until = 0
+        self.inbox = deque()
+        self.inbox_ready = asyncio.Event()
+        self.inbox_task = asyncio.create_task(self.process_inbox())
+
+        # Register before accept(): once the client sees the handshake complete, senders must
+        # already see it online, or their fan-out skips it (presence.send_to_user)
+        try:
+            if await run_mongo(presence.connected, self.user_id, self.channel_name):
+                await presence.announce(self.channel_layer, self.user_id, True)
+        except Exception as e:
+            print(f"Presence update failed for {self.user_id}: {e}")
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
+
         print(f"WebSocket Connected: User {self.user_id}")
-        await self.accept()
+        await self.accept(subprotocol=self.subprotocol)
+        metrics.socket_opened()
+        # Already in the group, so nothing sent from here on is lost; overlaps are deduped by id
+        await self.replay_missed()
 
+    # --- RECONNECT REPLAY: ws/chat/?token=...&since=<sync> or &last_id=<message id> ---
+    async def replay_missed(self):
+        """ Frames: {"type": "replay", "messages": [...], "done": false} per REPLAY_BATCH_SIZE, then one
+        with "done": true, "deleted", "cleared", "truncated" and the next "sync" value """
+        query = parse_qs(self.scope["query_string"].decode("utf8"))
+        try:
+            if query.get("since"):
+                since = sync.parse_since(query["since"][0])
+            elif query.get("last_id"):
+                since = sync.since_last_id(query["last_id"][0])
+            else:
+                return
+        except ValueError as e:
+            await self.send_frame({"type": "error", "error": str(e)})
+            return
+
+        started_at = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            messages, deleted, cleared, truncated = await run_mongo(
+                sync.missed_since, self.user_id, since, settings.REPLAY_MAX_MESSAGES)
+        except Exception as e:
+            print(f"Replay failed for {self.user_id}: {e}")
+            await self.send_frame({"type": "replay", "messages": [], "done": True, "truncated": True})
+            return
+
+        batch = settings.REPLAY_BATCH_SIZE
+        chunks = [messages[i:i + batch] for i in range(0, len(messages), batch)] or [[]]
+        for chunk in chunks[:-1]:
+            await self.send_frame({
+                "type": "replay", "messages": [message_payload(m) for m in chunk], "done": False
+            })
+        await self.send_frame({
+            "type": "replay",
+            "messages": [message_payload(m) for m in chunks[-1]],
+            "deleted": [{"id": str(t['_id']), "sender_id": t['sender_id'], "receiver_id": t['receiver_id']} for t in deleted],
+            "cleared": [{"other_user": other_id, "cleared_at": iso(ts)} for other_id, ts in cleared.items()],
+            "truncated": truncated,
+            "sync": sync.sync_cursor(started_at),
+            "done": True
+        })
+
+    @metrics.timed
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if hasattr(self, 'pending_reads'):
+            metrics.socket_closed()
+        if hasattr(self, 'inbox_task'):
+            self.closing = True
+            # Queued read receipts still count; every other queued frame goes with the socket
+            for data in self.inbox:
+                if data.get('type') == 'mark_read':
+                    self.queue_read(data)
+            self.inbox.clear()
+            self.inbox.append(None)
+            self.inbox_ready.set()
+            # The frame in hand may already be saved: let it reach the receiver
+            await self.inbox_task
+        for task in getattr(self, 'read_flush_tasks', {}).values():
+            task.cancel()
+        for other_id in list(getattr(self, 'pending_reads', {})):
+            await self.flush_read(other_id)
+        for group in getattr(self, 'presence_groups', ()):
+            await self.channel_layer.group_discard(group, self.channel_name)
+        if getattr(self, 'batching', False):
+            self.outbox_task.cancel()
+        if hasattr(self, 'heartbeat_task'):
+            self.heartbeat_task.cancel()
+            try:
+                if await run_mongo(presence.disconnected, self.user_id, self.channel_name):
+                    await presence.announce(self.channel_layer, self.user_id, False)
+            except Exception as e:
+                print(f"Presence update failed for {self.user_id}: {e}")
+        if hasattr(self, 'room_group_name'):
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+
+    # --- OUTBOUND: every frame goes through send_frame ---
+    async def send_frame(self, frame, text=None):
+        """ Send one frame now, or (batching) queue it for the next array frame.
+        `text` is the frame already encoded as JSON; `frame` may then be None. """
+        if self.closing:
+            return
+        if self.binary:
+            item = frame if frame is not None else json.loads(text)
+        else:
+            item = text if text is not None else frames.dumps(frame)
+        if not self.batching:
+            if self.binary:
+                await self.send(bytes_data=frames.pack(item))
+            else:
+                await self.send(text_data=item)
+            return
+        if self.binary:
+            item = frames.pack(item)
+        # Counted from here until send() returns for the batch holding it
+        if (len(self.outbox) >= settings.OUTBOUND_MAX_QUEUE
+                or self.outbox_bytes + len(item) > settings.OUTBOUND_MAX_BYTES):
+            await self.slow_consumer()
+            return
+        self.outbox.append(item)
+        self.outbox_bytes += len(item)
+        self.outbox_ready.set()
+
+    async def drain_outbox(self):
+        """ Wait OUTBOUND_BATCH_WINDOW_MS for more frames (unless a batch is already full),
+        then send them as arrays of up to OUTBOUND_BATCH_MAX """
+        while True:
+            await self.outbox_ready.wait()
+            if len(self.outbox) < settings.OUTBOUND_BATCH_MAX:
+                await asyncio.sleep(settings.OUTBOUND_BATCH_WINDOW_MS / 1000)
+            self.outbox_ready.clear()
+            while self.outbox:
+                count = min(len(self.outbox), settings.OUTBOUND_BATCH_MAX)
+                batch = [self.outbox[i] for i in range(count)]
+                if self.dropped_frames:
+                    # Tell the client it missed frames; it can reconnect with ?since= to catch up
+                    overflow = {"type": "overflow", "dropped": self.dropped_frames}
+                    batch.append(frames.pack(overflow) if self.binary else frames.dumps(overflow))
+                    self.dropped_frames = 0
+                # Blocks while the server applies backpressure; send_frame keeps queueing meanwhile
+                # and the batch still counts against the outbox limits until it returns
+                if self.binary:
+                    await self.send(bytes_data=frames.join_packed(batch))
+                else:
+                    await self.send(text_data=frames.join(batch))
+                if self.closing:
+                    return
+                for _ in range(count):
+                    self.outbox_bytes -= len(self.outbox.popleft())
+
+    async def slow_consumer(self):
+        """ Outbox full: the client isn't reading. OUTBOUND_SLOW_POLICY drops or disconnects. """
+        if settings.OUTBOUND_SLOW_POLICY == 'disconnect':
+            print(f"WebSocket Closed: User {self.user_id} is not reading ({len(self.outbox)} frames queued)")
+            metrics.slow_consumers.inc('disconnect')
+            self.closing = True
+            self.outbox.clear()
+            self.outbox_bytes = 0
+            await self.close(code=4008)
+        else:
+            metrics.slow_consumers.inc('drop')
+            self.dropped_frames += 1
+
+    # --- PRESENCE: heartbeat, {"type": "presence_subscribe", "user_ids": [...]} ---
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT)
+            try:
+                await run_mongo(presence.heartbeat, self.user_id, self.channel_name)
+            except Exception as e:
+                print(f"Presence heartbeat failed for {self.user_id}: {e}")
+
+    async def subscribe_presence(self, data):
+        """ Follow exactly these users (replaces the previous list); replies with their current state """
+        user_ids = [str(uid) for uid in (data.get('user_ids') or [])][:presence.MAX_USERS]
+        groups = {f"presence_{uid}" for uid in user_ids}
+        for group in self.presence_groups - groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        for group in groups - self.presence_groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.presence_groups = groups
+        states = await run_mongo(presence.lookup, user_ids) if user_ids else {}
+        await self.send_frame({"type": "presence", "users": states})
+
+    @metrics.timed
+    async def chat_presence(self, event):
+        await self.send_frame({"type": "presence", "users": event["users"]})
+
+    # --- INBOUND: receive checks the limits and queues, process_inbox handles frames in order ---
+    @metrics.timed
+    async def receive(self, text_data=None, bytes_data=None):
+        retry_after = self.socket_bucket.take()
+        if retry_after:
+            # A flood: answered at most once per retry_after, and not even parsed
+            metrics.rate_limited.inc('socket')
+            if time.monotonic() >= self.muted_until:
+                self.muted_until = time.monotonic() + retry_after
+                await self.send_frame({"type": "error", "code": "rate_limited", "limit": "socket",
+                                       "error": "Too many frames", "retry_after": round(retry_after, 3)})
+            return
+
+        if bytes_data is not None and self.binary:
+            data = frames.unpack(bytes_data)
+        else:
+            data = json.loads(text_data if text_data is not None else bytes_data)
+
+        if data.get('type') not in ('mark_read', 'presence_subscribe'):
+            retry_after = ratelimit.take_user(self.user_id)
+            if retry_after:
+                await self.reject(data, "user", "rate_limited", "Too many messages", retry_after)
+                return
+        if len(self.inbox) >= settings.INBOUND_MAX_QUEUE:
+            await self.reject(data, "queue", "busy", "Too many frames waiting", ratelimit.BUSY_RETRY_AFTER)
+            return
+        self.inbox.append(data)
+        self.inbox_ready.set()
+
+    async def reject(self, data, limit, code, error, retry_after):
+        """ Error frame for a frame over a limit; carries chat messages back so the client can resend them """
+        metrics.rate_limited.inc(limit)
+        await self.send_frame({"type": "error", "code": code, "limit": limit, "error": error,
+                               "retry_after": round(retry_after, 3), **rejected(data)})
+
+    async def process_inbox(self):
+        while True:
+            await self.inbox_ready.wait()
+            self.inbox_ready.clear()
+            while self.inbox:
+                data = self.inbox.popleft()
+                if data is None:
+                    return
+                try:
+                    await self.handle_frame(data)
+                except Exception as e:
+                    print(f"WebSocket frame from {self.user_id} failed: {e!r}")
+                    await self.send_frame({"type": "error", "code": "failed",
+                                           "error": "Frame could not be handled", **rejected(data)})
+
+    @metrics.timed
+    async def handle_frame(self, data):
+        if data.get('type') == 'mark_read':
+            self.queue_read(data)
+            return
+        if data.get('type') == 'presence_subscribe':
+            await self.subscribe_presence(data)
+            return
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
         message_text = data['message']
         receiver_id = data['receiverId']
 
-        is_allowed, error_msg = check_chat_permission(self.user_id, receiver_id)
+        decision = self.permissions.get(receiver_id)
+        if decision is None:
+            decision = await run_mongo(check_chat_permission, self.user_id, receiver_id)
+            self.permissions.set(receiver_id, decision)
+        is_allowed, error_msg = decision
         if not is_allowed:
-            await self.send(text_data=json.dumps({"error": error_msg, "type": "error"}))
+            await self.send_frame({"error": error_msg, "type": "error"})
             return
 
         now_aware = datetime.datetime.now(datetime.timezone.utc)
@@ -65,32 +375,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # Force it to be the authenticated user's ID
         sender_id = self.user_id 
         
-        msg_doc = {
-            "sender_id": sender_id,
-            "receiver_id": receiver_id,
-            "message": message_text,
-            "timestamp": now_aware,
-            "is_read": False,
-            "deleted_by": [] # --- Initialize Empty Array ---
-        }
-        
-        result = messages_collection.insert_one(msg_doc)
-        msg_id = str(result.inserted_id)
-
-        query = { "participants": { "$all": [self.user_id, receiver_id] } }
-        conversation = conversations_collection.find_one(query)
-        if conversation:
-            conversations_collection.update_one(
-                { "_id": conversation["_id"] },
-                { "$set": { "last_message": message_text, "updated_at": now_aware } }
-            )
+        if settings.MESSAGE_WRITE_BEHIND:
+            save = get_message_writer().submit(sender_id, receiver_id, message_text, now_aware)
         else:
-            conversations_collection.insert_one({
-                "participants": [self.user_id, receiver_id],
-                "last_message": message_text,
-                "updated_at": now_aware,
-                "is_disabled": False
-            })
+            save = run_mongo(save_message, sender_id, receiver_id, message_text, now_aware)
+        try:
+            msg_id = await save
+        except Exception as e:
+            print(f"Message from {sender_id} to {receiver_id} not saved: {e!r}")
+            await self.send_frame({"error": "Message could not be saved", "type": "error", **rejected(data)})
+            return
 
         payload = {
             "id": msg_id, 
@@ -100,28 +394,76 @@ class ChatConsumer(AsyncWebsocketConsumer):
             "timestamp": now_aware.isoformat()
         }
 
-        await self.channel_layer.group_send(
-            f"user_{receiver_id}",
-            {"type": "chat_message", "message": payload}
-        )
-        await self.send(text_data=json.dumps(payload))
+        # Encoded once: the receiver's sockets and this echo all send the same text
+        text = frames.dumps(payload)
+        await presence.send_to_user(self.channel_layer, receiver_id,
+                                    {"type": "chat_message", "sender_id": self.user_id, "text": text})
+        await self.send_frame(payload, text=text)
+
+    # --- READ RECEIPTS: {"type": "mark_read", "otherUserId": ..., "messageId": ...} ---
+    def queue_read(self, data):
+        other_id = data.get('otherUserId')
+        if not other_id:
+            return
+        other_id = str(other_id)
+        # Latest frame wins; one Mongo write per conversation per debounce window
+        self.pending_reads[other_id] = data.get('messageId')
+        if other_id not in self.read_flush_tasks:
+            self.read_flush_tasks[other_id] = asyncio.create_task(self.debounced_read(other_id))
+
+    async def debounced_read(self, other_id):
+        await asyncio.sleep(settings.READ_RECEIPT_DEBOUNCE)
+        self.read_flush_tasks.pop(other_id, None)
+        await self.flush_read(other_id)
+
+    async def flush_read(self, other_id):
+        if other_id not in self.pending_reads:
+            return
+        message_id = self.pending_reads.pop(other_id)
+        receipt = await run_mongo(mark_read, self.user_id, other_id, message_id)
+        if receipt:
+            event = {"type": "chat_read", **receipt}
+            await presence.send_to_user(self.channel_layer, other_id, event)
+            # Other tabs/devices of the reader clear their badges too
+            await self.channel_layer.group_send(self.room_group_name, event)
+
+    @metrics.timed
+    async def chat_read(self, event):
+        await self.send_frame({
+            "type": "read_receipt",
+            "reader_id": event["reader_id"],
+            "last_read_id": event["last_read_id"],
+            "last_read_at": event["last_read_at"],
+            "participants": event["participants"]
+        })
 
+    @metrics.timed
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event['message']))
+        # Events from older workers carry the payload dict instead of its text
+        message = event.get('message')
+        sender_id = event.get('sender_id') or message['sender_id']
+        # An Employee may answer an Admin once the Admin has written first
+        self.permissions.invalidate(sender_id, denied_only=True)
+        await self.send_frame(message, text=event.get('text'))
 
+    @metrics.timed
     async def chat_status_update(self, event):
-        await self.send(text_data=json.dumps({
+        # toggle_chat changed is_disabled for this pair
+        for participant in event["participants"]:
+            self.permissions.invalidate(participant)
+        await self.send_frame({
             "type": "status_update",
             "is_disabled": event["is_disabled"],
             "participants": event["participants"]
-        }))
+        })
 
+    @metrics.timed
     async def chat_activity(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             "type": "activity",
             "action": event["action"],
             "initiator_id": event.get("initiator_id"), # Added for clear_chat logic
             "message_id": event.get("message_id"),
             "new_text": event.get("new_text"),
             "participants": event.get("participants")
-        }))
\ No newline at end of file
+        })
\ No newline at end of file
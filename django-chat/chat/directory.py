@@ -0,0 +1,176 @@
+"""
+In-process cache for user and department documents.
+
+The chat service reads the same few users (sender, receiver, their
+departments) on every message. Entries live for DIRECTORY_CACHE_TTL seconds
+and the least recently used ones are evicted past the configured size.
+Call invalidate_user/invalidate_department (or POST directory/invalidate)
+when the Node backend changes a user's role or department, or set
+DIRECTORY_WATCH_CHANGES to follow a Mongo change stream instead. The cache
+is per process: an invalidation only reaches the worker that handled it,
+while the change stream is followed by every worker.
+"""
+import threading
+import time
+from collections import OrderedDict
+from bson.objectid import ObjectId
+from django.conf import settings
+from .mongo_client import users_collection, departments_collection
+
+USER_PROJECTION = {"password": 0, "AccessKey": 0}
+
+
+class TTLCache:
+    """ Thread-safe LRU cache whose entries expire after `ttl` seconds """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """ Store `value`; `ttl` overrides the cache-wide lifetime for this entry """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+user_cache = TTLCache(settings.DIRECTORY_CACHE_USERS, settings.DIRECTORY_CACHE_TTL)
+department_cache = TTLCache(settings.DIRECTORY_CACHE_DEPARTMENTS, settings.DIRECTORY_CACHE_TTL)
+
+
+def get_user(user_id):
+    """ User doc (without password/AccessKey) or None. Callers get their own copy. """
+    key = str(user_id)
+    doc = user_cache.get(key)
+    if doc is None:
+        if not ObjectId.is_valid(key):
+            return None
+        _ensure_watcher()
+        doc = users_collection.find_one({"_id": ObjectId(key)}, USER_PROJECTION)
+        if not doc:
+            return None
+        user_cache.set(key, doc)
+    return dict(doc)
+
+
+def get_department_name(dept_id):
+    key = str(dept_id)
+    name = department_cache.get(key)
+    if name is None:
+        if not ObjectId.is_valid(key):
+            return ""
+        _ensure_watcher()
+        dept_doc = departments_collection.find_one({"_id": ObjectId(key)}, {"name": 1})
+        name = dept_doc.get('name', '') if dept_doc else ''
+        department_cache.set(key, name)
+    return name
+
+
+# Called with the id after every invalidation (chat/search.py keeps its index fresh this way)
+user_listeners = []
+department_listeners = []
+# Bumped on every invalidation: anything derived from directory data can compare it to go stale
+generation = 0
+
+
+def invalidate_user(user_id):
+    global generation
+    generation += 1
+    user_cache.invalidate(str(user_id))
+    for listener in user_listeners:
+        listener(str(user_id))
+
+
+def invalidate_department(dept_id):
+    global generation
+    generation += 1
+    department_cache.invalidate(str(dept_id))
+    for listener in department_listeners:
+        listener(str(dept_id))
+
+
+def clear():
+    global generation
+    generation += 1
+    user_cache.clear()
+    department_cache.clear()
+
+
+def stats():
+    return {"users": user_cache.stats(), "departments": department_cache.stats()}
+
+
+# --- CHANGE STREAM: Drop entries as soon as the Node backend edits them ---
+_watcher_started = False
+_watcher_lock = threading.Lock()
+
+
+def _ensure_watcher():
+    global _watcher_started
+    if _watcher_started or not settings.DIRECTORY_WATCH_CHANGES:
+        return
+    with _watcher_lock:
+        if _watcher_started:
+            return
+        _watcher_started = True
+        for collection, invalidate in ((users_collection, invalidate_user), (departments_collection, invalidate_department)):
+            threading.Thread(
+                target=_watch, args=(collection, invalidate),
+                name=f"directory-watch-{collection.name}", daemon=True
+            ).start()
+
+
+def _watch(collection, invalidate):
+    # Change streams need a replica set; on a standalone mongod we fall back to the TTL
+    while True:
+        try:
+            with collection.watch([{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]) as stream:
+                for change in stream:
+                    invalidate(change["documentKey"]["_id"])
+        except Exception as e:
+            print(f"Directory watch on {collection.name} stopped: {e}")
+            # A missed event could leave stale entries, so start from scratch
+            for cache in (user_cache, department_cache):
+                cache.clear()
+            time.sleep(settings.DIRECTORY_CACHE_TTL)
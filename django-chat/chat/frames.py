@@ -0,0 +1,61 @@
+"""
+Wire encoding of ChatConsumer frames.
+
+- Text clients get JSON, encoded with orjson when it is installed (compact,
+  several times faster than json.dumps) and the stdlib otherwise. A chat
+  message is encoded once in `receive`: the same text is echoed to the
+  sender and carried in the group event, so every JSON recipient sends it
+  as is.
+- Clients that offer the "chat.msgpack" subprotocol get binary MessagePack
+  frames and may send MessagePack too. The offer is ignored when msgpack
+  isn't installed, so those clients fall back to JSON.
+
+Batching sockets (?batch=1) get one array per frame either way; already
+encoded JSON objects or MessagePack values are joined into the array
+without re-encoding.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = "chat.msgpack"
+
+
+def dumps(frame):
+    """ Compact JSON text """
+    if orjson is not None:
+        return orjson.dumps(frame).decode()
+    return json.dumps(frame, separators=(",", ":"), ensure_ascii=False)
+
+
+def join(texts):
+    """ JSON array text from already encoded JSON values """
+    return "[" + ",".join(texts) + "]"
+
+
+def pack(frame):
+    return msgpack.packb(frame)
+
+
+def join_packed(packed):
+    """ MessagePack array from already packed values """
+    return msgpack.Packer().pack_array_header(len(packed)) + b"".join(packed)
+
+
+def unpack(data):
+    return msgpack.unpackb(data)
+
+
+def negotiate(offered):
+    """ The subprotocol to accept from a client's offer, or None for JSON """
+    if msgpack is not None and MSGPACK_SUBPROTOCOL in (offered or []):
+        return MSGPACK_SUBPROTOCOL
+    return None
@@ -0,0 +1,140 @@
+"""
+Indexes the chat service relies on, declared next to the queries they serve.
+
+`manage.py chat_indexes` creates them and explains the hot queries to make
+sure none of them falls back to a COLLSCAN. With MONGO_REQUIRE_INDEXES=True
+the ASGI app refuses to start while any of them is missing.
+"""
+import datetime
+from bson.objectid import ObjectId
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from .mongo_client import messages_collection, conversations_collection, users_collection, chat_tombstones_collection, pair_key
+
+# get_chat_history: each branch of the sender/receiver $or walks this index
+# in (timestamp, _id) order, so a keyset page costs the same at any depth.
+# Its (sender_id, receiver_id) prefix also serves mark-as-read.
+MESSAGE_INDEXES = [
+    IndexModel(
+        [("sender_id", ASCENDING), ("receiver_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)],
+        name="history_pair_ts"
+    ),
+    # WebSocket replay (sync.missed_since): received messages across conversations, and edits
+    IndexModel([("receiver_id", ASCENDING), ("timestamp", DESCENDING)], name="inbox_ts"),
+    IndexModel([("edited_at", ASCENDING)], name="edited_at", sparse=True),
+]
+
+# get_recent_chats / get_total_unread match one participant (sorted by
+# updated_at). Every pair lookup/upsert goes through the unique pair_key;
+# the partial filter lets it build before `migrate_pair_keys` has run.
+CONVERSATION_INDEXES = [
+    IndexModel([("participants", ASCENDING), ("updated_at", DESCENDING)], name="participants_updated"),
+    IndexModel(
+        [("pair_key", ASCENDING)], name="pair_key_unique", unique=True,
+        partialFilterExpression={"pair_key": {"$type": "string"}}
+    ),
+]
+
+# get_chat_history?since=: deletions in one conversation; tombstones expire on their own
+TOMBSTONE_INDEXES = [
+    IndexModel([("pair_key", ASCENDING), ("deleted_at", ASCENDING)], name="pair_deleted"),
+    IndexModel([("deleted_at", ASCENDING)], name="tombstone_ttl", expireAfterSeconds=settings.SYNC_TOMBSTONE_DAYS * 86400),
+]
+
+# Sidebar auto-populate and search visibility: users of a department by role
+USER_INDEXES = [
+    IndexModel([("department", ASCENDING), ("role", ASCENDING)], name="department_role"),
+]
+
+
+def required_indexes():
+    return [
+        (messages_collection, MESSAGE_INDEXES),
+        (conversations_collection, CONVERSATION_INDEXES),
+        (users_collection, USER_INDEXES),
+        (chat_tombstones_collection, TOMBSTONE_INDEXES),
+    ]
+
+
+def ensure_indexes():
+    """ Create missing indexes (no-op for the ones that already exist). Returns created names. """
+    created = []
+    for collection, models in required_indexes():
+        created += collection.create_indexes(models)
+    return created
+
+
+def missing_indexes():
+    """ [(collection name, index name)] for declared indexes whose key pattern doesn't exist """
+    missing = []
+    for collection, models in required_indexes():
+        existing = [list(info['key']) for info in collection.index_information().values()]
+        for model in models:
+            spec = model.document
+            if list(spec['key'].items()) not in existing:
+                missing.append((collection.name, spec['name']))
+    return missing
+
+
+def check_required_indexes():
+    missing = missing_indexes()
+    if missing:
+        names = ", ".join(f"{coll}.{name}" for coll, name in missing)
+        raise ImproperlyConfigured(f"Missing Mongo indexes: {names}. Run `python manage.py chat_indexes`.")
+
+
+# --- QUERY PROBES: The shapes the views and consumer actually send ---
+def query_probes():
+    a, b = str(ObjectId()), str(ObjectId())
+    dept = ObjectId()
+    dept_query = {"$in": [dept, str(dept)]}
+    cleared_at = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [
+        ("get_chat_history", messages_collection, {
+            "$or": [
+                {"sender_id": a, "receiver_id": b},
+                {"sender_id": b, "receiver_id": a}
+            ],
+            "timestamp": {"$gt": cleared_at}
+        }, [("timestamp", -1), ("_id", -1)]),
+        ("unread_range", messages_collection, {
+            "sender_id": b, "receiver_id": a, "is_read": False, "timestamp": {"$gt": cleared_at}
+        }, None),
+        ("ws_replay", messages_collection, {"$or": [
+            {"sender_id": a, "timestamp": {"$gt": cleared_at}},
+            {"receiver_id": a, "timestamp": {"$gt": cleared_at}},
+            {"sender_id": a, "edited_at": {"$gt": cleared_at}},
+            {"receiver_id": a, "edited_at": {"$gt": cleared_at}},
+        ]}, [("timestamp", 1), ("_id", 1)]),
+        ("get_recent_chats", conversations_collection, {"participants": a}, [("updated_at", -1)]),
+        ("conversation_pair", conversations_collection, {"pair_key": pair_key(a, b)}, None),
+        ("sidebar_users", users_collection, {"$or": [
+            {"_id": {"$in": [ObjectId()]}},
+            {"department": dept_query, "role": {"$in": ["Employee", "employee"]}}
+        ]}, None),
+        ("dept_heads", users_collection, {"department": dept_query, "role": "Department Head"}, None),
+    ]
+
+
+def _stages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
+
+
+def explain_probes():
+    """ [(probe name, collection name, winning plan stages)] """
+    results = []
+    for name, collection, query, sort in query_probes():
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+        results.append((name, collection.name, list(_stages(plan))))
+    return results
@@ -0,0 +1,308 @@
+"""
+Channel layer for running several Daphne workers on one host without Redis.
+
+Every worker keeps its own channels and group memberships in memory (the
+stock InMemoryChannelLayer, including its group_expiry handling) and
+listens on a Unix socket `<path>/<process id>.sock`.
+
+- Channel names carry the owning process id, so `send` goes straight to it.
+- When a worker gets its first member of a group it tells the other workers
+  ("joined"), and "left" when its last one goes. `group_send` then delivers
+  locally and forwards only to workers that have members of the group.
+- A worker that starts up says "hello" and every peer answers with the
+  groups it holds. Until that has had `sync_grace` seconds to settle (or if
+  the process never listens, e.g. a sender-only process), group_send falls
+  back to forwarding to every live worker.
+- Every resync_interval (group_expiry / 4 by default) each worker sends its
+  full group list again. Peers refresh those memberships and forget any
+  the list no longer has, which also repairs a lost "joined" or "left".
+  A remote membership not confirmed for group_expiry expires; sockets of
+  dead workers are removed the first time a connection to them is refused.
+
+Frames on the socket are a 4-byte big-endian length followed by JSON, so
+messages must be JSON-serialisable (every event this app sends already is).
+"""
+import asyncio
+import atexit
+import json
+import os
+import random
+import string
+import struct
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+_HEADER = struct.Struct("!I")
+
+
+class UnixSocketChannelLayer(InMemoryChannelLayer):
+
+    def __init__(self, path="/tmp/chat-channel-layer", peer_refresh=1.0, sync_grace=1.0,
+                 clean_interval=1.0, resync_interval=None, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.peer_refresh = peer_refresh
+        self.sync_grace = sync_grace
+        self.clean_interval = clean_interval
+        # Must stay well under group_expiry, or peers expire groups this worker still has
+        self.resync_interval = self.group_expiry / 4 if resync_interval is None else resync_interval
+        self.process_id = "%d-%s" % (os.getpid(), "".join(random.choice(string.ascii_lowercase) for _ in range(6)))
+        self.socket_path = os.path.join(path, f"{self.process_id}.sock")
+        self._server = None
+        self._server_loop = None
+        self._routing_from = None
+        self._incoming = set()
+        self._peers = {}           # process id -> StreamWriter
+        self._connect_locks = {}
+        self._peer_ids = set()
+        self._peers_listed_at = 0
+        self._remote_groups = {}   # group -> {process id: last confirmed at}
+        self._cleaned_at = 0
+        self._synced_at = 0
+
+    # --- Routing ---
+
+    async def new_channel(self, prefix="specific."):
+        await self._ensure_server()
+        return "%s.unix.%s!%s" % (
+            prefix,
+            self.process_id,
+            "".join(random.choice(string.ascii_letters) for _ in range(12)),
+        )
+
+    def _owner(self, channel):
+        """ Process id encoded in a channel name from new_channel, else None """
+        if ".unix." not in channel or "!" not in channel:
+            return None
+        return channel.split(".unix.", 1)[1].split("!", 1)[0]
+
+    async def send(self, channel, message):
+        owner = self._owner(channel)
+        if owner is None or owner == self.process_id:
+            return await super().send(channel, message)
+        await self._forward(owner, {"op": "send", "channel": channel, "message": message})
+
+    async def group_add(self, group, channel):
+        owner = self._owner(channel)
+        if owner is not None and owner != self.process_id:
+            return await self._forward(owner, {"op": "group_add", "group": group, "channel": channel})
+        await self._ensure_server()
+        await self._maybe_resync()
+        first = not self.groups.get(group)
+        await super().group_add(group, channel)
+        if first:
+            await self._broadcast({"op": "joined", "group": group, "process": self.process_id})
+
+    async def group_discard(self, group, channel):
+        owner = self._owner(channel)
+        if owner is not None and owner != self.process_id:
+            return await self._forward(owner, {"op": "group_discard", "group": group, "channel": channel})
+        had_members = bool(self.groups.get(group))
+        await super().group_discard(group, channel)
+        if had_members and not self.groups.get(group):
+            await self._broadcast({"op": "left", "group": group, "process": self.process_id})
+
+    async def group_send(self, group, message):
+        await self._maybe_resync()
+        await super().group_send(group, message)
+        frame = {"op": "group_send", "group": group, "message": message}
+        await asyncio.gather(*(self._forward(peer, frame) for peer in self._group_peers(group)))
+
+    def has_members(self, group):
+        """ False only when no worker is known to have a member (chat/presence.py) """
+        return bool(self.groups.get(group)) or bool(self._group_peers(group))
+
+    def _group_peers(self, group):
+        if self._routing_from is None or time.monotonic() < self._routing_from:
+            return self._list_peers()
+        members = self._remote_groups.get(group)
+        if not members:
+            return ()
+        expired = time.time() - self.group_expiry
+        for peer, confirmed_at in list(members.items()):
+            if confirmed_at < expired:
+                del members[peer]
+        return list(members)
+
+    async def _maybe_resync(self):
+        """ Re-send our group list to every peer once per resync_interval """
+        if self._server is None or time.monotonic() - self._synced_at < self.resync_interval:
+            return
+        self._synced_at = time.monotonic()
+        await self._broadcast(self._sync_frame())
+
+    def _sync_frame(self):
+        groups = [group for group, members in self.groups.items() if members]
+        return {"op": "sync", "process": self.process_id, "groups": groups}
+
+    def _clean_expired(self):
+        # The stock implementation walks every group and channel; once per
+        # clean_interval is plenty for expiry and keeps group_send O(members)
+        now = time.monotonic()
+        if now - self._cleaned_at >= self.clean_interval:
+            self._cleaned_at = now
+            super()._clean_expired()
+
+    async def flush(self):
+        await super().flush()
+        self._remote_groups = {}
+        await self.close()
+
+    async def close(self):
+        for writer in list(self._peers.values()) + list(self._incoming):
+            writer.close()
+        self._peers = {}
+        self._connect_locks = {}
+        self._incoming = set()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            self._routing_from = None
+            self._unlink()
+
+    # --- Listening side ---
+
+    async def _ensure_server(self):
+        loop = asyncio.get_running_loop()
+        if self._server is not None and self._server_loop is loop:
+            return
+        if self._server is not None:
+            # Previous event loop is gone (e.g. successive asyncio.run calls)
+            self._server.close()
+            self._peers = {}
+            self._connect_locks = {}
+            self._incoming = set()
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        self._unlink()
+        self._server = await asyncio.start_unix_server(self._serve, path=self.socket_path)
+        self._server_loop = loop
+        self._peers_listed_at = 0
+        self._routing_from = time.monotonic() + self.sync_grace
+        self._synced_at = time.monotonic()
+        atexit.register(self._unlink)
+        await self._broadcast({"op": "hello", "process": self.process_id})
+
+    def _unlink(self):
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    async def _serve(self, reader, writer):
+        self._incoming.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(_HEADER.size)
+                frame = json.loads(await reader.readexactly(_HEADER.unpack(header)[0]))
+                try:
+                    await self._dispatch(frame)
+                except Exception as e:
+                    # One bad frame must not cut this peer off
+                    print(f"Channel layer: dropped {frame.get('op')} frame from a peer: {e!r}")
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Peer went away, or our loop is shutting down
+            pass
+        finally:
+            self._incoming.discard(writer)
+            writer.close()
+
+    async def _dispatch(self, frame):
+        op = frame["op"]
+        if op == "group_send":
+            # Local members only - the sender already picked the processes
+            await super().group_send(frame["group"], frame["message"])
+        elif op == "send":
+            try:
+                await super().send(frame["channel"], frame["message"])
+            except ChannelFull:
+                pass
+        elif op == "group_add":
+            await self.group_add(frame["group"], frame["channel"])
+        elif op == "group_discard":
+            await self.group_discard(frame["group"], frame["channel"])
+        elif op == "joined":
+            self._peer_ids.add(frame["process"])
+            self._remote_groups.setdefault(frame["group"], {})[frame["process"]] = time.time()
+        elif op == "left":
+            self._drop_remote(frame["group"], frame["process"])
+        elif op == "hello":
+            self._peer_ids.add(frame["process"])
+            await self._forward(frame["process"], self._sync_frame())
+        elif op == "sync":
+            # The peer's complete list: confirm what it has, forget what it no longer has
+            process, listed, now = frame["process"], set(frame["groups"]), time.time()
+            self._peer_ids.add(process)
+            for group, members in list(self._remote_groups.items()):
+                if process in members and group not in listed:
+                    self._drop_remote(group, process)
+            for group in listed:
+                self._remote_groups.setdefault(group, {})[process] = now
+
+    def _drop_remote(self, group, process):
+        members = self._remote_groups.get(group)
+        if members is not None:
+            members.pop(process, None)
+            if not members:
+                del self._remote_groups[group]
+
+    # --- Sending side ---
+
+    def _list_peers(self):
+        now = time.monotonic()
+        if now - self._peers_listed_at > self.peer_refresh:
+            try:
+                names = os.listdir(self.path)
+            except FileNotFoundError:
+                names = []
+            self._peer_ids = {
+                n[:-len(".sock")] for n in names
+                if n.endswith(".sock") and n[:-len(".sock")] != self.process_id
+            }
+            self._peers_listed_at = now
+        return list(self._peer_ids)
+
+    async def _broadcast(self, frame):
+        await asyncio.gather(*(self._forward(peer, frame) for peer in self._list_peers()))
+
+    async def _forward(self, peer, frame):
+        data = json.dumps(frame).encode()
+        packet = _HEADER.pack(len(data)) + data
+        for _ in range(2):
+            writer = self._peers.get(peer)
+            try:
+                if writer is None:
+                    writer = await self._connect(peer)
+                writer.write(packet)
+                await writer.drain()
+                return
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Worker died without cleaning up: forget it and remove its socket
+                self._forget_peer(peer, unlink=True)
+                return
+            except (ConnectionError, OSError):
+                # Broken pipe on a cached connection - reconnect once
+                self._forget_peer(peer)
+
+    async def _connect(self, peer):
+        lock = self._connect_locks.setdefault(peer, asyncio.Lock())
+        async with lock:
+            writer = self._peers.get(peer)
+            if writer is None:
+                _, writer = await asyncio.open_unix_connection(os.path.join(self.path, f"{peer}.sock"))
+                self._peers[peer] = writer
+            return writer
+
+    def _forget_peer(self, peer, unlink=False):
+        writer = self._peers.pop(peer, None)
+        if writer is not None:
+            writer.close()
+        if unlink:
+            try:
+                os.unlink(os.path.join(self.path, f"{peer}.sock"))
+            except FileNotFoundError:
+                pass
+            self._peer_ids.discard(peer)
+            for members in self._remote_groups.values():
+                members.pop(peer, None)
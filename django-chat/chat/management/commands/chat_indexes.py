@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.indexes import ensure_indexes, explain_probes, missing_indexes
+
+
+class Command(BaseCommand):
+    help = "Create the chat service's Mongo indexes and verify its queries don't COLLSCAN."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help="Only report missing indexes; don't create anything")
+        parser.add_argument('--skip-explain', action='store_true',
+                            help="Don't run explain() on the query probes")
+
+    def handle(self, *args, **opts):
+        if opts['check']:
+            missing = missing_indexes()
+            for coll, name in missing:
+                self.stdout.write(self.style.ERROR(f"missing  {coll}.{name}"))
+        else:
+            missing = []
+            for name in ensure_indexes():
+                self.stdout.write(f"ok       {name}")
+
+        failed = []
+        if not opts['skip_explain']:
+            for name, coll, stages in explain_probes():
+                if 'COLLSCAN' in stages:
+                    failed.append(name)
+                    self.stdout.write(self.style.ERROR(f"COLLSCAN {name} on {coll}: {' > '.join(stages)}"))
+                else:
+                    self.stdout.write(f"indexed  {name} on {coll}: {' > '.join(stages)}")
+
+        if missing or failed:
+            raise CommandError(f"{len(missing)} missing index(es), {len(failed)} query probe(s) doing a COLLSCAN")
+        self.stdout.write(self.style.SUCCESS("All chat indexes in place."))
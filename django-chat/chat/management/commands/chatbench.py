@@ -0,0 +1,398 @@
+import asyncio
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+import jwt
+from bson.objectid import ObjectId
+from channels.layers import channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client, override_settings
+from pymongo import MongoClient
+
+from chat import directory, frames, mongo_client
+from chat.middleware import JWTAuthMiddleware
+from chat.routing import websocket_urlpatterns
+from chat.testing import CommandCounter, OpCounter, chat_urlconf, standin_database, use_mongo_database
+from chat.writebehind import get_message_writer
+
+ENDPOINTS = ['recent', 'history', 'search', 'unread']
+VIEWS = ['sync', 'async']
+
+
+def percentiles(samples):
+    """ p50/p95/p99/max of a list of seconds, in milliseconds """
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1] * 1000, 2)}
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the chat service on one worker: N concurrent WebSocket clients through "
+            "ChatConsumer, then the REST endpoints. Reports throughput, p50/p95/p99 latency and "
+            "Mongo operations per request; --json writes the results for comparing releases.")
+
+    MODES = {
+        'inline': {'MONGO_EXECUTOR_WORKERS': 0, 'MESSAGE_WRITE_BEHIND': False},
+        'executor': {'MESSAGE_WRITE_BEHIND': False},
+        'write-behind': {'MESSAGE_WRITE_BEHIND': True, 'WRITE_BEHIND_DURABLE_ACK': True},
+        'write-behind-fast': {'MESSAGE_WRITE_BEHIND': True, 'WRITE_BEHIND_DURABLE_ACK': False},
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=1000, help="Concurrent WebSocket clients (even number)")
+        parser.add_argument('--messages', type=int, default=5, help="Messages sent by each client")
+        parser.add_argument('--latency-ms', type=float, default=1.0,
+                            help="Simulated Mongo round-trip added to every stand-in call")
+        parser.add_argument('--mongo-uri', default=None,
+                            help="Run against a real mongod instead of the in-process stand-in")
+        parser.add_argument('--db', default='chat_bench', help="Scratch database name (dropped before the run)")
+        parser.add_argument('--compare', action='store_true',
+                            help="Also run with MONGO_EXECUTOR_WORKERS=0 (pymongo inline on the event loop)")
+        parser.add_argument('--modes', default=None,
+                            help="Comma-separated persistence paths to run: "
+                                 "inline, executor, write-behind, write-behind-fast (no durable ack)")
+        parser.add_argument('--protocol', choices=['json', 'msgpack'], default='json',
+                            help="WebSocket wire format (msgpack offers the chat.msgpack subprotocol)")
+        parser.add_argument('--flood', type=int, default=0,
+                            help="Frames blasted by one extra user, per flood socket, during the WebSocket phase")
+        parser.add_argument('--flood-sockets', type=int, default=4, help="Sockets the flooding user opens")
+        parser.add_argument('--timeout', type=float, default=120, help="Seconds to wait for each frame")
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                            help="REST endpoints to hit after the WebSocket run ('' to skip): " + ', '.join(ENDPOINTS))
+        parser.add_argument('--requests', type=int, default=200, help="Requests per REST endpoint")
+        parser.add_argument('--concurrency', type=int, default=8, help="Threads issuing REST requests")
+        parser.add_argument('--views', default=None,
+                            help="Comma-separated REST view variants to compare through the ASGI handler "
+                                 "(sync, async); --concurrency is then requests in flight")
+        parser.add_argument('--json', default=None, metavar='PATH',
+                            help="Write machine-readable results to PATH ('-' for stdout)")
+        parser.add_argument('--baseline', default=None, metavar='PATH',
+                            help="Compare with an earlier --json file and fail on regressions")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="Allowed fractional drop in throughput / rise in p95 against --baseline")
+
+    def handle(self, *args, **opts):
+        if opts['sockets'] < 2 or opts['sockets'] % 2:
+            raise CommandError("--sockets must be an even number >= 2")
+        if opts['modes']:
+            modes = [m.strip() for m in opts['modes'].split(',') if m.strip()]
+        else:
+            modes = ['inline', 'executor'] if opts['compare'] else ['executor']
+        unknown = set(modes) - set(self.MODES)
+        if unknown:
+            raise CommandError(f"Unknown mode(s): {', '.join(sorted(unknown))}")
+        endpoints = [e.strip() for e in opts['endpoints'].split(',') if e.strip()]
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError(f"Unknown endpoint(s): {', '.join(sorted(unknown))}")
+        variants = [v.strip() for v in (opts['views'] or '').split(',') if v.strip()]
+        unknown = set(variants) - set(VIEWS)
+        if unknown:
+            raise CommandError(f"Unknown view variant(s): {', '.join(sorted(unknown))}")
+        if opts['protocol'] == 'msgpack' and frames.msgpack is None:
+            raise CommandError("--protocol msgpack needs the msgpack package")
+
+        if opts['mongo_uri']:
+            counter = CommandCounter()
+            MongoClient(opts['mongo_uri']).drop_database(opts['db'])
+            db = MongoClient(opts['mongo_uri'], event_listeners=[counter])[opts['db']]
+            latency = 0
+            proxy_counter = None
+        else:
+            counter = proxy_counter = OpCounter()
+            db = standin_database(opts['db'])
+            latency = opts['latency_ms'] / 1000.0
+
+        report = {
+            "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "backend": "mongod" if opts['mongo_uri'] else "standin",
+            "params": {k: opts[k] for k in ('sockets', 'messages', 'latency_ms', 'requests', 'concurrency', 'views', 'protocol', 'flood', 'flood_sockets')},
+            "settings": {"MONGO_EXECUTOR_WORKERS": settings.MONGO_EXECUTOR_WORKERS},
+            "runs": [],
+        }
+
+        with use_mongo_database(db, latency=latency, counter=proxy_counter):
+            user_ids = self.seed_users(db, opts['sockets'] + 2)
+            # The flooder writes to a user with no socket: every frame costs inserts, not deliveries
+            flood_ids = user_ids[-2:]
+            user_ids = user_ids[:-2]
+            for mode in modes:
+                db['messages'].delete_many({})
+                db['conversations'].delete_many({})
+                directory.clear()
+                run = {"mode": mode}
+                with override_settings(**self.MODES[mode]):
+                    mongo_client._executor = None
+                    channel_layers.backends.clear()
+                    counter.reset()
+                    # The app logs every connect with print(); keep the report readable
+                    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                        ws = asyncio.run(self.run_sockets(
+                            user_ids, opts['messages'], opts['timeout'], opts['protocol'],
+                            flood=(opts['flood'], opts['flood_sockets'], flood_ids)))
+                    ws["mongo_ops"] = counter.total()
+                    ws["mongo_ops_per_message"] = round(ws["mongo_ops"] / ws["messages"], 2)
+                    ws["stored"] = db['messages'].count_documents({})
+                    if opts['flood']:
+                        ws["flood"]["stored"] = db['messages'].count_documents({"sender_id": flood_ids[0]})
+                        ws["stored"] -= ws["flood"]["stored"]
+                    run["ws"] = ws
+                    self.print_ws(mode, ws)
+
+                    if endpoints:
+                        run["rest"] = {}
+                        for endpoint in endpoints:
+                            # Without --views: the test client from threads (no ASGI handler)
+                            for variant in variants or [None]:
+                                name = f"{endpoint}:{variant}" if variant else endpoint
+                                counter.reset()
+                                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                                    if variant:
+                                        with override_settings(ROOT_URLCONF=chat_urlconf(variant == 'async')):
+                                            result = asyncio.run(self.run_rest_asgi(
+                                                endpoint, user_ids, opts['requests'], opts['concurrency']))
+                                    else:
+                                        result = self.run_rest(endpoint, user_ids, opts['requests'], opts['concurrency'])
+                                result["mongo_ops_per_request"] = round(counter.total() / result["requests"], 2)
+                                run["rest"][name] = result
+                                self.print_rest(name, result)
+                    mongo_client._executor = None
+                report["runs"].append(run)
+
+        if opts['json']:
+            data = json.dumps(report, indent=2, default=str)
+            if opts['json'] == '-':
+                self.stdout.write(data)
+            else:
+                with open(opts['json'], 'w') as f:
+                    f.write(data + "\n")
+                self.stdout.write(f"Results written to {opts['json']}")
+
+        if opts['baseline']:
+            with open(opts['baseline']) as f:
+                regressions = self.compare(json.load(f), report, opts['tolerance'])
+            if regressions:
+                raise CommandError("Regressions against baseline:\n  " + "\n  ".join(regressions))
+            self.stdout.write(f"No regressions against {opts['baseline']} (tolerance {opts['tolerance']:.0%})")
+
+    def compare(self, baseline, report, tolerance):
+        """ Throughput that fell or p95 latency that rose by more than `tolerance`, per mode/endpoint """
+        previous = {run["mode"]: run for run in baseline.get("runs", [])}
+        regressions = []
+
+        def check(name, old_rate, new_rate, old_p95, new_p95):
+            if old_rate and new_rate < old_rate * (1 - tolerance):
+                regressions.append(f"{name}: throughput {old_rate} -> {new_rate}/s")
+            if old_p95 and new_p95 is not None and new_p95 > old_p95 * (1 + tolerance):
+                regressions.append(f"{name}: p95 {old_p95} -> {new_p95}ms")
+
+        for run in report["runs"]:
+            old = previous.get(run["mode"])
+            if not old:
+                continue
+            check(f"{run['mode']} ws", old["ws"]["messages_per_s"], run["ws"]["messages_per_s"],
+                  old["ws"]["ack_latency_ms"]["p95"], run["ws"]["ack_latency_ms"]["p95"])
+            for endpoint, result in run.get("rest", {}).items():
+                old_result = old.get("rest", {}).get(endpoint)
+                if old_result:
+                    check(f"{run['mode']} {endpoint}", old_result["requests_per_s"], result["requests_per_s"],
+                          old_result["latency_ms"]["p95"], result["latency_ms"]["p95"])
+        return regressions
+
+    def seed_users(self, db, count):
+        db['users'].delete_many({})
+        docs = [
+            {"_id": ObjectId(), "firstName": f"Bench{i}", "lastName": "User", "employeeId": f"EMP-{i}", "role": "Admin"}
+            for i in range(count)
+        ]
+        db['users'].insert_many(docs)
+        return [str(d["_id"]) for d in docs]
+
+    # --- WebSocket phase ---
+
+    async def run_sockets(self, user_ids, messages, timeout, protocol='json', flood=(0, 0, None)):
+        application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        binary = protocol == 'msgpack'
+        subprotocols = [frames.MSGPACK_SUBPROTOCOL] if binary else None
+        comms = []
+        for user_id in user_ids:
+            token = jwt.encode({"userId": user_id}, settings.SECRET_KEY, algorithm="HS256")
+            comms.append(WebsocketCommunicator(application, f"/ws/chat/?token={token}", subprotocols=subprotocols))
+
+        results = await asyncio.gather(*(c.connect(timeout=timeout) for c in comms))
+        if not all(connected for connected, _ in results):
+            raise CommandError("Some sockets were rejected during connect")
+
+        flood_frames, flood_sockets, (flooder_id, sink_id) = flood if flood[0] else (0, 0, (None, None))
+        flooders = []
+        if flood_frames:
+            token = jwt.encode({"userId": flooder_id}, settings.SECRET_KEY, algorithm="HS256")
+            flooders = [WebsocketCommunicator(application, f"/ws/chat/?token={token}") for _ in range(flood_sockets)]
+            await asyncio.gather(*(f.connect(timeout=timeout) for f in flooders))
+            # Everything is in the socket's input queue at once, as from a client that never waits
+            for comm in flooders:
+                for n in range(flood_frames):
+                    await comm.send_to(text_data=json.dumps({"message": f"flood {n}", "receiverId": sink_id}))
+
+        sent_at = {}
+        ack_latency = []
+        delivery_latency = []
+        wire_bytes = [0, 0]  # sent, received
+
+        async def client(i):
+            comm = comms[i]
+            partner = user_ids[i ^ 1]
+            for n in range(messages):
+                text = f"bench {i} {n}"
+                sent_at[text] = time.perf_counter()
+                frame = {"message": text, "receiverId": partner}
+                if binary:
+                    data = frames.pack(frame)
+                    await comm.send_to(bytes_data=data)
+                else:
+                    data = json.dumps(frame)
+                    await comm.send_to(text_data=data)
+                wire_bytes[0] += len(data)
+            # Own echoes plus everything the partner sent
+            for _ in range(2 * messages):
+                data = await comm.receive_from(timeout=timeout)
+                wire_bytes[1] += len(data)
+                frame = frames.unpack(data) if binary else json.loads(data)
+                elapsed = time.perf_counter() - sent_at[frame["message"]]
+                (ack_latency if frame["sender_id"] == user_ids[i] else delivery_latency).append(elapsed)
+
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        await asyncio.gather(*(client(i) for i in range(len(comms))))
+        cpu = time.process_time() - cpu_start
+        elapsed = time.perf_counter() - start
+
+        await asyncio.gather(*(c.disconnect(timeout=timeout) for c in comms + flooders))
+        if settings.MESSAGE_WRITE_BEHIND:
+            # Without durable ack the last batch may still be queued
+            await get_message_writer().drain()
+
+        total = len(comms) * messages
+        return {
+            "sockets": len(comms),
+            "messages": total,
+            "elapsed_s": round(elapsed, 3),
+            "messages_per_s": round(total / elapsed, 1),
+            "protocol": protocol,
+            # Client frames in, and the echo plus delivery out, per message sent
+            "bytes_in_per_message": round(wire_bytes[0] / total, 1),
+            "bytes_out_per_message": round(wire_bytes[1] / total, 1),
+            # Whole process (clients included), so compare protocols on the same machine
+            "cpu_ms_per_message": round(cpu * 1000 / total, 3),
+            "flood": {"sockets": len(flooders), "frames": len(flooders) * flood_frames},
+            "ack_latency_ms": percentiles(ack_latency),
+            "delivery_latency_ms": percentiles(delivery_latency),
+        }
+
+    def print_ws(self, mode, ws):
+        label = mode if mode == 'inline' else f"{mode} ({settings.MONGO_EXECUTOR_WORKERS} threads)"
+        ack = ws["ack_latency_ms"]
+        self.stdout.write(
+            f"{label:<32} sockets={ws['sockets']} messages={ws['messages']} stored={ws['stored']} "
+            f"elapsed={ws['elapsed_s']:.2f}s throughput={ws['messages_per_s']:.0f} msg/s "
+            f"ack p50/p95/p99={ack['p50']}/{ack['p95']}/{ack['p99']}ms ops/msg={ws['mongo_ops_per_message']} "
+            f"{ws['protocol']} bytes in/out={ws['bytes_in_per_message']}/{ws['bytes_out_per_message']} "
+            f"cpu={ws['cpu_ms_per_message']}ms/msg"
+        )
+        if ws["flood"]["frames"]:
+            delivery = ws["delivery_latency_ms"]
+            self.stdout.write(
+                f"  flood: {ws['flood']['frames']} frames on {ws['flood']['sockets']} sockets, "
+                f"{ws['flood']['stored']} stored; others' delivery p50/p95/p99="
+                f"{delivery['p50']}/{delivery['p95']}/{delivery['p99']}ms"
+            )
+
+    # --- REST phase ---
+
+    def rest_request(self, endpoint, user_id, partner_id, i):
+        if endpoint == 'recent':
+            return f"/api/chat/recent/{user_id}", {}
+        if endpoint == 'history':
+            return f"/api/chat/history/{user_id}", {"other_user": partner_id, "limit": 50}
+        if endpoint == 'search':
+            return "/api/chat/search", {"q": f"bench{i % 100}", "user_id": user_id}
+        return f"/api/chat/unread/total/{user_id}", {}
+
+    def run_rest(self, endpoint, user_ids, requests, concurrency):
+        tokens = {}
+
+        def one(i):
+            user_id = user_ids[i % len(user_ids)]
+            if user_id not in tokens:
+                tokens[user_id] = jwt.encode({"userId": user_id}, settings.SECRET_KEY, algorithm="HS256")
+            path, params = self.rest_request(endpoint, user_id, user_ids[(i % len(user_ids)) ^ 1], i)
+            start = time.perf_counter()
+            response = Client().get(path, params, HTTP_AUTHORIZATION=f"Bearer {tokens[user_id]}")
+            return time.perf_counter() - start, response.status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(one, range(requests)))
+        elapsed = time.perf_counter() - start
+
+        errors = sum(1 for _, status in results if status >= 400)
+        return {
+            "requests": requests,
+            "errors": errors,
+            "elapsed_s": round(elapsed, 3),
+            "requests_per_s": round(requests / elapsed, 1),
+            "latency_ms": percentiles([t for t, _ in results]),
+        }
+
+    async def run_rest_asgi(self, endpoint, user_ids, requests, concurrency):
+        """ Same requests through Django's ASGI handler, `concurrency` in flight on one event loop """
+        tokens = {}
+        in_flight = asyncio.Semaphore(concurrency)
+        client = AsyncClient()
+
+        async def one(i):
+            user_id = user_ids[i % len(user_ids)]
+            if user_id not in tokens:
+                tokens[user_id] = jwt.encode({"userId": user_id}, settings.SECRET_KEY, algorithm="HS256")
+            path, params = self.rest_request(endpoint, user_id, user_ids[(i % len(user_ids)) ^ 1], i)
+            async with in_flight:
+                start = time.perf_counter()
+                response = await client.get(path, params, headers={"Authorization": f"Bearer {tokens[user_id]}"})
+                return time.perf_counter() - start, response.status_code
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one(i) for i in range(requests)))
+        elapsed = time.perf_counter() - start
+
+        errors = sum(1 for _, status in results if status >= 400)
+        return {
+            "requests": requests,
+            "errors": errors,
+            "elapsed_s": round(elapsed, 3),
+            "requests_per_s": round(requests / elapsed, 1),
+            "latency_ms": percentiles([t for t, _ in results]),
+        }
+
+    def print_rest(self, endpoint, result):
+        lat = result["latency_ms"]
+        self.stdout.write(
+            f"  {endpoint:<14} requests={result['requests']} errors={result['errors']} "
+            f"throughput={result['requests_per_s']:.0f} req/s "
+            f"p50/p95/p99={lat['p50']}/{lat['p95']}/{lat['p99']}ms ops/req={result['mongo_ops_per_request']}"
+        )
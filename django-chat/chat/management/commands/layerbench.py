@@ -0,0 +1,97 @@
+import asyncio
+import multiprocessing
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.layers import UnixSocketChannelLayer
+
+
+def expected_deliveries(worker, workers, channels, messages):
+    """ How many events land on `worker`'s channels (targets are deterministic) """
+    total_groups = workers * channels
+    count = 0
+    for sender in range(workers):
+        for n in range(messages):
+            if ((sender * messages + n) % total_groups) // channels == worker:
+                count += 1
+    return count
+
+
+async def run_worker(worker, workers, channels, messages, path, barrier, results):
+    layer = UnixSocketChannelLayer(path=path, capacity=100000, peer_refresh=0, sync_grace=0.5)
+    names = []
+    for i in range(channels):
+        name = await layer.new_channel()
+        await layer.group_add(f"user_{worker * channels + i}", name)
+        names.append(name)
+
+    expected = expected_deliveries(worker, workers, channels, messages)
+    received = 0
+    done = asyncio.Event()
+    if not expected:
+        done.set()
+
+    async def drain(name):
+        nonlocal received
+        while True:
+            await layer.receive(name)
+            received += 1
+            if received == expected:
+                done.set()
+
+    receivers = [asyncio.create_task(drain(n)) for n in names]
+    # Everyone listening, then let hello/sync and joined announcements settle
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    await asyncio.sleep(layer.sync_grace)
+
+    start = time.perf_counter()
+    total_groups = workers * channels
+    for n in range(messages):
+        target = (worker * messages + n) % total_groups
+        await layer.group_send(f"user_{target}", {"type": "chat.message", "message": {"n": n}})
+    await done.wait()
+    elapsed = time.perf_counter() - start
+
+    # Keep serving peers that are still sending to us
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    for task in receivers:
+        task.cancel()
+    await layer.close()
+    results.put(elapsed)
+
+
+def worker_main(*args):
+    asyncio.run(run_worker(*args))
+
+
+class Command(BaseCommand):
+    help = "Measure cross-process group_send fan-out of the Unix socket channel layer."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', default='1,2,4', help="Comma-separated worker counts to try")
+        parser.add_argument('--channels', type=int, default=200, help="Connected sockets (groups) per worker")
+        parser.add_argument('--messages', type=int, default=5000, help="group_send calls per worker")
+
+    def handle(self, *args, **opts):
+        ctx = multiprocessing.get_context('fork')
+        for workers in [int(w) for w in opts['workers'].split(',')]:
+            with tempfile.TemporaryDirectory(prefix="layerbench-") as path:
+                barrier = ctx.Barrier(workers)
+                results = ctx.Queue()
+                procs = [
+                    ctx.Process(target=worker_main, args=(w, workers, opts['channels'], opts['messages'], path, barrier, results))
+                    for w in range(workers)
+                ]
+                for p in procs:
+                    p.start()
+                elapsed = max(results.get(timeout=600) for _ in procs)
+                for p in procs:
+                    p.join()
+
+            total = workers * opts['messages']
+            self.stdout.write(
+                f"workers={workers} group_sends={total} elapsed={elapsed:.2f}s "
+                f"throughput={total / elapsed:.0f} events/s"
+            )
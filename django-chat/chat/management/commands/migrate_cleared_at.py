@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand, CommandError
+from pymongo import UpdateOne
+
+from chat.mongo_client import messages_collection, conversations_collection, pair_key
+
+# Pairs per update_many when stripping deleted_by
+UNSET_BATCH = 500
+
+
+class Command(BaseCommand):
+    help = "Convert per-message deleted_by arrays into per-participant cleared_at watermarks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report watermarks without writing")
+        parser.add_argument('--keep-deleted-by', action='store_true',
+                            help="Leave the old deleted_by arrays on messages after migrating")
+
+    def handle(self, *args, **opts):
+        # "Clear chat" tagged every message of the pair at that moment, so the newest
+        # tagged message marks where the user's view of the history starts.
+        pipeline = [
+            {"$match": {"deleted_by.0": {"$exists": True}}},
+            {"$unwind": "$deleted_by"},
+            {"$group": {
+                "_id": {"sender": "$sender_id", "receiver": "$receiver_id", "user": "$deleted_by"},
+                "cleared_at": {"$max": "$timestamp"}
+            }}
+        ]
+        watermarks = {}
+        for row in messages_collection.aggregate(pipeline, allowDiskUse=True):
+            key = (pair_key(row['_id']['sender'], row['_id']['receiver']), row['_id']['user'])
+            if key not in watermarks or row['cleared_at'] > watermarks[key]:
+                watermarks[key] = row['cleared_at']
+
+        # Only conversations already keyed can take a watermark (run migrate_pair_keys first);
+        # the other pairs keep their deleted_by tags for the next run
+        keys = {key for key, _ in watermarks}
+        keyed = {c['pair_key'] for c in conversations_collection.find({"pair_key": {"$in": list(keys)}}, {"pair_key": 1})}
+        for key in sorted(keys - keyed):
+            self.stdout.write(self.style.WARNING(f"skip     {key}: no conversation with this pair_key yet"))
+
+        ops = []
+        for (key, user_id), cleared_at in watermarks.items():
+            if key not in keyed:
+                continue
+            if opts['verbosity'] > 1:
+                self.stdout.write(f"{key} {user_id}: cleared_at={cleared_at.isoformat()}")
+            # $max keeps a newer watermark written since (re-running is safe)
+            ops.append(UpdateOne({"pair_key": key}, {"$max": {f"cleared_at.{user_id}": cleared_at}}))
+
+        if opts['dry_run']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Would set {len(ops)} watermark(s), skip {len(keys - keyed)} unkeyed pair(s)."
+            ))
+            return
+
+        if ops:
+            result = conversations_collection.bulk_write(ops, ordered=False)
+            if result.matched_count < len(ops):
+                raise CommandError(
+                    f"Only {result.matched_count} of {len(ops)} watermarks matched a conversation; "
+                    "deleted_by left in place. Re-run to retry."
+                )
+        unset = 0
+        if not opts['keep_deleted_by']:
+            # Strip the tags of the pairs whose watermark landed, and only those
+            pairs = [key.split(":") for key in sorted(keyed)]
+            for i in range(0, len(pairs), UNSET_BATCH):
+                unset += messages_collection.update_many(
+                    {"deleted_by": {"$exists": True}, "$or": [
+                        {"sender_id": a, "receiver_id": b} for x, y in pairs[i:i + UNSET_BATCH] for a, b in ((x, y), (y, x))
+                    ]},
+                    {"$unset": {"deleted_by": ""}}
+                ).modified_count
+        self.stdout.write(self.style.SUCCESS(
+            f"Set {len(ops)} watermark(s), removed deleted_by from {unset} message(s), "
+            f"skipped {len(keys - keyed)} unkeyed pair(s)."
+        ))
@@ -0,0 +1,72 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from chat.mongo_client import conversations_collection, pair_key
+
+
+class Command(BaseCommand):
+    help = "Backfill conversations.pair_key and merge duplicate conversations of the same pair."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report what would change without writing")
+
+    def handle(self, *args, **opts):
+        dry_run = opts['dry_run']
+        groups = {}
+        skipped = 0
+        for conv in conversations_collection.find({}):
+            participants = conv.get('participants') or []
+            if len(participants) != 2:
+                # e.g. docs upserted by the old toggle_chat without a participants array
+                skipped += 1
+                self.stdout.write(self.style.WARNING(f"skip     {conv['_id']}: participants={participants!r}"))
+                continue
+            groups.setdefault(pair_key(*participants), []).append(conv)
+
+        keyed = merged = 0
+        for key, convs in groups.items():
+            if len(convs) == 1:
+                if convs[0].get('pair_key') != key:
+                    keyed += 1
+                    if not dry_run:
+                        conversations_collection.update_one({"_id": convs[0]["_id"]}, {"$set": {"pair_key": key}})
+                continue
+
+            keeper, merged_fields, duplicate_ids = self.merge(convs)
+            merged += len(duplicate_ids)
+            self.stdout.write(f"merge    {key}: keep {keeper['_id']}, drop {[str(i) for i in duplicate_ids]}")
+            if not dry_run:
+                # Drop duplicates first so the unique pair_key can't collide with them
+                conversations_collection.delete_many({"_id": {"$in": duplicate_ids}})
+                conversations_collection.update_one({"_id": keeper["_id"]}, {"$set": dict(merged_fields, pair_key=key)})
+
+        action = "Would key" if dry_run else "Keyed"
+        self.stdout.write(self.style.SUCCESS(
+            f"{action} {keyed} conversation(s), merged away {merged} duplicate(s), skipped {skipped}."
+        ))
+
+    def merge(self, convs):
+        """ Keep the most recently updated doc; fold the others into it """
+        epoch = datetime.datetime.min
+
+        def updated(conv):
+            ts = conv.get('updated_at')
+            return ts.replace(tzinfo=None) if isinstance(ts, datetime.datetime) else epoch
+
+        convs = sorted(convs, key=updated, reverse=True)
+        keeper = convs[0]
+
+        # Copies can count the same messages, so a sum overcounts: keep the largest
+        # (run reconcile_unread afterwards for exact counts)
+        unread_counts = {}
+        for conv in convs:
+            for uid, count in (conv.get('unread_counts') or {}).items():
+                unread_counts[uid] = max(unread_counts.get(uid, 0), count)
+
+        merged_fields = {
+            # Stay on the safe side: a pair disabled in any copy stays disabled
+            "is_disabled": any(c.get('is_disabled', False) for c in convs),
+            "unread_counts": unread_counts,
+        }
+        return keeper, merged_fields, [c["_id"] for c in convs[1:]]
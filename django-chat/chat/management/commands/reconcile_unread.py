@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+
+from chat.mongo_client import messages_collection, conversations_collection
+
+
+class Command(BaseCommand):
+    help = "Backfill/repair conversations.unread_counts from the messages collection."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report drift without writing")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **opts):
+        # Unread = not read and newer than the receiver's read and "clear chat" watermarks.
+        # Totals per (sender, receiver) first; pairs with a watermark are recounted below.
+        pipeline = [
+            {"$match": {"is_read": False}},
+            {"$group": {"_id": {"sender": "$sender_id", "receiver": "$receiver_id"}, "count": {"$sum": 1}}}
+        ]
+        actual = {}
+        for row in messages_collection.aggregate(pipeline, allowDiskUse=True):
+            actual[(row['_id']['sender'], row['_id']['receiver'])] = row['count']
+
+        scanned = drifted = 0
+        ops = []
+        for conv in conversations_collection.find({}, {"participants": 1, "unread_counts": 1, "cleared_at": 1, "last_read_at": 1}):
+            scanned += 1
+            participants = conv.get('participants') or []
+            if len(participants) != 2:
+                continue
+            a, b = participants
+            expected = {a: actual.get((b, a), 0), b: actual.get((a, b), 0)}
+            for uid in expected:
+                watermark = max(filter(None, [
+                    (conv.get('cleared_at') or {}).get(uid),
+                    (conv.get('last_read_at') or {}).get(uid)
+                ]), default=None)
+                if watermark:
+                    other = b if uid == a else a
+                    expected[uid] = messages_collection.count_documents({
+                        "sender_id": other, "receiver_id": uid, "is_read": False,
+                        "timestamp": {"$gt": watermark}
+                    })
+            stored = conv.get('unread_counts') or {}
+            if all(stored.get(uid) == count for uid, count in expected.items()):
+                continue
+
+            drifted += 1
+            if opts['verbosity'] > 1:
+                self.stdout.write(f"{conv['_id']}: {stored} -> {expected}")
+            ops.append(UpdateOne(
+                {"_id": conv['_id']},
+                {"$set": {f"unread_counts.{uid}": count for uid, count in expected.items()}}
+            ))
+            if len(ops) >= opts['batch_size'] and not opts['dry_run']:
+                conversations_collection.bulk_write(ops, ordered=False)
+                ops = []
+
+        if ops and not opts['dry_run']:
+            conversations_collection.bulk_write(ops, ordered=False)
+
+        action = "would update" if opts['dry_run'] else "updated"
+        self.stdout.write(self.style.SUCCESS(f"Scanned {scanned} conversations, {action} {drifted}."))
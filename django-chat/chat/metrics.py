@@ -0,0 +1,250 @@
+"""
+Prometheus metrics for the chat service (METRICS_ENABLED=True), served
+as text on GET /metrics.
+
+- chat_http_request_duration_seconds: every view, via MetricsMiddleware
+- chat_ws_handler_duration_seconds: ChatConsumer handlers, via @timed
+- chat_mongo_command_duration_seconds / chat_mongo_command_errors_total:
+  every command per collection, from pymongo command monitoring
+- chat_ws_active_sockets
+- chat_channel_layer_send_duration_seconds: send/group_send on the layer
+- chat_fanout_skipped_total: group_sends skipped for users with no socket
+- chat_ws_slow_consumer_total: frames dropped / sockets closed because the
+  outbound queue of a batching socket was full
+- chat_ws_rate_limited_total: inbound frames turned away, by limit
+  (socket / user token bucket, full inbound queue)
+
+METRICS_ENABLED is read at startup. When it is off the middleware is not
+installed, no Mongo listener is registered and @timed returns the handler
+unchanged, so the only remaining cost is a flag check per socket
+open/close.
+"""
+import bisect
+import functools
+import threading
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, Http404
+from pymongo import monitoring
+
+ENABLED = settings.METRICS_ENABLED
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in items]
+
+
+class GaugeMetric(CounterMetric):
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self.lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.values.items())
+        lines = self.header()
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, [le])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+REGISTRY = []
+
+http_duration = HistogramMetric(
+    "chat_http_request_duration_seconds", "REST request latency by view", ("view", "method", "status"))
+handler_duration = HistogramMetric(
+    "chat_ws_handler_duration_seconds", "ChatConsumer handler latency", ("handler",))
+mongo_duration = HistogramMetric(
+    "chat_mongo_command_duration_seconds", "Mongo command latency by collection", ("collection", "command"))
+mongo_errors = CounterMetric(
+    "chat_mongo_command_errors_total", "Failed Mongo commands by collection", ("collection", "command"))
+active_sockets = GaugeMetric(
+    "chat_ws_active_sockets", "Open WebSocket connections in this worker")
+layer_send_duration = HistogramMetric(
+    "chat_channel_layer_send_duration_seconds", "Channel layer send/group_send latency", ("op",))
+slow_consumers = CounterMetric(
+    "chat_ws_slow_consumer_total", "Full outbound queues on batching sockets, by action taken", ("action",))
+rate_limited = CounterMetric(
+    "chat_ws_rate_limited_total", "Inbound WebSocket frames rejected, by limit", ("limit",))
+fanout_skipped = CounterMetric(
+    "chat_fanout_skipped_total", "group_sends skipped because the recipient has no open socket", ("event",))
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- DJANGO: middleware and the /metrics view ---
+class MetricsMiddleware:
+    """ Times every request; the label is the view function name. Sync and async
+    (so async views under ASGI aren't pushed back through a thread). """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self.observe(request, response, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, response, start)
+        return response
+
+    def observe(self, request, response, start):
+        match = request.resolver_match
+        if match is not None:
+            view = getattr(match.func, 'view_class', match.func).__name__
+            http_duration.observe(time.perf_counter() - start, view, request.method, f"{response.status_code // 100}xx")
+
+
+def metrics_view(request):
+    if not ENABLED:
+        raise Http404()
+    token = settings.METRICS_TOKEN
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return HttpResponse("Unauthorized", status=401)
+    return HttpResponse(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# --- WEBSOCKETS: handler timing, socket gauge, channel layer ---
+def timed(handler):
+    """ Record the duration of an async consumer method (no-op when disabled) """
+    if not ENABLED:
+        return handler
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            handler_duration.observe(time.perf_counter() - start, handler.__name__)
+    return wrapper
+
+
+def socket_opened():
+    if ENABLED:
+        active_sockets.inc()
+
+
+def socket_closed():
+    if ENABLED:
+        active_sockets.dec()
+
+
+def instrument_channel_layer(layer):
+    """ Time send/group_send on this layer instance; safe to call repeatedly """
+    if not ENABLED or layer is None or getattr(layer, '_metrics_instrumented', False):
+        return layer
+    for op in ('send', 'group_send'):
+        original = getattr(layer, op)
+
+        async def timed_op(*args, _original=original, _op=op, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await _original(*args, **kwargs)
+            finally:
+                layer_send_duration.observe(time.perf_counter() - start, _op)
+        setattr(layer, op, timed_op)
+    layer._metrics_instrumented = True
+    return layer
+
+
+# --- MONGO: pymongo command monitoring ---
+class MongoCommandListener(monitoring.CommandListener):
+
+    def __init__(self):
+        self.pending = {}
+
+    def started(self, event):
+        # getMore carries the cursor id under its name and the collection separately
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        self.pending[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event):
+        collection = self.pending.pop((event.connection_id, event.request_id), "")
+        mongo_duration.observe(event.duration_micros / 1e6, collection, event.command_name)
+
+    def failed(self, event):
+        collection = self.pending.pop((event.connection_id, event.request_id), "")
+        mongo_duration.observe(event.duration_micros / 1e6, collection, event.command_name)
+        mongo_errors.inc(collection, event.command_name)
+
+
+def mongo_event_listeners():
+    """ For MongoClient(event_listeners=...) """
+    return [MongoCommandListener()] if ENABLED else []
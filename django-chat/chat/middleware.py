@@ -1,16 +1,14 @@
-import jwt
-from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from urllib.parse import parse_qs
-from .mongo_client import users_collection
-from bson.objectid import ObjectId
+from . import directory
+from .auth import verify_token
 
 @database_sync_to_async
 def get_user(user_id):
     try:
-        user = users_collection.find_one({"_id": ObjectId(user_id)})
+        user = directory.get_user(user_id)
         if user:
             # Create a simple object to mimic a Django User
             # This is enough for the consumer to check is_authenticated
@@ -25,26 +23,27 @@ def get_user(user_id):
         return AnonymousUser()
 
 class JWTAuthMiddleware(BaseMiddleware):
+    """ Verifies the ?token= JWT once per connection. Consumers read scope["user_id"]
+    (None if missing/invalid, with scope["auth_error"] set for an invalid token). """
     async def __call__(self, scope, receive, send):
         # 1. Get the token from query string
         query_string = parse_qs(scope["query_string"].decode("utf8"))
         token = query_string.get("token")
 
+        scope["user_id"] = None
+        scope["user"] = AnonymousUser()
         if token:
             try:
-                # 2. Decode the token
-                # NOTE: Ensure 'settings.SECRET_KEY' matches your Node.js JWT Secret
-                # If Node uses a different secret, hardcode it here for now:
-                # secret = "your_node_jwt_secret"
-                payload = jwt.decode(token[0], settings.SECRET_KEY, algorithms=["HS256"])
-                user_id = payload.get("id") or payload.get("userId") or payload.get("_id")
-                
-                # 3. Get User from DB
+                # 2. Verify the token (cached until exp, see chat/auth.py)
+                user_id = verify_token(token[0])
+                if user_id is None:
+                    raise ValueError("Payload missing user ID")
+                scope["user_id"] = user_id
+
+                # 3. Get User from the directory cache
                 scope["user"] = await get_user(user_id)
             except Exception as e:
                 print(f"JWT Error: {e}")
-                scope["user"] = AnonymousUser()
-        else:
-            scope["user"] = AnonymousUser()
+                scope["auth_error"] = str(e)
 
-        return await super().__call__(scope, receive, send)
\ No newline at end of file
+        return await super().__call__(scope, receive, send)
@@ -1,16 +1,94 @@
 import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient
+from pymongo.read_preferences import Primary, read_pref_mode_from_name, make_read_preference
 from django.conf import settings
 from bson.objectid import ObjectId
+from .metrics import mongo_event_listeners
 
-client = MongoClient(settings.MONGO_URI)
-db = client[settings.MONGO_DB_NAME]
+# --- CLIENT FACTORY: built on first use, so manage.py commands and tests that never query don't pay for it ---
+_client = None
+_client_lock = threading.Lock()
+
+def client_options():
+    """ MongoClient keyword arguments from the MONGO_* settings """
+    options = {
+        "maxPoolSize": settings.MONGO_MAX_POOL_SIZE,
+        "minPoolSize": settings.MONGO_MIN_POOL_SIZE,
+        "connectTimeoutMS": settings.MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "event_listeners": mongo_event_listeners(),
+    }
+    if settings.MONGO_SOCKET_TIMEOUT_MS:
+        options["socketTimeoutMS"] = settings.MONGO_SOCKET_TIMEOUT_MS
+    if settings.MONGO_MAX_IDLE_TIME_MS:
+        options["maxIdleTimeMS"] = settings.MONGO_MAX_IDLE_TIME_MS
+    if settings.MONGO_COMPRESSORS:
+        # zstd needs the zstandard package, snappy python-snappy; pymongo warns and skips missing ones
+        options["compressors"] = settings.MONGO_COMPRESSORS
+    return options
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient(settings.MONGO_URI, **client_options())
+    return _client
+
+def get_database():
+    return get_client()[settings.MONGO_DB_NAME]
+
+def reads_from_primary():
+    return settings.MONGO_READ_HEAVY_PREFERENCE == 'primary'
+
+def read_heavy_preference():
+    """ MONGO_READ_HEAVY_PREFERENCE as a pymongo read preference (maxStalenessSeconds applies to secondaries) """
+    if reads_from_primary():
+        return Primary()
+    mode = read_pref_mode_from_name(settings.MONGO_READ_HEAVY_PREFERENCE)
+    return make_read_preference(mode, None, max_staleness=settings.MONGO_MAX_STALENESS_S)
+
+class LazyCollection:
+    """ Stands in for db[name] until first use; `read_heavy` ones use MONGO_READ_HEAVY_PREFERENCE """
+
+    def __init__(self, name, read_heavy=False):
+        self._name = name
+        self._read_heavy = read_heavy
+        self._collection = None
+
+    def _resolve(self):
+        if self._collection is None:
+            collection = get_database()[self._name]
+            if self._read_heavy:
+                collection = collection.with_options(read_preference=read_heavy_preference())
+            self._collection = collection
+        return self._collection
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __repr__(self):
+        return f"LazyCollection({self._name!r}{', read_heavy=True' if self._read_heavy else ''})"
 
 # Collections
-messages_collection = db['messages']
-users_collection = db['users'] 
-conversations_collection = db['conversations'] 
-departments_collection = db['departments']
+messages_collection = LazyCollection('messages')
+users_collection = LazyCollection('users')
+conversations_collection = LazyCollection('conversations')
+departments_collection = LazyCollection('departments')
+# Owned by the chat service (chat/sync.py)
+chat_versions_collection = LazyCollection('chat_versions')
+chat_tombstones_collection = LazyCollection('chat_tombstones')
+chat_presence_collection = LazyCollection('chat_presence')  # chat/presence.py
+
+# Read-heavy endpoints (recent chats, unread totals, the search index) may read these
+# from secondaries; writes and everything in the consumer use the ones above (primary)
+users_read_collection = LazyCollection('users', read_heavy=True)
+conversations_read_collection = LazyCollection('conversations', read_heavy=True)
+departments_read_collection = LazyCollection('departments', read_heavy=True)
 
 # --- FIXED: Handle ALL ObjectId fields ---
 def fix_id(doc):
@@ -19,4 +97,30 @@ def fix_id(doc):
     for key, value in doc.items():
         if isinstance(value, ObjectId):
             doc[key] = str(value)
-    return doc
\ No newline at end of file
+    return doc
+
+# --- CONVERSATION KEY: Same value whichever side starts the chat ---
+def pair_key(user_a, user_b):
+    return ":".join(sorted([str(user_a), str(user_b)]))
+
+# --- ASYNC BRIDGE: Keep blocking pymongo calls off the event loop ---
+_executor = None
+
+def get_mongo_executor():
+    """ Bounded thread pool dedicated to pymongo calls made from async code.
+    Returns None when MONGO_EXECUTOR_WORKERS is 0 (calls then run inline). """
+    global _executor
+    if _executor is None and settings.MONGO_EXECUTOR_WORKERS > 0:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.MONGO_EXECUTOR_WORKERS,
+            thread_name_prefix="mongo"
+        )
+    return _executor
+
+async def run_mongo(func, *args, **kwargs):
+    """ Await a blocking Mongo function without stalling other sockets """
+    executor = get_mongo_executor()
+    if executor is None:
+        return func(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
@@ -1,13 +1,17 @@
-from .mongo_client import users_collection, conversations_collection
-from bson.objectid import ObjectId
+import time
+from django.conf import settings
+from .mongo_client import conversations_collection, pair_key
+from . import directory
+
+SERVER_ERROR = "Server Error checking permissions"
 
 def check_chat_permission(sender_id, receiver_id):
     """
     Returns (Allowed: bool, ErrorMessage: str)
     """
     try:
-        sender = users_collection.find_one({"_id": ObjectId(sender_id)})
-        receiver = users_collection.find_one({"_id": ObjectId(receiver_id)})
+        sender = directory.get_user(sender_id)
+        receiver = directory.get_user(receiver_id)
 
         if not sender or not receiver:
             return False, "User not found"
@@ -19,9 +23,7 @@ def check_chat_permission(sender_id, receiver_id):
         receiver_dept = str(receiver.get('department', ''))
 
         # Check if Conversation exists and is Disabled
-        conversation = conversations_collection.find_one({
-            "participants": {"$all": [sender_id, receiver_id]}
-        })
+        conversation = conversations_collection.find_one({"pair_key": pair_key(sender_id, receiver_id)})
         is_disabled = conversation.get('is_disabled', False) if conversation else False
 
         # --- ROLE BASED LOGIC ---
@@ -56,9 +58,10 @@ def check_chat_permission(sender_id, receiver_id):
                     return True, None
                 return False, "You can only message your own Department Head."
 
-            # Can msg Admin (ONLY if conversation already exists - i.e., replying)
+            # Can msg Admin (ONLY if the Admin already wrote - i.e., replying)
             if receiver_role == 'Admin':
-                if conversation:
+                # A doc toggle_chat created before anyone wrote carries no last_message
+                if conversation and 'last_message' in conversation:
                     return True, None
                 return False, "You cannot start a chat with an Admin. Wait for them to message you."
 
@@ -68,4 +71,41 @@ def check_chat_permission(sender_id, receiver_id):
 
     except Exception as e:
         print(f"Permission Error: {e}")
-        return False, "Server Error checking permissions"
\ No newline at end of file
+        return False, SERVER_ERROR
+
+
+# --- DECISION CACHE: one per socket, so steady-state sends skip the reads above ---
+# Any directory invalidation (role/department change) bumps directory.generation
+# and so makes every cached decision stale
+
+
+class PermissionCache:
+    """
+    check_chat_permission results for one sender, keyed by receiver id.
+    Entries expire after PERMISSION_CACHE_TTL seconds; ChatConsumer drops them
+    early when a chat is toggled or the receiver writes first.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = settings.PERMISSION_CACHE_TTL if ttl is None else ttl
+        self.entries = {}
+
+    def get(self, receiver_id):
+        entry = self.entries.get(receiver_id)
+        if entry is None:
+            return None
+        decision, expires_at, generation = entry
+        if expires_at < time.monotonic() or generation != directory.generation:
+            del self.entries[receiver_id]
+            return None
+        return decision
+
+    def set(self, receiver_id, decision):
+        # Transient failures are retried on the next message
+        if self.ttl > 0 and decision[1] != SERVER_ERROR:
+            self.entries[receiver_id] = (decision, time.monotonic() + self.ttl, directory.generation)
+
+    def invalidate(self, receiver_id, denied_only=False):
+        entry = self.entries.get(receiver_id)
+        if entry is not None and not (denied_only and entry[0][0]):
+            del self.entries[receiver_id]
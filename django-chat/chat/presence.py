@@ -0,0 +1,115 @@
+"""
+Who has an open socket, for online/offline events, the presence API and
+skipping channel-layer sends nobody would receive.
+
+- chat_presence {_id: user id, sockets: {socket: expires_at}, last_seen}
+  is written by ChatConsumer: connect adds the socket, a heartbeat every
+  PRESENCE_HEARTBEAT seconds pushes its expiry PRESENCE_TIMEOUT ahead, and
+  disconnect removes it. A worker that dies stops heartbeating, so its
+  sockets lapse on their own. A user is online while any socket is live.
+- Clients subscribe to the users on their sidebar
+  ({"type": "presence_subscribe", "user_ids": [...]}) and get a "presence"
+  frame with the current state, then one per online/offline transition.
+- `send_to_user` consults the channel layer's own group membership (free,
+  and exact for the in-memory and Unix socket layers) rather than Mongo;
+  for any other layer it always sends.
+"""
+import datetime
+from channels.layers import InMemoryChannelLayer
+from django.conf import settings
+from pymongo import ReturnDocument
+from . import metrics
+from .mongo_client import chat_presence_collection
+
+# Cap on one socket's presence_subscribe list and on one API lookup
+MAX_USERS = 500
+
+
+def _socket_key(channel_name):
+    # Field names can't contain dots
+    return "sockets." + channel_name.replace(".", "_")
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _live(doc, now):
+    for expires_at in ((doc or {}).get("sockets") or {}).values():
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+        if expires_at > now:
+            return True
+    return False
+
+
+# --- REGISTRY (blocking - run via run_mongo) ---
+def connected(user_id, channel_name):
+    """ Register a socket. True if the user was offline until now. """
+    now = _now()
+    before = chat_presence_collection.find_one_and_update(
+        {"_id": user_id},
+        {"$set": {_socket_key(channel_name): now + datetime.timedelta(seconds=settings.PRESENCE_TIMEOUT)}},
+        upsert=True, return_document=ReturnDocument.BEFORE
+    )
+    return not _live(before, now)
+
+
+def heartbeat(user_id, channel_name):
+    chat_presence_collection.update_one(
+        {"_id": user_id},
+        {"$set": {_socket_key(channel_name): _now() + datetime.timedelta(seconds=settings.PRESENCE_TIMEOUT)}}
+    )
+
+
+def disconnected(user_id, channel_name):
+    """ Drop a socket. True if it was the user's last live one. """
+    now = _now()
+    after = chat_presence_collection.find_one_and_update(
+        {"_id": user_id},
+        {"$unset": {_socket_key(channel_name): ""}, "$set": {"last_seen": now}},
+        return_document=ReturnDocument.AFTER
+    )
+    return not _live(after, now)
+
+
+def lookup(user_ids):
+    """ {user id: {"online": bool, "last_seen": iso or None}} in one read """
+    now = _now()
+    docs = {doc["_id"]: doc for doc in chat_presence_collection.find({"_id": {"$in": list(user_ids)}})}
+    result = {}
+    for uid in user_ids:
+        doc = docs.get(uid)
+        last_seen = (doc or {}).get("last_seen")
+        if last_seen is not None and last_seen.tzinfo is None:
+            last_seen = last_seen.replace(tzinfo=datetime.timezone.utc)
+        result[uid] = {"online": _live(doc, now), "last_seen": last_seen.isoformat() if last_seen else None}
+    return result
+
+
+# --- FAN-OUT ---
+def has_members(layer, group):
+    """ False only when the layer knows no socket is in `group` """
+    if hasattr(layer, "has_members"):
+        return layer.has_members(group)
+    if type(layer) is InMemoryChannelLayer:
+        return bool(layer.groups.get(group))
+    return True
+
+
+async def send_to_user(layer, user_id, event):
+    """ group_send to user_<id>, skipped when that user has no socket """
+    group = f"user_{user_id}"
+    if not has_members(layer, group):
+        metrics.fanout_skipped.inc(event.get("type", ""))
+        return
+    await layer.group_send(group, event)
+
+
+async def announce(layer, user_id, online):
+    group = f"presence_{user_id}"
+    if has_members(layer, group):
+        await layer.group_send(group, {
+            "type": "chat_presence",
+            "users": {user_id: {"online": online, "last_seen": None if online else _now().isoformat()}}
+        })
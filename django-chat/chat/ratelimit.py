@@ -0,0 +1,67 @@
+"""
+Token buckets for inbound WebSocket frames (ChatConsumer.receive).
+
+- Every socket has its own bucket, charged for every frame before it is
+  even parsed (WS_SOCKET_RATE / WS_SOCKET_BURST).
+- Chat messages - the frames that cost a Mongo insert and a fan-out - are
+  also charged to a bucket per user, shared by all of that user's sockets
+  in this worker (WS_USER_RATE / WS_USER_BURST). Opening more tabs doesn't
+  buy more throughput.
+
+User buckets live in a TTLCache of RATE_LIMIT_USERS entries. An entry
+expires once its bucket would have refilled, so dropping it loses nothing,
+and the least recently active users are evicted first when the cache is
+full. Limits are per worker; a user spread over N workers gets N buckets.
+"""
+import time
+from django.conf import settings
+from .directory import TTLCache
+
+# retry_after for frames turned away because the socket's inbound queue is full
+BUSY_RETRY_AFTER = 1.0
+
+
+class TokenBucket:
+    """ `rate` tokens per second, at most `burst` saved up. Not thread-safe: one event loop. """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def take(self):
+        """ Spend one token. 0 when allowed, otherwise seconds until one is available. """
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def refill_time(self):
+        """ Seconds until an empty bucket is full again """
+        return self.burst / self.rate
+
+
+user_buckets = TTLCache(settings.RATE_LIMIT_USERS, 0)
+
+
+def socket_bucket():
+    return TokenBucket(settings.WS_SOCKET_RATE, settings.WS_SOCKET_BURST)
+
+
+def take_user(user_id):
+    """ Charge one chat message to `user_id`; 0 or seconds to wait, as TokenBucket.take """
+    if settings.WS_USER_RATE <= 0:
+        return 0
+    bucket = user_buckets.get(user_id)
+    if bucket is None:
+        bucket = TokenBucket(settings.WS_USER_RATE, settings.WS_USER_BURST)
+    retry_after = bucket.take()
+    # Touch on every use: the entry outlives the bucket's last spend by a full refill
+    user_buckets.set(user_id, bucket, ttl=bucket.refill_time())
+    return retry_after
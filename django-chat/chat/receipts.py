@@ -0,0 +1,79 @@
+"""
+Read state as a per-participant watermark on the conversation:
+
+    last_read_at.<user_id>   timestamp of the newest message the user has read
+    last_read_id.<user_id>   its id (sent back to the sender as a read receipt)
+
+A message is unread for its receiver while it is newer than both the
+receiver's last_read_at and cleared_at. Advancing the watermark is one
+conditional update on the conversation instead of an update_many over
+every message.
+"""
+import datetime
+from bson.objectid import ObjectId
+from . import sync
+from .mongo_client import messages_collection, conversations_collection, pair_key
+
+
+def mark_read(reader_id, other_id, message_id=None):
+    """
+    Advance reader_id's watermark to message_id (default: newest message from
+    other_id). Blocking. Returns a receipt dict, or None when nothing moved.
+    """
+    message_filter = {"sender_id": other_id, "receiver_id": reader_id}
+    if message_id:
+        if not ObjectId.is_valid(str(message_id)):
+            return None
+        msg = messages_collection.find_one(dict(message_filter, _id=ObjectId(message_id)), {"timestamp": 1})
+    else:
+        msg = messages_collection.find_one(message_filter, {"timestamp": 1}, sort=[("timestamp", -1), ("_id", -1)])
+    if not msg:
+        return None
+
+    key = pair_key(reader_id, other_id)
+    conv = conversations_collection.find_one(
+        {"pair_key": key}, {"last_read_at": 1, "cleared_at": 1, "unread_counts": 1}
+    )
+    if not conv:
+        return None
+    previous = (conv.get('last_read_at') or {}).get(reader_id)
+    if previous and previous >= msg['timestamp']:
+        return None
+
+    # Messages this read covers that were still counted as unread
+    floor = max(filter(None, [previous, (conv.get('cleared_at') or {}).get(reader_id)]), default=None)
+    newly_read = {**message_filter, "is_read": False, "timestamp": {"$lte": msg['timestamp']}}
+    if floor:
+        newly_read["timestamp"]["$gt"] = floor
+    covered = messages_collection.count_documents(newly_read)
+
+    update = {"$set": {
+        f"last_read_at.{reader_id}": msg['timestamp'],
+        f"last_read_id.{reader_id}": str(msg['_id']),
+        "changed_at": datetime.datetime.now(datetime.timezone.utc)
+    }}
+    if covered:
+        # Always $inc, never $set: messages arriving since we read `conv` stay counted
+        update["$inc"] = {f"unread_counts.{reader_id}": -covered}
+
+    # Compare-and-set on the old watermark: a concurrent read never moves it backwards
+    result = conversations_collection.update_one(
+        {"_id": conv["_id"], f"last_read_at.{reader_id}": previous},
+        update
+    )
+    if not result.modified_count:
+        return None
+    if covered > (conv.get('unread_counts') or {}).get(reader_id, 0):
+        # The counter had drifted low (reconcile_unread repairs that); don't leave it negative
+        conversations_collection.update_one({"_id": conv["_id"]}, {"$max": {f"unread_counts.{reader_id}": 0}})
+    # Unread badge for the reader, receipt ticks for the sender
+    sync.bump(reader_id, other_id)
+
+    ts = msg['timestamp']
+    if ts.tzinfo is None: ts = ts.replace(tzinfo=datetime.timezone.utc)
+    return {
+        "reader_id": reader_id,
+        "participants": [reader_id, other_id],
+        "last_read_id": str(msg['_id']),
+        "last_read_at": ts.isoformat()
+    }
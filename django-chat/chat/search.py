@@ -0,0 +1,227 @@
+"""
+In-memory index behind search_users (USER_SEARCH_INDEX=True).
+
+Every user is reduced to lowercase tokens: each of firstName, lastName and
+employeeId as a whole plus its alphanumeric runs ("EMP-1042" gives
+"emp-1042", "emp" and "1042"). A query matches a user when each of its
+words is a prefix of one of the user's tokens.
+
+Tokens are kept in sorted (token, user id) lists, one per visibility
+bucket: Admins, and Employees / Department Heads per department. A
+search only walks the buckets the caller may see, so the role/department
+rules are applied by construction and a lookup is a bisect plus at most
+`limit` matches.
+
+The index is loaded on the first search and rebuilt in the background
+every USER_SEARCH_REFRESH seconds (full reads go to MONGO_READ_HEAVY_PREFERENCE). Single users are refreshed through the
+directory invalidation hooks (POST directory/invalidate, or the change
+stream when DIRECTORY_WATCH_CHANGES is on).
+"""
+import bisect
+import heapq
+import re
+import threading
+import time
+from bson.objectid import ObjectId
+from django.conf import settings
+from . import directory
+from .mongo_client import users_collection, departments_collection, users_read_collection, departments_read_collection, fix_id
+
+SEARCH_PROJECTION = {"firstName": 1, "lastName": 1, "role": 1, "profilePhoto": 1, "email": 1, "department": 1, "employeeId": 1}
+_WORD = re.compile(r"[^\W_]+")
+
+
+def user_tokens(doc):
+    tokens = set()
+    for field in ("firstName", "lastName", "employeeId"):
+        value = str(doc.get(field) or "").lower().strip()
+        if value:
+            tokens.add(value)
+            tokens.update(_WORD.findall(value))
+    return tokens
+
+
+def user_bucket(doc):
+    role = doc.get('role')
+    dept = str(doc.get('department') or "")
+    if role == 'Admin':
+        return ('Admin',)
+    if role in ('Employee', 'employee'):
+        return ('Employee', dept)
+    if role == 'Department Head':
+        return ('Department Head', dept)
+    return ('Other',)
+
+
+def visible_buckets(user):
+    """ Buckets `user` may search, or None for all of them (Admin) """
+    role = user.get('role', 'Employee')
+    dept = str(user.get('department') or "")
+    if role == 'Admin':
+        return None
+    if role == 'Department Head':
+        # Head can search: Admins OR their own Employees
+        return [('Admin',), ('Employee', dept)]
+    # Employee can search: Admins OR their Department Heads
+    return [('Admin',), ('Department Head', dept)]
+
+
+def _prefix_count(entries, prefix):
+    return bisect.bisect_left(entries, (prefix + "\U0010ffff",)) - bisect.bisect_left(entries, (prefix,))
+
+
+def _prefix_range(entries, prefix):
+    i = bisect.bisect_left(entries, (prefix,))
+    while i < len(entries) and entries[i][0].startswith(prefix):
+        yield entries[i]
+        i += 1
+
+
+class UserSearchIndex:
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {}         # user id -> (doc, bucket, tokens)
+        self.buckets = {}       # bucket -> sorted [(token, user id)]
+        self.departments = {}   # department id -> name
+        self.built_at = None
+        self.building = False
+        self.changed_while_building = set()
+
+    # --- Loading ---
+
+    def clear(self):
+        """ Forget everything; the next search loads from scratch """
+        with self.lock:
+            self.users, self.buckets, self.departments = {}, {}, {}
+            self.built_at = None
+
+    def build(self):
+        """ Load every user and department. Blocking - a full collection read. """
+        with self.lock:
+            self.building = True
+            self.changed_while_building = set()
+        try:
+            users = {}
+            buckets = {}
+            for doc in users_read_collection.find({}, SEARCH_PROJECTION):
+                uid = str(doc["_id"])
+                entry = (doc, user_bucket(doc), user_tokens(doc))
+                users[uid] = entry
+                buckets.setdefault(entry[1], []).extend((token, uid) for token in entry[2])
+            for entries in buckets.values():
+                entries.sort()
+            departments = {str(d["_id"]): d.get('name', '') for d in departments_read_collection.find({}, {"name": 1})}
+
+            with self.lock:
+                self.users, self.buckets, self.departments = users, buckets, departments
+                self.built_at = time.monotonic()
+                changed, self.changed_while_building = self.changed_while_building, set()
+        finally:
+            with self.lock:
+                self.building = False
+        # Edits that raced with the full read
+        for uid in changed:
+            self.refresh_user(uid)
+
+    def ensure_fresh(self):
+        if self.built_at is None:
+            with self.lock:
+                if self.built_at is None:
+                    self.build()
+            return
+        if not self.building and time.monotonic() - self.built_at > settings.USER_SEARCH_REFRESH:
+            with self.lock:
+                if self.building:
+                    return
+                self.building = True
+            threading.Thread(target=self.build, name="user-search-rebuild", daemon=True).start()
+
+    # --- Incremental updates ---
+
+    def refresh_user(self, user_id):
+        if self.built_at is None and not self.building:
+            return
+        doc = users_collection.find_one({"_id": ObjectId(user_id)}, SEARCH_PROJECTION) if ObjectId.is_valid(user_id) else None
+        with self.lock:
+            if self.building:
+                self.changed_while_building.add(user_id)
+            self._remove(user_id)
+            if doc:
+                entry = (doc, user_bucket(doc), user_tokens(doc))
+                self.users[user_id] = entry
+                entries = self.buckets.setdefault(entry[1], [])
+                for token in entry[2]:
+                    bisect.insort(entries, (token, user_id))
+
+    def _remove(self, user_id):
+        entry = self.users.pop(user_id, None)
+        if entry is None:
+            return
+        entries = self.buckets.get(entry[1], [])
+        for token in entry[2]:
+            i = bisect.bisect_left(entries, (token, user_id))
+            if i < len(entries) and entries[i] == (token, user_id):
+                del entries[i]
+
+    def refresh_department(self, dept_id):
+        if self.built_at is None:
+            return
+        dept_doc = departments_collection.find_one({"_id": ObjectId(dept_id)}, {"name": 1}) if ObjectId.is_valid(dept_id) else None
+        with self.lock:
+            if dept_doc:
+                self.departments[dept_id] = dept_doc.get('name', '')
+            else:
+                self.departments.pop(dept_id, None)
+
+    # --- Querying ---
+
+    def search(self, user, query, exclude_id=None, limit=10):
+        """ Up to `limit` users visible to `user` matching every word of `query`, in token order """
+        terms = _WORD.findall(query.lower())
+        if not terms:
+            return []
+        self.ensure_fresh()
+
+        results = []
+        with self.lock:
+            allowed = visible_buckets(user)
+            names = list(self.buckets) if allowed is None else [b for b in allowed if b in self.buckets]
+            # Walk the rarest word ("emp-42" -> "42", not "emp"); check the rest per user
+            lead = min(terms, key=lambda term: sum(_prefix_count(self.buckets[b], term) for b in names))
+            seen = {str(exclude_id)}
+            for _, uid in heapq.merge(*(_prefix_range(self.buckets[b], lead) for b in names)):
+                if uid in seen:
+                    continue
+                seen.add(uid)
+                doc, _, tokens = self.users[uid]
+                if all(any(token.startswith(term) for token in tokens) for term in terms):
+                    results.append(dict(doc))
+                    if len(results) >= limit:
+                        break
+            departments = self.departments
+
+        for doc in results:
+            dept_id = doc.get('department')
+            if not dept_id:
+                doc['department_name'] = ""
+            elif str(dept_id) in departments:
+                doc['department_name'] = departments[str(dept_id)]
+            else:
+                doc['department_name'] = directory.get_department_name(dept_id)
+            fix_id(doc)
+        return results
+
+    def stats(self):
+        with self.lock:
+            return {
+                "users": len(self.users),
+                "tokens": sum(len(entries) for entries in self.buckets.values()),
+                "buckets": len(self.buckets),
+                "age": None if self.built_at is None else round(time.monotonic() - self.built_at, 1),
+            }
+
+
+user_index = UserSearchIndex()
+directory.user_listeners.append(user_index.refresh_user)
+directory.department_listeners.append(user_index.refresh_department)
@@ -0,0 +1,180 @@
+"""
+Delta sync for the endpoints the frontend polls (recent, history, unread/total).
+
+- chat_versions {_id: user id, version: n} is bumped by every write that
+  changes what that user sees: new messages (consumer / write-behind),
+  reads, toggle_chat, delete_conversation and manage_message. The version
+  goes into a strong ETag, so a poll with a matching If-None-Match gets a
+  304 after one find_one on chat_versions.
+- `?since=<iso>` asks for what changed after a previous response's `sync`
+  value: conversations by `changed_at`, messages by timestamp/`edited_at`,
+  and deletions from chat_tombstones (kept SYNC_TOMBSTONE_DAYS).
+- Each bump also records `bumped_at`; `secondary_safe` uses it to decide
+  whether a read-heavy endpoint may answer from a secondary.
+- `missed_since` is the same delta across all of a user's conversations,
+  replayed to a reconnecting WebSocket (ws/chat/?since= or ?last_id=).
+"""
+import datetime
+import time
+import zlib
+from collections import Counter
+from bson.objectid import ObjectId
+from django.conf import settings
+from pymongo import UpdateOne
+from . import directory
+from .mongo_client import messages_collection, conversations_collection, chat_versions_collection, chat_tombstones_collection, pair_key, reads_from_primary
+
+# `sync` cursors step back this far so writes still in flight when we read are picked up next time
+SYNC_OVERLAP = datetime.timedelta(seconds=5)
+# pymongo's staleness estimate can be off by up to one server heartbeat
+HEARTBEAT_MARGIN = datetime.timedelta(seconds=10)
+
+
+def bump(*user_ids):
+    """ +1 on each user's version (repeat an id to add more). Blocking, one round-trip. """
+    counts = Counter(str(uid) for uid in user_ids if uid)
+    if counts:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        chat_versions_collection.bulk_write([
+            UpdateOne({"_id": uid}, {"$inc": {"version": n}, "$set": {"bumped_at": now}}, upsert=True)
+            for uid, n in counts.items()
+        ], ordered=False)
+
+
+def read_version(user_id):
+    """ (version, bumped_at or None) from the primary """
+    doc = chat_versions_collection.find_one({"_id": str(user_id)})
+    return (doc["version"], doc.get("bumped_at")) if doc else (0, None)
+
+
+def get_version(user_id):
+    return read_version(user_id)[0]
+
+
+def secondary_safe(bumped_at):
+    """ True when any secondary we may read from (MONGO_MAX_STALENESS_S) already has the user's
+    last change, so a response read there matches the version in its ETag """
+    if reads_from_primary():
+        return False
+    if bumped_at is None:
+        return True
+    if bumped_at.tzinfo is None:
+        bumped_at = bumped_at.replace(tzinfo=datetime.timezone.utc)
+    window = datetime.timedelta(seconds=settings.MONGO_MAX_STALENESS_S) + HEARTBEAT_MARGIN
+    return datetime.datetime.now(datetime.timezone.utc) - bumped_at > window
+
+
+def make_etag(request, user_id, version, with_directory=False):
+    """ Strong ETag for `user_id` at `version`; distinct per query string """
+    tag = f"{user_id}.{version}"
+    if with_directory:
+        tag += f".{directory_marker()}"
+    query = request.META.get('QUERY_STRING', '')
+    return f'"{tag}.{zlib.crc32(query.encode()):08x}"'
+
+
+def directory_marker():
+    """
+    ETag part for what the sidebar takes from the users/departments collections
+    (names, departments, auto-populated department members). None of that bumps
+    a version, and directory.generation only moves on this process's own
+    invalidations, so the wall-clock DIRECTORY_CACHE_TTL window is folded in
+    too: a cached sidebar is never staler than the directory cache itself.
+    """
+    ttl = settings.DIRECTORY_CACHE_TTL
+    window = int(time.time() // ttl) if ttl > 0 else time.time_ns()
+    return f"{window}-{directory.generation}"
+
+
+def is_fresh(request, etag):
+    """ True when If-None-Match already names `etag` """
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    return header.strip() == '*' or etag in [t.strip() for t in header.split(',')]
+
+
+def cache_headers(etag):
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def parse_since(value):
+    try:
+        ts = datetime.datetime.fromisoformat(value.replace(' ', '+'))
+    except ValueError:
+        raise ValueError("since must be an ISO timestamp (the `sync` value of a previous response)")
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=datetime.timezone.utc)
+    return ts
+
+
+def sync_cursor(started_at):
+    return (started_at - SYNC_OVERLAP).isoformat()
+
+
+def record_deleted(message, pair, deleted_at):
+    """ Tombstone so `since` queries can report the deletion """
+    chat_tombstones_collection.update_one(
+        {"_id": message["_id"]},
+        {"$set": {"pair_key": pair, "deleted_at": deleted_at,
+                  "sender_id": message["sender_id"], "receiver_id": message["receiver_id"]}},
+        upsert=True
+    )
+
+
+def deleted_since(pair, since):
+    return [str(t["_id"]) for t in chat_tombstones_collection.find(
+        {"pair_key": pair, "deleted_at": {"$gt": since}}, {"_id": 1})]
+
+
+def since_last_id(message_id):
+    """ Replay start for a last-seen message id: its ObjectId time, no lookup needed """
+    if not ObjectId.is_valid(message_id):
+        raise ValueError("last_id must be a message id")
+    return ObjectId(message_id).generation_time - SYNC_OVERLAP
+
+
+def missed_since(user_id, since, limit):
+    """ Everything `user_id` missed after `since`, across all conversations. Blocking, three reads.
+    Returns (messages, deleted tombstones, {other user: cleared_at} for clears after `since`, truncated). """
+    messages = list(messages_collection.find({"$or": [
+        {"sender_id": user_id, "timestamp": {"$gt": since}},
+        {"receiver_id": user_id, "timestamp": {"$gt": since}},
+        {"sender_id": user_id, "edited_at": {"$gt": since}},
+        {"receiver_id": user_id, "edited_at": {"$gt": since}},
+    ]}).sort([("timestamp", 1), ("_id", 1)]).limit(limit + 1))
+    # Older than the tombstones we keep: deletions may be missing, the client should reload
+    truncated = len(messages) > limit or \
+        since < datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=settings.SYNC_TOMBSTONE_DAYS)
+    messages = messages[:limit]
+
+    deleted = list(chat_tombstones_collection.find(
+        {"deleted_at": {"$gt": since}, "$or": [{"sender_id": user_id}, {"receiver_id": user_id}]}))
+
+    # Every watermark that can hide a replayed message (an edit may be newer than an old clear),
+    # plus clears made on another device since `since`, which this one has to apply too
+    pairs = list({pair_key(m['sender_id'], m['receiver_id']) for m in messages})
+    watermarks, cleared = {}, {}
+    for conv in conversations_collection.find({"$or": [
+        {"pair_key": {"$in": pairs}, f"cleared_at.{user_id}": {"$exists": True}},
+        {"participants": user_id, f"cleared_at.{user_id}": {"$gt": since}},
+    ]}, {"participants": 1, "cleared_at": 1}):
+        other_id = conv['participants'][0] if conv['participants'][0] != user_id else conv['participants'][1]
+        cleared_at = _aware(conv['cleared_at'][user_id])
+        watermarks[other_id] = cleared_at
+        if cleared_at > since:
+            cleared[other_id] = cleared_at
+    if watermarks:
+        messages = [m for m in messages if not _hidden(m, user_id, watermarks)]
+    return messages, deleted, cleared, truncated
+
+
+def _aware(ts):
+    return ts.replace(tzinfo=datetime.timezone.utc) if ts.tzinfo is None else ts
+
+
+def _hidden(message, user_id, watermarks):
+    """ True when the reader cleared the conversation after this message was sent """
+    other_id = message['receiver_id'] if message['sender_id'] == user_id else message['sender_id']
+    cleared_at = watermarks.get(other_id)
+    return cleared_at is not None and _aware(message['timestamp']) <= cleared_at
@@ -0,0 +1,168 @@
+"""
+Helpers for running the chat app against a throwaway Mongo database
+(a mongomock stand-in or a scratch database on a local mongod).
+Used by the benchmark command; not imported by the app itself.
+"""
+import importlib
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from contextlib import contextmanager
+from pymongo import monitoring
+
+COLLECTION_NAMES = ['messages', 'users', 'conversations', 'departments', 'chat_versions', 'chat_tombstones', 'chat_presence']
+
+# Modules holding collection bindings, imported before rebinding so none is missed
+# (management commands are otherwise only loaded by call_command)
+CHAT_MODULES = [
+    'chat.async_views', 'chat.consumers', 'chat.directory', 'chat.indexes', 'chat.permissions',
+    'chat.presence', 'chat.receipts', 'chat.search', 'chat.sync', 'chat.views', 'chat.writebehind',
+    'chat.management.commands.migrate_cleared_at', 'chat.management.commands.migrate_pair_keys',
+    'chat.management.commands.reconcile_unread',
+]
+
+
+def standin_database(name='chat_bench'):
+    """ In-process Mongo stand-in. Needs mongomock (requirements-test.txt). """
+    try:
+        import mongomock
+    except ImportError:
+        raise RuntimeError("mongomock is required for the in-process stand-in (pip install -r requirements-test.txt)")
+    return mongomock.MongoClient()[name]
+
+
+class OpCounter:
+    """ Thread-safe tally of Mongo operations by (collection, operation) """
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, collection, op):
+        with self._lock:
+            self._counts[(collection, op)] += 1
+
+    def total(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+class CommandCounter(OpCounter, monitoring.CommandListener):
+    """
+    OpCounter fed by pymongo command monitoring, for a real mongod:
+    MongoClient(uri, event_listeners=[counter]). Counts every command sent,
+    including getMore, but not driver housekeeping (ping, endSessions...).
+    """
+
+    # Driver housekeeping, not queries the app asked for
+    IGNORED = {"hello", "ismaster", "isMaster", "ping", "endSessions", "killCursors", "buildInfo"}
+
+    def started(self, event):
+        if event.command_name in self.IGNORED:
+            return
+        # getMore carries the cursor id under its name and the collection separately
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        self.record(collection if isinstance(collection, str) else None, event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class SlowCollection:
+    """
+    Wraps a collection and sleeps `latency` seconds on every call, to model the
+    network round-trip a real mongod adds. The sleep is blocking on purpose:
+    that is exactly what pymongo does to whoever calls it. With a `counter`,
+    every call is also recorded as one operation.
+    """
+    def __init__(self, collection, latency, counter=None):
+        self._collection = collection
+        self._latency = latency
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            if self._counter is not None:
+                self._counter.record(self._collection.name, name)
+            if self._latency:
+                time.sleep(self._latency)
+            return attr(*args, **kwargs)
+        return call
+
+
+@contextmanager
+def mongo_budget(counter, max_ops, label="block"):
+    """
+    Fail with AssertionError when the block issues more than `max_ops` Mongo
+    operations. Yields a dict that holds the breakdown afterwards.
+    """
+    before = counter.snapshot()
+    usage = {}
+    yield usage
+    after = counter.snapshot()
+    usage.update({key: n - before.get(key, 0) for key, n in after.items() if n - before.get(key, 0)})
+    used = sum(usage.values())
+    if used > max_ops:
+        breakdown = ", ".join(f"{coll}.{op} x{n}" for (coll, op), n in sorted(usage.items(), key=str))
+        raise AssertionError(f"{label} used {used} Mongo operations, budget is {max_ops}: {breakdown}")
+
+
+@contextmanager
+def use_mongo_database(db, latency=0, counter=None):
+    """
+    Point every chat module at `db` for the duration of the block.
+    Modules import collections by name, so each binding is swapped in place.
+    A `counter` records each collection call (for a real mongod, pass a
+    CommandCounter to the MongoClient instead).
+    """
+    collections = {}
+    for name in COLLECTION_NAMES:
+        coll = db[name]
+        wrap = latency or counter is not None
+        collections[f"{name}_collection"] = SlowCollection(coll, latency, counter) if wrap else coll
+
+    # Read-heavy variants (chat/mongo_client.py) go to the same stand-in
+    for name in COLLECTION_NAMES:
+        collections[f"{name}_read_collection"] = collections[f"{name}_collection"]
+
+    for mod_name in CHAT_MODULES:
+        importlib.import_module(mod_name)
+    saved = []
+    for mod_name, module in list(sys.modules.items()):
+        if not mod_name.startswith('chat.') or module is None:
+            continue
+        for attr, coll in collections.items():
+            if hasattr(module, attr):
+                saved.append((module, attr, getattr(module, attr)))
+                setattr(module, attr, coll)
+    try:
+        yield db
+    finally:
+        for module, attr, original in reversed(saved):
+            setattr(module, attr, original)
+
+
+def chat_urlconf(async_views):
+    """ A ROOT_URLCONF serving /api/chat/ with the sync or async views, whatever ASYNC_VIEWS says """
+    from django.urls import include, path
+    from . import urls
+    module = types.ModuleType(f"chat_urlconf_{'async' if async_views else 'sync'}")
+    module.urlpatterns = [path('api/chat/', include(urls.async_urlpatterns if async_views else urls.sync_urlpatterns))]
+    return module
@@ -1,3 +1,1446 @@
-from django.test import TestCase
+"""
+Chat app tests, one TestCase per feature, all on a throwaway Mongo database.
 
-# Create your tests here.
+QueryBudgetTests holds the query budgets: the most Mongo operations each
+endpoint and each consumer message may issue. A budget that fails usually
+means a find_one crept into a loop - batch it instead of raising the number.
+
+Runs against the in-process stand-in (mongomock, from requirements-test.txt),
+counting calls through the collection proxy. Set CHAT_TEST_MONGO_URI to run
+against a scratch database on a real mongod instead, counted with pymongo
+command monitoring.
+"""
+import asyncio
+import datetime
+import gc
+import importlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+import unittest
+from unittest import mock
+
+import jwt
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.core.management import CommandError, call_command
+from django.http import Http404
+from django.test import AsyncClient, Client, SimpleTestCase, override_settings
+from pymongo import MongoClient
+
+from . import auth, consumers, directory, frames, indexes, metrics, permissions, presence, ratelimit, receipts, search, writebehind
+from .layers import UnixSocketChannelLayer
+from .management.commands import migrate_cleared_at
+from .middleware import JWTAuthMiddleware
+from .routing import websocket_urlpatterns
+from .testing import CommandCounter, OpCounter, chat_urlconf, mongo_budget, standin_database, use_mongo_database
+
+TEST_MONGO_URI = os.getenv('CHAT_TEST_MONGO_URI')
+
+# --- BUDGETS: Mongo operations per call, cold directory cache ---
+BUDGETS = {
+    'get_recent_chats': 4,          # version, conversations, me, partners + auto-populated users in one aggregate
+    'get_chat_history': 8,          # version, conversation, mark_read (5), page
+    'get_chat_history_paged': 8,
+    'get_chat_history_since': 9,    # as above, plus tombstones
+    'search_users': 3,              # me, then users + departments to load the index once
+    'get_total_unread': 2,          # version, one aggregate
+    'not_modified': 1,              # If-None-Match hit: the version read only
+    'toggle_chat': 4,               # both users, one upsert, version bump
+    'delete_conversation': 2,       # update, version bump
+    'consumer_message': 5,          # receiver, conversation, insert, conversation upsert, version bump
+    'consumer_message_repeat': 3,   # insert + conversation upsert + version bump; permission decision cached
+    'consumer_reconnect': 2,        # presence in and out; token and user both cached by the first connect
+    'consumer_replay': 5,           # as above, plus messages/edits, tombstones, cleared conversations
+    'get_presence': 1,
+}
+
+
+def token_for(user_id):
+    return jwt.encode({"userId": str(user_id)}, settings.SECRET_KEY, algorithm="HS256")
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+async def receive_json(comm):
+    return json.loads(await comm.receive_from(timeout=5))
+
+
+async def receive_all(comm):
+    """ Every JSON frame the socket sends until it goes quiet """
+    received = []
+    while not await comm.receive_nothing(timeout=0.2):
+        received.append(json.loads(await comm.receive_from()))
+    return received
+
+
+async def eventually(condition, timeout=2):
+    """ Wait for `condition()` to hold, e.g. for frames between two layers to land """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        await asyncio.sleep(0.01)
+
+
+class ChatTestCase(SimpleTestCase):
+    """ Points the chat app at a fresh database, with every in-process cache cleared """
+
+    def setUp(self):
+        name = f"chat_test_{os.getpid()}"
+        if TEST_MONGO_URI:
+            self.counter = CommandCounter()
+            mongo = MongoClient(TEST_MONGO_URI, event_listeners=[self.counter])
+            mongo.drop_database(name)
+            self.addCleanup(mongo.drop_database, name)
+            self.db = mongo[name]
+            patch = use_mongo_database(self.db)
+        else:
+            self.counter = OpCounter()
+            self.db = standin_database(name)
+            patch = use_mongo_database(self.db, counter=self.counter)
+        patch.__enter__()
+        self.addCleanup(patch.__exit__, None, None, None)
+        directory.clear()
+        auth.token_cache.clear()
+        search.user_index.clear()
+        ratelimit.user_buckets.clear()
+        channel_layers.backends.clear()
+
+    # --- Fixtures ---
+
+    def seed(self, partners):
+        """ One department, an Admin "me", a Department Head, and `partners` employees
+        who each exchanged a few messages with me """
+        self.dept_id = self.db['departments'].insert_one({"name": "Engineering"}).inserted_id
+        self.me = str(self.db['users'].insert_one(
+            {"firstName": "Ada", "lastName": "Admin", "employeeId": "EMP-1", "role": "Admin"}).inserted_id)
+        self.head = str(self.db['users'].insert_one(
+            {"firstName": "Hal", "lastName": "Head", "employeeId": "EMP-2", "role": "Department Head",
+             "department": self.dept_id}).inserted_id)
+        self.partners = []
+        self.add_partners(partners)
+
+    def add_partners(self, count):
+        start = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+        for _ in range(count):
+            i = len(self.partners)
+            partner = str(self.db['users'].insert_one({
+                "firstName": f"Emp{i}", "lastName": "Loyee", "employeeId": f"EMP-{100 + i}",
+                "role": "Employee", "department": self.dept_id,
+            }).inserted_id)
+            self.partners.append(partner)
+            for n in range(3):
+                sender, receiver = (partner, self.me) if n % 2 == 0 else (self.me, partner)
+                consumers.save_message(sender, receiver, f"hello {n}", start + datetime.timedelta(minutes=i * 10 + n))
+        directory.clear()
+
+    def api(self, user_id=None, **headers):
+        return Client(HTTP_AUTHORIZATION=f"Bearer {token_for(user_id or self.me)}", **headers)
+
+    def get(self, path, params=None, user_id=None):
+        return self.api(user_id).get(path, params or {})
+
+    def command(self, name, *args):
+        """ Run a management command; returns what it wrote """
+        out = io.StringIO()
+        call_command(name, *args, stdout=out)
+        return out.getvalue()
+
+    def socket(self, user_id, query="", **kwargs):
+        """ A WebsocketCommunicator on ws/chat/ for `user_id`, not yet connected """
+        application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        path = f"/ws/chat/?token={token_for(user_id)}" + (f"&{query}" if query else "")
+        return WebsocketCommunicator(application, path, **kwargs)
+
+
+class QueryBudgetTests(ChatTestCase):
+
+    def assertBudget(self, label, call):
+        with mongo_budget(self.counter, BUDGETS[label], label):
+            response = call()
+        self.assertLess(response.status_code, 400, getattr(response, 'data', response))
+        return response
+
+    # --- REST ---
+
+    def test_recent_chats_budget_is_flat_in_conversation_count(self):
+        self.seed(partners=3)
+        with mongo_budget(self.counter, BUDGETS['get_recent_chats'], 'get_recent_chats') as small:
+            response = self.get(f"/api/chat/recent/{self.me}")
+        self.assertEqual(len([u for u in response.data if u.get('last_message')]), 3)
+
+        self.add_partners(27)
+        with mongo_budget(self.counter, BUDGETS['get_recent_chats'], 'get_recent_chats') as large:
+            response = self.get(f"/api/chat/recent/{self.me}")
+        self.assertEqual(len([u for u in response.data if u.get('last_message')]), 30)
+        self.assertEqual(sum(small.values()), sum(large.values()))
+
+    def test_chat_history_budget(self):
+        self.seed(partners=2)
+        self.assertBudget('get_chat_history', lambda: self.get(
+            f"/api/chat/history/{self.me}", {"other_user": self.partners[0]}))
+
+    def test_chat_history_page_budget(self):
+        self.seed(partners=2)
+        response = self.assertBudget('get_chat_history_paged', lambda: self.get(
+            f"/api/chat/history/{self.me}", {"other_user": self.partners[0], "limit": 2}))
+        self.assertTrue(response.data["has_more"])
+
+    def test_chat_history_since_budget(self):
+        self.seed(partners=2)
+        since = (now() - datetime.timedelta(seconds=1)).isoformat()
+        self.assertBudget('get_chat_history_since', lambda: self.get(
+            f"/api/chat/history/{self.me}", {"other_user": self.partners[0], "since": since}))
+
+    def test_search_budget_does_not_grow_with_hits(self):
+        self.seed(partners=20)
+        response = self.assertBudget('search_users', lambda: self.get(
+            "/api/chat/search", {"q": "emp", "user_id": self.me}))
+        self.assertEqual(len(response.data), 10)
+        # Warm index: only the caller's directory lookup (cached) remains
+        with mongo_budget(self.counter, 0, 'search_users (warm)'):
+            self.get("/api/chat/search", {"q": "loyee", "user_id": self.me})
+
+    def test_total_unread_budget(self):
+        self.seed(partners=5)
+        response = self.assertBudget('get_total_unread', lambda: self.get(f"/api/chat/unread/total/{self.me}"))
+        self.assertEqual(response.data["count"], 10)
+
+    def test_unchanged_poll_is_not_modified(self):
+        self.seed(partners=3)
+        for path, params in ((f"/api/chat/recent/{self.me}", {}),
+                             (f"/api/chat/history/{self.me}", {"other_user": self.partners[0]}),
+                             (f"/api/chat/unread/total/{self.me}", {})):
+            etag = self.get(path, params)["ETag"]
+            client = self.api(HTTP_IF_NONE_MATCH=etag)
+            with mongo_budget(self.counter, BUDGETS['not_modified'], f"not_modified {path}"):
+                response = client.get(path, params)
+            self.assertEqual(response.status_code, 304, path)
+            self.assertEqual(response["ETag"], etag)
+
+        # A new message changes my version, so the same tag no longer matches
+        etag = self.get(f"/api/chat/unread/total/{self.me}")["ETag"]
+        consumers.save_message(self.partners[1], self.me, "new", now())
+        client = self.api(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(client.get(f"/api/chat/unread/total/{self.me}").status_code, 200)
+
+    def test_toggle_chat_budget(self):
+        self.seed(partners=1)
+        self.assertBudget('toggle_chat', lambda: self.api().post(
+            "/api/chat/toggle", {"admin_id": self.me, "target_user_id": self.partners[0], "action": "disable"},
+            content_type="application/json"))
+
+    def test_delete_conversation_budget(self):
+        self.seed(partners=1)
+        self.assertBudget('delete_conversation', lambda: self.api().delete(
+            f"/api/chat/delete_all?user_id={self.me}&other_user={self.partners[0]}"))
+
+    def test_presence_budget(self):
+        self.seed(partners=1)
+        self.assertBudget('get_presence', lambda: self.get(
+            "/api/chat/presence", {"ids": f"{self.me},{self.partners[0]}"}))
+
+    # --- WebSocket ---
+
+    def test_consumer_message_budget(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+
+        async def exchange():
+            comm = self.socket(self.me)
+            connected, _ = await comm.connect()
+            self.assertTrue(connected)
+            with mongo_budget(self.counter, BUDGETS['consumer_message'], 'consumer_message'):
+                await comm.send_to(text_data=json.dumps({"message": "hi", "receiverId": partner}))
+                echo = await receive_json(comm)
+            await comm.disconnect()
+            return echo
+
+        echo = async_to_sync(exchange)()
+        self.assertEqual(echo["message"], "hi")
+
+    def test_repeat_message_skips_permission_reads(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+
+        async def exchange():
+            comm = self.socket(self.me)
+            await comm.connect()
+            await comm.send_to(text_data=json.dumps({"message": "first", "receiverId": partner}))
+            await comm.receive_from(timeout=5)
+            with mongo_budget(self.counter, BUDGETS['consumer_message_repeat'], 'consumer_message_repeat'):
+                await comm.send_to(text_data=json.dumps({"message": "second", "receiverId": partner}))
+                await comm.receive_from(timeout=5)
+            await comm.disconnect()
+
+        async_to_sync(exchange)()
+
+    def test_reconnect_reuses_verified_token(self):
+        self.seed(partners=1)
+
+        async def connect():
+            comm = self.socket(self.me)
+            connected, _ = await comm.connect()
+            await comm.disconnect()
+            return connected
+
+        with mock.patch('chat.auth.jwt.decode', wraps=auth.jwt.decode) as decode:
+            self.assertTrue(async_to_sync(connect)())
+            with mongo_budget(self.counter, BUDGETS['consumer_reconnect'], 'consumer_reconnect'):
+                self.assertTrue(async_to_sync(connect)())
+            # REST calls with the same token skip verification too
+            self.get(f"/api/chat/unread/total/{self.me}")
+        self.assertEqual(decode.call_count, 1)
+
+
+class PermissionCacheTests(ChatTestCase):
+
+    def test_toggle_chat_invalidates_cached_permission(self):
+        self.seed(partners=1)
+        employee = self.partners[0]
+
+        def toggle(action):
+            return self.api().post("/api/chat/toggle", {"admin_id": self.me, "target_user_id": employee, "action": action},
+                                      content_type="application/json")
+
+        async def exchange():
+            comm = self.socket(employee)
+            await comm.connect()
+            # Employee -> own Department Head is allowed, and now cached
+            await comm.send_to(text_data=json.dumps({"message": "hi boss", "receiverId": self.head}))
+            self.assertEqual((await receive_json(comm))["message"], "hi boss")
+            await comm.send_to(text_data=json.dumps({"message": "hi admin", "receiverId": self.me}))
+            self.assertEqual((await receive_json(comm))["message"], "hi admin")
+
+            await sync_to_async(toggle)("disable")
+            self.assertEqual((await receive_json(comm))["type"], "status_update")
+            await comm.send_to(text_data=json.dumps({"message": "still there?", "receiverId": self.me}))
+            self.assertEqual((await receive_json(comm))["type"], "error")
+            await comm.disconnect()
+
+        async_to_sync(exchange)()
+
+
+class DirectoryInvalidationTests(ChatTestCase):
+
+    def invalidate(self, client):
+        return client.post("/api/chat/directory/invalidate", {"user_id": self.head}, content_type="application/json")
+
+    def cached(self):
+        return directory.user_cache.get(self.head) is not None
+
+    def test_only_admins_and_the_backend_may_invalidate(self):
+        self.seed(partners=1)
+        directory.get_user(self.head)
+
+        self.assertEqual(self.invalidate(self.api(self.partners[0])).status_code, 403)
+        self.assertEqual(self.invalidate(self.api(self.head)).status_code, 403)
+        self.assertEqual(self.invalidate(Client(HTTP_AUTHORIZATION="Bearer backend-secret")).status_code, 401)
+        self.assertTrue(self.cached())
+
+        self.assertEqual(self.invalidate(self.api()).status_code, 200)
+        self.assertFalse(self.cached())
+
+        directory.get_user(self.head)
+        with override_settings(DIRECTORY_SERVICE_TOKEN="backend-secret"):
+            self.assertEqual(self.invalidate(Client(HTTP_AUTHORIZATION="Bearer backend-secret")).status_code, 200)
+        self.assertFalse(self.cached())
+
+
+class ChatPermissionTests(ChatTestCase):
+
+    def test_toggle_does_not_let_an_employee_write_first_to_an_admin(self):
+        self.seed(partners=0)
+        employee = str(self.db['users'].insert_one(
+            {"firstName": "New", "lastName": "Hire", "role": "Employee", "department": self.dept_id}).inserted_id)
+        response = self.api().post("/api/chat/toggle", {"admin_id": self.me, "target_user_id": employee, "action": "enable"},
+                                   content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(self.db['conversations'].find_one({"participants": employee}))
+
+        allowed, error = permissions.check_chat_permission(employee, self.me)
+        self.assertFalse(allowed, error)
+
+        consumers.save_message(self.me, employee, "welcome aboard", now())
+        self.assertEqual(permissions.check_chat_permission(employee, self.me), (True, None))
+
+
+class HistoryPagingTests(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.seed(partners=1)
+        self.partner = self.partners[0]
+        # Two more sharing one timestamp: pages must split ties by _id, not skip or repeat them
+        tie = datetime.datetime(2026, 1, 2, tzinfo=datetime.timezone.utc)
+        for text in ("tie a", "tie b"):
+            consumers.save_message(self.partner, self.me, text, tie)
+        consumers.save_message(self.me, self.partner, "last", tie + datetime.timedelta(minutes=1))
+
+    def history(self, **params):
+        response = self.get(f"/api/chat/history/{self.me}", {"other_user": self.partner, **params})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_pages_walk_back_without_gaps_or_repeats(self):
+        everything = [m["id"] for m in self.history()["messages"]]
+        self.assertEqual(len(everything), 6)
+
+        pages, page = [], self.history(limit=2)
+        while True:
+            pages.insert(0, [m["id"] for m in page["messages"]])
+            if not page["has_more"]:
+                self.assertIsNone(page["next_cursor"])
+                break
+            self.assertEqual(page["next_cursor"], pages[0][0])
+            page = self.history(limit=2, before=page["next_cursor"])
+        self.assertEqual([len(p) for p in pages], [2, 2, 2])
+        self.assertEqual(sum(pages, []), everything)
+
+    def test_after_catches_up_oldest_first(self):
+        everything = self.history()["messages"]
+        page = self.history(limit=2, after=everything[1]["id"])
+        self.assertEqual([m["id"] for m in page["messages"]], [m["id"] for m in everything[2:4]])
+        self.assertEqual(page["next_cursor"], everything[3]["id"])
+
+        # An ISO timestamp works as a cursor too, and excludes that instant (both ties)
+        page = self.history(limit=10, after=everything[3]["timestamp"])
+        self.assertEqual([m["message"] for m in page["messages"]], ["last"])
+        self.assertFalse(page["has_more"])
+
+    def test_bad_cursor_is_rejected(self):
+        self.assertEqual(self.get(f"/api/chat/history/{self.me}",
+                                  {"other_user": self.partner, "before": "last tuesday"}).status_code, 400)
+        self.assertEqual(self.get(f"/api/chat/history/{self.me}",
+                                  {"other_user": self.partner, "before": "f" * 24}).status_code, 400)
+
+
+class SidebarTests(ChatTestCase):
+
+    KEYS = {"conversation_id", "user", "last_message", "updated_at", "is_disabled", "unread_count"}
+
+    def test_recent_chats_shape_and_order(self):
+        self.seed(partners=3)
+        recent = self.get(f"/api/chat/recent/{self.me}").data
+        # Newest conversation first; an Admin gets no auto-populated entries
+        self.assertEqual([c["user"]["_id"] for c in recent], self.partners[::-1])
+        for conv in recent:
+            self.assertEqual(set(conv), self.KEYS)
+            self.assertEqual(conv["last_message"], "hello 2")
+            self.assertEqual(conv["unread_count"], 2)
+            self.assertFalse(conv["is_disabled"])
+            self.assertEqual(conv["user"]["department_name"], "Engineering")
+            self.assertNotIn("password", conv["user"])
+
+    def test_employee_sidebar_lists_their_department_head(self):
+        self.seed(partners=1)
+        recent = self.get(f"/api/chat/recent/{self.partners[0]}", user_id=self.partners[0]).data
+        self.assertEqual([c["conversation_id"] for c in recent][0], f"new_{self.head}")
+        self.assertEqual(set(recent[0]), self.KEYS)
+        self.assertEqual([c["user"]["_id"] for c in recent], [self.head, self.me])
+        self.assertEqual(recent[1]["unread_count"], 1)
+
+
+class UnreadCounterTests(ChatTestCase):
+
+    def total(self, user_id):
+        return self.get(f"/api/chat/unread/total/{user_id}", user_id=user_id).data["count"]
+
+    def counters(self):
+        return {str(c["_id"]): c.get("unread_counts") for c in self.db['conversations'].find({})}
+
+    def test_counters_follow_send_read_and_clear(self):
+        self.seed(partners=2)
+        first, second = self.partners
+        # Each partner sent me two of their three messages, I sent one
+        self.assertEqual(self.total(self.me), 4)
+        self.assertEqual(self.total(first), 1)
+
+        consumers.save_message(first, self.me, "one more", now())
+        self.assertEqual(self.total(self.me), 5)
+
+        self.get(f"/api/chat/history/{self.me}", {"other_user": first})
+        self.assertEqual(self.total(self.me), 2)
+        self.assertEqual(self.total(first), 1)
+
+        self.api().delete(f"/api/chat/delete_all?user_id={self.me}&other_user={second}")
+        self.assertEqual(self.total(self.me), 0)
+        self.assertEqual(self.total(second), 1)
+
+    def test_reconcile_unread_repairs_drift(self):
+        self.seed(partners=2)
+        first, second = self.partners
+        self.get(f"/api/chat/history/{self.me}", {"other_user": first})
+        self.api().delete(f"/api/chat/delete_all?user_id={second}&other_user={self.me}")
+        expected = self.counters()
+
+        self.db['conversations'].update_many({}, {"$set": {f"unread_counts.{self.me}": 7}, "$unset": {f"unread_counts.{second}": ""}})
+        self.assertIn("updated 2", self.command('reconcile_unread'))
+        self.assertEqual(self.counters(), expected)
+        self.assertIn("updated 0", self.command('reconcile_unread'))
+
+
+class SearchVisibilityTests(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.seed(partners=1)
+        self.employee = self.partners[0]
+        other_dept = self.db['departments'].insert_one({"name": "Sales"}).inserted_id
+        self.other_head = str(self.db['users'].insert_one(
+            {"firstName": "Oscar", "lastName": "Other", "employeeId": "EMP-3", "role": "Department Head",
+             "department": other_dept}).inserted_id)
+        self.other_employee = str(self.db['users'].insert_one(
+            {"firstName": "Olive", "lastName": "Other", "employeeId": "EMP-4", "role": "Employee",
+             "department": other_dept}).inserted_id)
+        directory.clear()
+
+    def visible_to(self, user_id):
+        """ Who `user_id` finds searching for everyone, with and without the in-memory index """
+        found = []
+        for use_index in (True, False):
+            with override_settings(USER_SEARCH_INDEX=use_index):
+                response = self.get("/api/chat/search", {"q": "emp", "user_id": user_id}, user_id=user_id)
+            found.append(sorted(u["_id"] for u in response.data))
+        self.assertEqual(found[0], found[1], "index and $regex search disagree")
+        return found[0]
+
+    def test_employee_sees_admins_and_own_department_head(self):
+        self.assertEqual(self.visible_to(self.employee), sorted([self.me, self.head]))
+
+    def test_department_head_sees_admins_and_own_employees(self):
+        self.assertEqual(self.visible_to(self.head), sorted([self.me, self.employee]))
+        self.assertEqual(self.visible_to(self.other_head), sorted([self.me, self.other_employee]))
+
+    def test_admin_sees_everyone(self):
+        self.assertEqual(self.visible_to(self.me),
+                         sorted([self.head, self.employee, self.other_head, self.other_employee]))
+
+
+class ReadReceiptTests(ChatTestCase):
+
+    def unread(self, partner):
+        conv = self.db['conversations'].find_one({"participants": {"$all": [self.me, partner]}})
+        return conv['unread_counts'][self.me]
+
+    def test_message_arriving_during_mark_read_stays_unread(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+        count_documents = receipts.messages_collection.count_documents
+
+        def count_then_receive(*args, **kwargs):
+            covered = count_documents(*args, **kwargs)
+            # Lands after mark_read read the conversation, before it writes
+            consumers.save_message(partner, self.me, "just now", now())
+            return covered
+
+        with mock.patch.object(receipts.messages_collection, 'count_documents', side_effect=count_then_receive):
+            receipt = receipts.mark_read(self.me, partner)
+        self.assertIsNotNone(receipt)
+        self.assertEqual(self.unread(partner), 1)
+
+    def test_drifted_counter_is_not_left_negative(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+        self.db['conversations'].update_one({"participants": {"$all": [self.me, partner]}},
+                                            {"$set": {f"unread_counts.{self.me}": 1}})
+        self.assertIsNotNone(receipts.mark_read(self.me, partner))
+        self.assertEqual(self.unread(partner), 0)
+
+
+class MigrationTests(ChatTestCase):
+
+    def test_pair_key_merge_keeps_the_largest_unread_count(self):
+        a, b = "a" * 24, "b" * 24
+        older = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+        self.db['conversations'].insert_many([
+            {"participants": [a, b], "last_message": "old", "updated_at": older,
+             "unread_counts": {a: 2, b: 1}, "is_disabled": True},
+            {"participants": [b, a], "last_message": "new", "updated_at": older + datetime.timedelta(hours=1),
+             "unread_counts": {a: 3}},
+        ])
+        self.command('migrate_pair_keys')
+
+        convs = list(self.db['conversations'].find({}))
+        self.assertEqual(len(convs), 1)
+        self.assertEqual(convs[0]['pair_key'], f"{a}:{b}")
+        self.assertEqual(convs[0]['last_message'], "new")
+        self.assertEqual(convs[0]['unread_counts'], {a: 3, b: 1})
+        self.assertTrue(convs[0]['is_disabled'])
+
+        self.assertIn("merged away 0", self.command('migrate_pair_keys'))
+
+    def test_cleared_at_migration_is_idempotent(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+        messages = list(self.db['messages'].find({}).sort("timestamp", 1))
+        # The old "clear chat" tagged every message at the time; a newer one arrived since
+        self.db['messages'].update_many({"_id": {"$in": [m["_id"] for m in messages[:2]]}},
+                                        {"$set": {"deleted_by": [self.me]}})
+        conv_filter = {"participants": self.me}
+
+        self.command('migrate_cleared_at', '--keep-deleted-by')
+        cleared_at = self.db['conversations'].find_one(conv_filter)['cleared_at']
+        self.assertEqual(cleared_at[self.me].replace(tzinfo=None), messages[1]['timestamp'].replace(tzinfo=None))
+        self.assertEqual(self.db['messages'].count_documents({"deleted_by": {"$exists": True}}), 2)
+
+        history = self.get(f"/api/chat/history/{self.me}", {"other_user": partner}).data
+        self.assertEqual([m["message"] for m in history["messages"]], ["hello 2"])
+
+        # Running again, with the arrays gone or not, writes the same watermarks
+        self.command('migrate_cleared_at')
+        self.assertIn("Set 0 watermark(s), removed deleted_by from 0", self.command('migrate_cleared_at'))
+        self.assertEqual(self.db['conversations'].find_one(conv_filter)['cleared_at'], cleared_at)
+
+        # ...and never moves back a watermark set by a later "clear chat"
+        self.api().delete(f"/api/chat/delete_all?user_id={self.me}&other_user={partner}")
+        newer = self.db['conversations'].find_one(conv_filter)['cleared_at'][self.me]
+        self.db['messages'].update_one({"_id": messages[0]["_id"]}, {"$set": {"deleted_by": [self.me]}})
+        self.command('migrate_cleared_at')
+        self.assertEqual(self.db['conversations'].find_one(conv_filter)['cleared_at'][self.me], newer)
+
+    def test_cleared_at_waits_for_pair_keys(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+        self.db['messages'].update_many({}, {"$set": {"deleted_by": [self.me]}})
+        self.db['conversations'].update_many({}, {"$unset": {"pair_key": ""}})
+        conv_filter = {"participants": self.me}
+
+        # Nothing to hang the watermark on: the clear-chat state must survive on the messages
+        self.assertIn("skipped 1 unkeyed pair(s)", self.command('migrate_cleared_at'))
+        self.assertNotIn('cleared_at', self.db['conversations'].find_one(conv_filter))
+        self.assertEqual(self.db['messages'].count_documents({"deleted_by": [self.me]}), 3)
+
+        self.command('migrate_pair_keys')
+        self.assertIn("removed deleted_by from 3", self.command('migrate_cleared_at'))
+        self.assertIn(self.me, self.db['conversations'].find_one(conv_filter)['cleared_at'])
+        history = self.get(f"/api/chat/history/{self.me}", {"other_user": partner}).data
+        self.assertEqual(history["messages"], [])
+
+    def test_cleared_at_keeps_tags_when_a_watermark_misses(self):
+        self.seed(partners=1)
+        self.db['messages'].update_many({}, {"$set": {"deleted_by": [self.me]}})
+        bulk_write = migrate_cleared_at.conversations_collection.bulk_write
+
+        def conversation_gone(ops, **kwargs):
+            self.db['conversations'].delete_many({})
+            return bulk_write(ops, **kwargs)
+
+        with mock.patch.object(migrate_cleared_at.conversations_collection, 'bulk_write', side_effect=conversation_gone):
+            self.assertRaises(CommandError, self.command, 'migrate_cleared_at')
+        self.assertEqual(self.db['messages'].count_documents({"deleted_by": [self.me]}), 3)
+
+
+class DeltaSyncTests(ChatTestCase):
+
+    def test_since_returns_only_changes(self):
+        self.seed(partners=3)
+        partner = self.partners[0]
+        history = self.get(f"/api/chat/history/{self.me}", {"other_user": partner}).data
+        since = (now() - datetime.timedelta(seconds=1)).isoformat()
+
+        client = self.api()
+        mine = next(m for m in history["messages"] if m["sender"] == self.me)
+        client.put(f"/api/chat/message/{mine['id']}?user_id={self.me}", {"message": "edited"},
+                   content_type="application/json")
+        oops = consumers.save_message(self.me, partner, "oops", now())
+        client.delete(f"/api/chat/message/{oops}?user_id={self.me}")
+        consumers.save_message(partner, self.me, "fresh", now())
+
+        recent = self.get(f"/api/chat/recent/{self.me}", {"since": since}).data
+        self.assertEqual([c["user"]["_id"] for c in recent["conversations"]], [partner])
+        self.assertIn("sync", recent)
+
+        delta = self.get(f"/api/chat/history/{self.me}", {"other_user": partner, "since": since}).data
+        self.assertEqual(sorted(m["message"] for m in delta["messages"]), ["edited", "fresh"])
+        self.assertEqual(delta["deleted"], [str(oops)])
+
+        self.assertEqual(self.get(f"/api/chat/recent/{self.me}", {"since": "yesterday"}).status_code, 400)
+
+    def test_recent_chats_etag_expires_with_the_directory_cache(self):
+        self.seed(partners=1)
+        path = f"/api/chat/recent/{self.head}"
+        with mock.patch('chat.sync.time.time', return_value=1_000_000):
+            etag = self.get(path, user_id=self.head)["ETag"]
+            # A new hire in the Head's department: no chat version moves
+            hire = str(self.db['users'].insert_one(
+                {"firstName": "New", "lastName": "Hire", "role": "Employee", "department": self.dept_id}).inserted_id)
+            self.assertEqual(self.api(self.head, HTTP_IF_NONE_MATCH=etag).get(path).status_code, 304)
+
+        later = 1_000_000 + settings.DIRECTORY_CACHE_TTL
+        with mock.patch('chat.sync.time.time', return_value=later):
+            response = self.api(self.head, HTTP_IF_NONE_MATCH=etag).get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(hire, [c["user"]["_id"] for c in response.data])
+
+
+class ReplayTests(ChatTestCase):
+
+    def reconnect(self, query):
+        async def run():
+            comm = self.socket(self.me, query)
+            connected, _ = await comm.connect()
+            self.assertTrue(connected)
+            received = []
+            while query and (not received or not received[-1].get("done")):
+                received.append(await receive_json(comm))
+            await comm.disconnect()
+            return received
+        return async_to_sync(run)()
+
+    def test_reconnect_replays_missed_changes(self):
+        self.seed(partners=2)
+        first, second = self.partners
+        since = (now() - datetime.timedelta(seconds=1)).isoformat()
+        history = self.get(f"/api/chat/history/{self.me}", {"other_user": first}).data["messages"]
+        mine = next(m for m in history if m["sender"] == self.me)
+
+        # While "offline": a new message, an edit, a delete, and a clear of the second conversation
+        client = self.api()
+        fresh = consumers.save_message(first, self.me, "missed", now())
+        client.put(f"/api/chat/message/{mine['id']}?user_id={self.me}", {"message": "edited"}, content_type="application/json")
+        oops = consumers.save_message(self.me, first, "oops", now())
+        client.delete(f"/api/chat/message/{oops}?user_id={self.me}")
+        consumers.save_message(second, self.me, "hidden", now())
+        client.delete(f"/api/chat/delete_all?user_id={self.me}&other_user={second}")
+
+        self.assertEqual(self.reconnect(""), [])  # no replay asked; warms the token and directory caches
+        with mock.patch.object(settings, 'REPLAY_BATCH_SIZE', 1), \
+                mongo_budget(self.counter, BUDGETS['consumer_replay'], 'consumer_replay'):
+            received = self.reconnect(f"since={since}")
+
+        self.assertEqual({f["type"] for f in received}, {"replay"})
+        replayed = {m["id"]: m for f in received for m in f["messages"]}
+        self.assertEqual(sorted(m["message"] for m in replayed.values()), ["edited", "missed"])
+        self.assertIn("edited_at", replayed[mine["id"]])
+        self.assertEqual(len(received), 2)
+        last = received[-1]
+        self.assertEqual([t["id"] for t in last["deleted"]], [oops])
+        self.assertEqual([c["other_user"] for c in last["cleared"]], [second])
+        self.assertFalse(last["truncated"])
+
+        # A last-seen message id resumes from that message
+        received = self.reconnect(f"last_id={fresh}")
+        self.assertIn(fresh, {m["id"] for f in received for m in f["messages"]})
+
+    def test_edits_to_cleared_messages_stay_hidden(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+        theirs = str(self.db['messages'].find_one({"sender_id": partner})["_id"])
+        self.api().delete(f"/api/chat/delete_all?user_id={self.me}&other_user={partner}")
+        since = now().isoformat()
+
+        # Cleared before `since`, edited after it
+        self.api(partner).put(f"/api/chat/message/{theirs}?user_id={partner}", {"message": "edited"},
+                              content_type="application/json")
+        fresh = consumers.save_message(partner, self.me, "after the clear", now())
+
+        received = self.reconnect(f"since={since}")
+        self.assertEqual([m["id"] for f in received for m in f["messages"]], [fresh])
+        self.assertEqual(received[-1]["cleared"], [])
+
+
+class PresenceTests(ChatTestCase):
+
+    def test_presence_events_and_offline_fanout_skip(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+
+        async def exchange():
+            me = self.socket(self.me)
+            await me.connect()
+            await me.send_to(text_data=json.dumps({"type": "presence_subscribe", "user_ids": [partner]}))
+            self.assertFalse((await receive_json(me))["users"][partner]["online"])
+
+            # Partner offline: the message is saved but nothing goes through the channel layer for them
+            layer = channel_layers["default"]
+            with mock.patch.object(layer, 'group_send', wraps=layer.group_send) as group_send:
+                await me.send_to(text_data=json.dumps({"message": "are you there?", "receiverId": partner}))
+                await me.receive_from(timeout=5)
+            self.assertEqual(group_send.call_count, 0)
+
+            them = self.socket(partner)
+            await them.connect()
+            self.assertEqual(await receive_json(me),
+                             {"type": "presence", "users": {partner: {"online": True, "last_seen": None}}})
+            await me.send_to(text_data=json.dumps({"message": "hi", "receiverId": partner}))
+            await me.receive_from(timeout=5)
+            self.assertEqual((await receive_json(them))["message"], "hi")
+
+            await them.disconnect()
+            self.assertFalse((await receive_json(me))["users"][partner]["online"])
+            await me.disconnect()
+
+        async_to_sync(exchange)()
+
+        response = self.get("/api/chat/presence", {"ids": f"{self.me},{partner}"})
+        self.assertFalse(response.data[partner]["online"])
+        self.assertIsNotNone(response.data[partner]["last_seen"])
+
+
+    def test_socket_is_online_once_the_handshake_completes(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+
+        registered = presence.connected
+
+        def slow_registration(*args):
+            time.sleep(0.1)
+            return registered(*args)
+
+        async def connect():
+            them = self.socket(partner)
+            await them.connect()
+            online = (await sync_to_async(presence.lookup)([partner]))[partner]["online"]
+            await them.disconnect()
+            return online
+
+        with mock.patch.object(presence, 'connected', side_effect=slow_registration):
+            self.assertTrue(async_to_sync(connect)())
+
+
+class AsyncViewTests(ChatTestCase):
+
+    def test_async_views_match_sync_views(self):
+        self.seed(partners=3)
+        partner = self.partners[0]
+        self.get(f"/api/chat/history/{self.me}", {"other_user": partner})  # mark read so both runs see the same state
+        headers = {"Authorization": f"Bearer {token_for(self.me)}"}
+        calls = [
+            (f"/api/chat/recent/{self.me}", {}),
+            (f"/api/chat/history/{self.me}", {"other_user": partner, "limit": 2}),
+            ("/api/chat/search", {"q": "emp", "user_id": self.me}),
+            (f"/api/chat/unread/total/{self.me}", {}),
+        ]
+
+        def fetch_sync():
+            with override_settings(ROOT_URLCONF=chat_urlconf(False)):
+                return [Client().get(path, params, headers=headers) for path, params in calls]
+
+        async def fetch_async():
+            with override_settings(ROOT_URLCONF=chat_urlconf(True)):
+                return [await AsyncClient().get(path, params, headers=headers) for path, params in calls]
+
+        expected = fetch_sync()
+        for (path, _), want, got in zip(calls, expected, async_to_sync(fetch_async)()):
+            self.assertEqual(got.status_code, want.status_code, path)
+            self.assertEqual(got.json(), want.json(), path)
+            self.assertEqual(got.get("ETag"), want.get("ETag"), path)
+
+        # Writes fan out from the async view too
+        async def toggle_while_connected():
+            comm = self.socket(partner)
+            await comm.connect()
+            with override_settings(ROOT_URLCONF=chat_urlconf(True)):
+                response = await AsyncClient().post(
+                    "/api/chat/toggle", {"admin_id": self.me, "target_user_id": partner, "action": "disable"},
+                    content_type="application/json", headers=headers)
+            frame = await receive_json(comm)
+            await comm.disconnect()
+            return response, frame
+
+        response, frame = async_to_sync(toggle_while_connected)()
+        self.assertEqual(response.json(), {"success": True, "status": "disable"})
+        self.assertEqual(frame, {"type": "status_update", "is_disabled": True, "participants": [self.me, partner]})
+
+    def test_async_views_handle_exceptions_like_drf(self):
+        self.seed(partners=1)
+        headers = {"Authorization": f"Bearer {token_for(self.me)}"}
+        path, params = f"/api/chat/history/{self.me}", {"other_user": self.partners[0]}
+
+        def fetch_sync():
+            with override_settings(ROOT_URLCONF=chat_urlconf(False)):
+                return Client().get(path, params, headers=headers)
+
+        async def fetch_async():
+            with override_settings(ROOT_URLCONF=chat_urlconf(True)):
+                return await AsyncClient().get(path, params, headers=headers)
+
+        with mock.patch('chat.views.sync.get_version', side_effect=Http404):
+            want, got = fetch_sync(), async_to_sync(fetch_async)()
+        self.assertEqual((got.status_code, got.json()), (want.status_code, want.json()))
+        self.assertEqual(got.status_code, 404)
+
+        with mock.patch('chat.views.sync.get_version', side_effect=PermissionDenied):
+            want, got = fetch_sync(), async_to_sync(fetch_async)()
+        self.assertEqual((got.status_code, got.json()), (403, want.json()))
+
+        # Anything else is a server error, raised to Django as DRF does
+        with mock.patch('chat.views.sync.get_version', side_effect=RuntimeError("boom")):
+            self.assertRaises(RuntimeError, fetch_sync)
+            self.assertRaises(RuntimeError, async_to_sync(fetch_async))
+
+
+class IndexTests(ChatTestCase):
+
+    def explain(self):
+        # mongomock has no query planner; probes only run against a real server
+        return [] if TEST_MONGO_URI else ['--skip-explain']
+
+    def test_dropped_index_is_reported_recreated_and_blocks_startup(self):
+        self.command('chat_indexes', *self.explain())
+        self.assertEqual(indexes.missing_indexes(), [])
+
+        self.db['messages'].drop_index("history_pair_ts")
+        self.assertEqual(indexes.missing_indexes(), [("messages", "history_pair_ts")])
+        with self.assertRaisesMessage(CommandError, "1 missing index(es)"):
+            self.command('chat_indexes', '--check', '--skip-explain')
+
+        # The ASGI module runs the check on import when MONGO_REQUIRE_INDEXES is on
+        with override_settings(MONGO_REQUIRE_INDEXES=True), mock.patch.dict(sys.modules):
+            sys.modules.pop('server.asgi', None)
+            with self.assertRaisesMessage(ImproperlyConfigured, "messages.history_pair_ts"):
+                importlib.import_module('server.asgi')
+
+        out = self.command('chat_indexes', *self.explain())
+        self.assertIn("ok       history_pair_ts", out)
+        self.assertEqual(indexes.missing_indexes(), [])
+        with override_settings(MONGO_REQUIRE_INDEXES=True), mock.patch.dict(sys.modules):
+            sys.modules.pop('server.asgi', None)
+            self.assertTrue(importlib.import_module('server.asgi').application)
+
+
+class MetricsTests(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        enabled = mock.patch.object(metrics, 'ENABLED', True)
+        enabled.start()
+        self.addCleanup(enabled.stop)
+        self.seed(partners=1)
+
+    def scrape(self, **headers):
+        response = Client(**headers).get("/metrics")
+        return response.status_code, response.content.decode()
+
+    def test_rest_and_socket_traffic_is_exposed(self):
+        with override_settings(MIDDLEWARE=['chat.metrics.MetricsMiddleware', *settings.MIDDLEWARE]):
+            self.get(f"/api/chat/unread/total/{self.me}")
+
+        async def exchange():
+            comm, partner = self.socket(self.me), self.socket(self.partners[0])
+            await comm.connect()
+            await partner.connect()
+            await comm.send_to(text_data=json.dumps({"message": "measured", "receiverId": self.partners[0]}))
+            await receive_json(partner)
+            opened = metrics.active_sockets.values.get((), 0)
+            await comm.disconnect()
+            await partner.disconnect()
+            return opened
+
+        before = metrics.active_sockets.values.get((), 0)
+        self.assertEqual(async_to_sync(exchange)(), before + 2)
+        self.assertEqual(metrics.active_sockets.values.get((), 0), before)
+
+        status, text = self.scrape()
+        self.assertEqual(status, 200)
+        self.assertIn('chat_http_request_duration_seconds_count{view="get_total_unread",method="GET",status="2xx"}', text)
+        self.assertIn('# TYPE chat_ws_active_sockets gauge', text)
+        # The message was fanned out to the partner's user_<id> group
+        self.assertRegex(text, r'chat_channel_layer_send_duration_seconds_count\{op="group_send"\} [1-9]')
+        self.assertIn('chat_channel_layer_send_duration_seconds_bucket{op="group_send",le="+Inf"}', text)
+
+    def test_mongo_commands_are_counted_per_collection(self):
+        listener = metrics.MongoCommandListener()
+
+        def command(request_id, name, body, duration, ok=True):
+            started = types.SimpleNamespace(connection_id=("db", 27017), request_id=request_id,
+                                            command_name=name, command=body)
+            listener.started(started)
+            done = types.SimpleNamespace(connection_id=("db", 27017), request_id=request_id,
+                                         command_name=name, duration_micros=duration)
+            (listener.succeeded if ok else listener.failed)(done)
+
+        find = metrics.mongo_duration.values.get(("messages", "find"), [None, 0.0, 0])
+        errors = metrics.mongo_errors.values.get(("messages", "insert"), 0)
+        command(1, "find", {"find": "messages"}, 2000)
+        command(2, "getMore", {"getMore": 42, "collection": "messages"}, 1000)
+        command(3, "insert", {"insert": "messages"}, 500, ok=False)
+
+        self.assertEqual(metrics.mongo_duration.values[("messages", "find")][2], find[2] + 1)
+        self.assertAlmostEqual(metrics.mongo_duration.values[("messages", "find")][1], find[1] + 0.002)
+        self.assertIn(("messages", "getMore"), metrics.mongo_duration.values)
+        self.assertEqual(metrics.mongo_errors.values[("messages", "insert")], errors + 1)
+        self.assertEqual(listener.pending, {})
+        self.assertIn('chat_mongo_command_errors_total{collection="messages",command="insert"}', self.scrape()[1])
+
+    def test_token_and_disabled_endpoint(self):
+        with override_settings(METRICS_TOKEN="scraper"):
+            self.assertEqual(self.scrape()[0], 401)
+            self.assertEqual(self.scrape(HTTP_AUTHORIZATION="Bearer scraper")[0], 200)
+
+        with mock.patch.object(metrics, 'ENABLED', False):
+            self.assertEqual(self.scrape()[0], 404)
+            self.assertEqual(metrics.mongo_event_listeners(), [])
+
+            async def handler():
+                pass
+            # Off: handlers and layers are left exactly as they were
+            self.assertIs(metrics.timed(handler), handler)
+            layer = types.SimpleNamespace()
+            self.assertIs(metrics.instrument_channel_layer(layer), layer)
+            self.assertEqual(vars(layer), {})
+
+        self.assertIsInstance(metrics.mongo_event_listeners()[0], metrics.MongoCommandListener)
+        timed = metrics.timed(OutboundBatchingTests.publish)
+        self.assertIsNot(timed, OutboundBatchingTests.publish)
+
+
+class ReadRoutingTests(SimpleTestCase):
+
+    def test_read_heavy_routing_only_for_settled_users(self):
+        from . import mongo_client, sync
+        with override_settings(MONGO_READ_HEAVY_PREFERENCE='secondaryPreferred', MONGO_MAX_STALENESS_S=90,
+                               MONGO_COMPRESSORS='zstd,snappy', MONGO_MAX_POOL_SIZE=7):
+            self.assertEqual(mongo_client.read_heavy_preference().max_staleness, 90)
+            options = mongo_client.client_options()
+            self.assertEqual((options["compressors"], options["maxPoolSize"]), ('zstd,snappy', 7))
+
+            current = now()
+            self.assertTrue(sync.secondary_safe(None))
+            self.assertTrue(sync.secondary_safe(current - datetime.timedelta(minutes=5)))
+            # Changed within the staleness window: a secondary may not have it yet
+            self.assertFalse(sync.secondary_safe(current - datetime.timedelta(seconds=30)))
+        self.assertFalse(sync.secondary_safe(None))
+
+
+class WriteBehindTests(ChatTestCase):
+
+    def writer(self, durable_ack):
+        return writebehind.MessageWriter(batch_size=10, flush_ms=20, max_queue=100, durable_ack=durable_ack)
+
+    def unread(self, partner):
+        conv = self.db['conversations'].find_one({"pair_key": f"{min(self.me, partner)}:{max(self.me, partner)}"})
+        return conv['unread_counts'][partner] if conv else 0
+
+    def test_rejected_message_fails_alone(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+        taken = self.db['messages'].find_one({})["_id"]
+
+        async def scenario():
+            writer = self.writer(durable_ack=True)
+            # The first message reuses an existing _id and is rejected by the batch insert
+            with mock.patch.object(writebehind, 'ObjectId', side_effect=[taken, writebehind.ObjectId()]):
+                results = await asyncio.gather(
+                    writer.submit(self.me, partner, "duplicate", now()),
+                    writer.submit(self.me, partner, "fine", now()),
+                    return_exceptions=True)
+            await writer.drain()
+            return results
+
+        before = self.unread(partner)
+        with mock.patch('builtins.print'):
+            rejected, written = async_to_sync(scenario)()
+        self.assertIsInstance(rejected, Exception)
+        self.assertIsInstance(written, str)
+        self.assertEqual(self.unread(partner), before + 1)
+        self.assertEqual(self.db['conversations'].find_one({"participants": partner})['last_message'], "fine")
+
+    def test_failed_flush_without_durable_ack_leaves_nothing_unretrieved(self):
+        self.seed(partners=1)
+        unhandled = []
+
+        async def scenario():
+            asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+            writer = self.writer(durable_ack=False)
+            await writer.submit(self.me, self.partners[0], "lost", now())
+            await writer.drain()
+
+        with mock.patch.object(writebehind, 'write_batch', side_effect=RuntimeError("primary stepped down")), \
+                mock.patch('builtins.print'):
+            async_to_sync(scenario)()
+        gc.collect()
+        self.assertEqual(unhandled, [])
+
+    def test_lifespan_shutdown_drains_the_queue(self):
+        self.seed(partners=1)
+        self.addCleanup(setattr, writebehind, '_writer', None)
+        events = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+        sent = []
+
+        async def scenario():
+            async def receive():
+                return next(events)
+
+            async def send(message):
+                sent.append(message["type"])
+
+            await writebehind.get_message_writer().submit(self.me, self.partners[0], "last words", now())
+            await writebehind.lifespan({"type": "lifespan"}, receive, send)
+
+        with override_settings(WRITE_BEHIND_DURABLE_ACK=False, WRITE_BEHIND_FLUSH_MS=10_000):
+            async_to_sync(scenario)()
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertIsNotNone(self.db['messages'].find_one({"message": "last words"}))
+
+
+class OutboundBatchingTests(ChatTestCase):
+
+    layer_event = {"type": "chat_activity", "action": "edit_message", "message_id": "m", "new_text": "x"}
+
+    async def publish(self, events):
+        layer = channel_layers["default"]
+        for _ in range(events):
+            await layer.group_send(f"user_{self.me}", self.layer_event)
+
+    def test_batching_socket_coalesces_bursts_and_bounds_its_queue(self):
+        self.seed(partners=1)
+
+        async def burst(events, **overrides):
+            comm = self.socket(self.me, "batch=1")
+            with override_settings(**overrides):
+                await comm.connect()
+                await self.publish(events)
+                received = []
+                while True:
+                    output = await comm.receive_output(timeout=5)
+                    if output["type"] == "websocket.close":
+                        return received, output["code"]
+                    received.append(json.loads(output["text"]))
+                    if sum(len(f) for f in received) >= events or received[-1][-1]["type"] == "overflow":
+                        await comm.disconnect()
+                        return received, None
+
+        # An edit storm arrives as a few array frames instead of one frame per edit
+        received, _ = async_to_sync(burst)(30, OUTBOUND_BATCH_WINDOW_MS=50, OUTBOUND_BATCH_MAX=20)
+        self.assertEqual([len(f) for f in received], [20, 10])
+        self.assertEqual(received[0][0]["action"], "edit_message")
+        edit = received[0][0]
+
+        # Queue full: new frames are dropped and the client is told how many
+        dropped = metrics.slow_consumers.values.get(('drop',), 0)
+        received, _ = async_to_sync(burst)(5, OUTBOUND_BATCH_WINDOW_MS=100, OUTBOUND_MAX_QUEUE=3)
+        self.assertEqual(received, [[edit] * 3 + [{"type": "overflow", "dropped": 2}]])
+        self.assertEqual(metrics.slow_consumers.values[('drop',)], dropped + 2)
+
+        # The byte limit applies the same way: room for two of these frames
+        size = len(frames.dumps(edit))
+        received, _ = async_to_sync(burst)(5, OUTBOUND_BATCH_WINDOW_MS=100, OUTBOUND_MAX_BYTES=size * 2 + 1)
+        self.assertEqual(received, [[edit] * 2 + [{"type": "overflow", "dropped": 3}]])
+
+        # ...or the socket is closed so the client reconnects with ?since=
+        closed = metrics.slow_consumers.values.get(('disconnect',), 0)
+        received, code = async_to_sync(burst)(5, OUTBOUND_BATCH_WINDOW_MS=100, OUTBOUND_MAX_QUEUE=3,
+                                              OUTBOUND_SLOW_POLICY='disconnect')
+        self.assertEqual((received, code), ([], 4008))
+        self.assertEqual(metrics.slow_consumers.values[('disconnect',)], closed + 1)
+
+    @unittest.skipUnless(frames.msgpack, "needs msgpack")
+    def test_msgpack_batches_are_one_array(self):
+        self.seed(partners=1)
+
+        async def burst():
+            comm = self.socket(self.me, "batch=1", subprotocols=["chat.msgpack"])
+            with override_settings(OUTBOUND_BATCH_WINDOW_MS=50, OUTBOUND_MAX_QUEUE=3):
+                await comm.connect()
+                await self.publish(4)
+                received = frames.unpack(await comm.receive_from(timeout=5))
+            await comm.disconnect()
+            return received
+
+        received = async_to_sync(burst)()
+        self.assertEqual([f.get("action") for f in received[:3]], ["edit_message"] * 3)
+        self.assertEqual(received[3], {"type": "overflow", "dropped": 1})
+
+    def test_batch_counts_against_the_limit_until_send_returns(self):
+        self.seed(partners=1)
+        released = asyncio.Event()
+        send = consumers.ChatConsumer.send
+
+        async def stalled_send(consumer, text_data=None, **kwargs):
+            # The client stopped reading: the first batch doesn't go out until released
+            await released.wait()
+            await send(consumer, text_data=text_data, **kwargs)
+
+        async def scenario():
+            comm = self.socket(self.me, "batch=1")
+            with override_settings(OUTBOUND_BATCH_WINDOW_MS=10, OUTBOUND_MAX_QUEUE=3), \
+                    mock.patch.object(consumers.ChatConsumer, 'send', stalled_send):
+                released.set()
+                await comm.connect()
+                released.clear()
+                await self.publish(3)
+                await asyncio.sleep(0.2)    # drained into a batch that is stuck in send()
+                await self.publish(2)
+                await asyncio.sleep(0.2)
+                released.set()
+                first = await receive_json(comm)
+                await self.publish(1)
+                second = await receive_json(comm)
+            await comm.disconnect()
+            return first, second
+
+        first, second = async_to_sync(scenario)()
+        self.assertEqual(len(first), 3)
+        self.assertEqual(second[-1], {"type": "overflow", "dropped": 2})
+
+
+class FrameEncodingTests(ChatTestCase):
+
+    @unittest.skipUnless(frames.msgpack, "needs msgpack")
+    def test_msgpack_subprotocol_and_single_json_encoding(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+
+        async def exchange():
+            binary = self.socket(self.me, subprotocols=["chat.msgpack"])
+            text = self.socket(partner)
+            self.assertEqual(await binary.connect(), (True, "chat.msgpack"))
+            self.assertEqual(await text.connect(), (True, None))
+
+            with mock.patch('chat.frames.dumps', wraps=frames.dumps) as dumps:
+                await binary.send_to(bytes_data=frames.pack({"message": "packed", "receiverId": partner}))
+                echo = frames.unpack(await binary.receive_from(timeout=5))
+                delivered = await text.receive_from(timeout=5)
+            # One JSON encoding for the sender's echo and every JSON recipient
+            self.assertEqual(dumps.call_count, 1)
+            self.assertEqual(json.loads(delivered), echo)
+            self.assertEqual(echo["message"], "packed")
+
+            # JSON replies reach the MessagePack client as binary frames
+            await text.send_to(text_data=json.dumps({"message": "plain", "receiverId": self.me}))
+            await text.receive_from(timeout=5)
+            self.assertEqual(frames.unpack(await binary.receive_from(timeout=5))["message"], "plain")
+            await binary.disconnect()
+            await text.disconnect()
+
+        async_to_sync(exchange)()
+
+    @unittest.skipUnless(frames.orjson, "needs orjson")
+    def test_orjson_and_stdlib_encodings_match(self):
+        self.seed(partners=1)
+        doc = self.db['messages'].find_one({"sender_id": self.me})
+        doc['message'] = 'naïve "quotes" \\ 👋\n'
+        doc['edited_at'] = now()
+        payload = consumers.message_payload(doc)
+        payload.update({"is_read": False, "count": 3, "participants": [self.me, None]})
+
+        fast = frames.dumps(payload)
+        with mock.patch.object(frames, 'orjson', None):
+            plain = frames.dumps(payload)
+            self.assertEqual(frames.join([plain, plain]), f"[{plain},{plain}]")
+        self.assertEqual(fast, plain)
+        self.assertEqual(json.loads(fast), payload)
+
+    def test_stdlib_fallback_serves_text_clients(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+
+        async def exchange():
+            sender, receiver = self.socket(self.me), self.socket(partner)
+            await sender.connect()
+            await receiver.connect()
+            await sender.send_to(text_data=json.dumps({"message": "plain ✓", "receiverId": partner}))
+            echo = await sender.receive_from(timeout=5)
+            delivered = await receiver.receive_from(timeout=5)
+            await sender.disconnect()
+            await receiver.disconnect()
+            return echo, delivered
+
+        with mock.patch.object(frames, 'orjson', None):
+            echo, delivered = async_to_sync(exchange)()
+        self.assertEqual(echo, delivered)
+        self.assertEqual(json.loads(echo)["message"], "plain ✓")
+
+
+class InboundErrorTests(ChatTestCase):
+
+    def test_failures_answer_with_the_rejected_message(self):
+        self.seed(partners=1)
+        partner = self.partners[0]
+
+        async def exchange():
+            comm = self.socket(self.me)
+            await comm.connect()
+            with mock.patch.object(consumers, 'save_message', side_effect=RuntimeError("primary stepped down")):
+                await comm.send_to(text_data=json.dumps({"message": "lost?", "receiverId": partner}))
+                not_saved = await receive_json(comm)
+            # Malformed: no receiverId
+            await comm.send_to(text_data=json.dumps({"message": "to whom?"}))
+            failed = await receive_json(comm)
+            # The socket stays usable
+            await comm.send_to(text_data=json.dumps({"message": "retry", "receiverId": partner}))
+            echo = await receive_json(comm)
+            await comm.disconnect()
+            return not_saved, failed, echo
+
+        with mock.patch('builtins.print'):
+            not_saved, failed, echo = async_to_sync(exchange)()
+        self.assertEqual((not_saved["error"], not_saved["rejected"]),
+                         ("Message could not be saved", {"message": "lost?", "receiverId": partner}))
+        self.assertEqual((failed["code"], failed["rejected"]["message"]), ("failed", "to whom?"))
+        self.assertEqual(echo["message"], "retry")
+
+
+class RateLimitTests(ChatTestCase):
+
+    def chat(self, text):
+        return json.dumps({"message": text, "receiverId": self.partners[0]})
+
+    def test_user_bucket_is_shared_by_all_sockets(self):
+        self.seed(partners=1)
+
+        async def exchange():
+            # Two tabs of one user draw on one bucket of 3
+            tabs = [self.socket(self.me) for _ in range(2)]
+            for tab in tabs:
+                await tab.connect()
+            replies = []
+            for n in range(4):
+                await tabs[n % 2].send_to(text_data=self.chat(f"m{n}"))
+                replies.append(await receive_json(tabs[n % 2]))
+            for tab in tabs:
+                await tab.disconnect()
+            return replies
+
+        with override_settings(WS_USER_RATE=0.01, WS_USER_BURST=3):
+            replies = async_to_sync(exchange)()
+        self.assertEqual([f.get("message") for f in replies[:3]], ["m0", "m1", "m2"])
+        error = replies[3]
+        self.assertEqual((error["code"], error["limit"], error["rejected"]["message"]), ("rate_limited", "user", "m3"))
+        self.assertGreater(error["retry_after"], 0)
+        self.assertEqual(self.db['messages'].count_documents({"message": {"$in": ["m0", "m1", "m2", "m3"]}}), 3)
+
+    def test_socket_flood_gets_one_error_per_window(self):
+        self.seed(partners=1)
+
+        async def flood():
+            comm = self.socket(self.me)
+            await comm.connect()
+            for _ in range(6):
+                await comm.send_to(text_data=json.dumps({"type": "presence_subscribe", "user_ids": []}))
+            received = await receive_all(comm)
+            await comm.disconnect()
+            return received
+
+        with override_settings(WS_SOCKET_RATE=0.01, WS_SOCKET_BURST=2):
+            received = async_to_sync(flood)()
+        self.assertEqual([f["type"] for f in received], ["presence", "presence", "error"])
+        self.assertEqual(received[-1]["limit"], "socket")
+
+    def test_full_inbound_queue_turns_frames_away(self):
+        self.seed(partners=1)
+
+        async def stalled():
+            release = asyncio.Event()
+
+            async def slow_handle_frame(consumer, data):
+                await release.wait()
+
+            comm = self.socket(self.me)
+            with mock.patch.object(consumers.ChatConsumer, 'handle_frame', slow_handle_frame):
+                await comm.connect()
+                for n in range(3):
+                    await comm.send_to(text_data=self.chat(f"q{n}"))
+                received = await receive_all(comm)
+                release.set()
+                await comm.disconnect()
+            return received
+
+        # One frame in hand, one waiting, the rest turned away
+        with override_settings(INBOUND_MAX_QUEUE=1):
+            received = async_to_sync(stalled)()
+        self.assertTrue(received)
+        self.assertTrue(all((f["code"], f["limit"]) == ("busy", "queue") for f in received))
+
+
+class UnixSocketLayerTests(SimpleTestCase):
+    """ Two layers on one socket directory stand in for two worker processes """
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = tmp.name
+
+    def run_workers(self, scenario, **config):
+        async def run():
+            workers = [UnixSocketChannelLayer(path=self.path, peer_refresh=0, sync_grace=0, **config)
+                       for _ in range(2)]
+            try:
+                await scenario(*workers)
+            finally:
+                for worker in workers:
+                    await worker.close()
+        async_to_sync(run)()
+
+    def test_group_send_and_send_cross_workers(self):
+        async def scenario(a, b):
+            await a.new_channel()  # a listens, so it hears b's "joined"
+            channel = await b.new_channel()
+            await b.group_add("user_1", channel)
+            await eventually(lambda: a.has_members("user_1"))
+
+            await a.group_send("user_1", {"type": "chat.message", "n": 1})
+            self.assertEqual(await asyncio.wait_for(b.receive(channel), 2), {"type": "chat.message", "n": 1})
+            await a.send(channel, {"type": "chat.message", "n": 2})
+            self.assertEqual((await asyncio.wait_for(b.receive(channel), 2))["n"], 2)
+            # Groups nobody joined are not forwarded at all
+            self.assertFalse(a.has_members("user_2"))
+
+        self.run_workers(scenario)
+
+    def test_join_leave_and_expiry(self):
+        async def scenario(a, b):
+            await a.new_channel()
+            first, second = await b.new_channel(), await b.new_channel()
+            await b.group_add("user_1", first)
+            await b.group_add("user_1", second)
+            await eventually(lambda: a.has_members("user_1"))
+
+            # Still one member on b: no "left" yet
+            await b.group_discard("user_1", first)
+            await asyncio.sleep(0.05)
+            self.assertTrue(a.has_members("user_1"))
+            await b.group_discard("user_1", second)
+            await eventually(lambda: not a.has_members("user_1"))
+
+            # A membership b never confirms again expires on a...
+            await b.group_add("user_1", first)
+            await eventually(lambda: a.has_members("user_1"))
+            a._remote_groups["user_1"][b.process_id] -= a.group_expiry + 1
+            self.assertFalse(a.has_members("user_1"))
+
+            # ...but b re-sends its groups every resync_interval, so a long-lived member stays routed
+            await b.group_add("user_1", first)  # refreshes b's local timestamp only
+            b._synced_at -= b.resync_interval
+            await b.group_send("user_9", {"type": "chat.message"})
+            await eventually(lambda: a.has_members("user_1"))
+
+            # The same sync drops what b no longer has, even if its "left" was lost
+            a._remote_groups.setdefault("user_7", {})[b.process_id] = time.time()
+            b._synced_at -= b.resync_interval
+            await b.group_send("user_9", {"type": "chat.message"})
+            await eventually(lambda: not a.has_members("user_7"))
+
+        self.run_workers(scenario, group_expiry=3600)
+
+    def test_full_channel_does_not_cut_the_peer_off(self):
+        async def scenario(a, b):
+            await a.new_channel()
+            channel = await b.new_channel()
+            await b.group_add("user_1", channel)
+            await eventually(lambda: a.has_members("user_1"))
+
+            for n in range(3):
+                await a.send(channel, {"type": "chat.message", "n": n})
+            await asyncio.sleep(0.05)
+            # Capacity 1: the rest were dropped, and b still serves a afterwards
+            self.assertEqual((await asyncio.wait_for(b.receive(channel), 2))["n"], 0)
+            await a.group_send("user_1", {"type": "chat.message", "n": 3})
+            self.assertEqual((await asyncio.wait_for(b.receive(channel), 2))["n"], 3)
+
+        with mock.patch('builtins.print') as printed:
+            self.run_workers(scenario, capacity=1)
+        printed.assert_not_called()
@@ -1,7 +1,9 @@
+from django.conf import settings
 from django.urls import path
+from . import async_views
 from .views import *
 
-urlpatterns = [
+sync_urlpatterns = [
     path('history/<str:user_id>', get_chat_history),
     path('recent/<str:user_id>', get_recent_chats),
     path('search', search_users),
@@ -9,4 +11,23 @@ urlpatterns = [
     path('delete_all', delete_conversation),
     path('message/<str:message_id>', manage_message),
     path('unread/total/<str:user_id>', get_total_unread),
-]
\ No newline at end of file
+    path('presence', get_presence),
+    path('directory/invalidate', invalidate_directory),
+    path('directory/stats', get_directory_stats),
+]
+
+# Same routes, with the chat endpoints served by chat/async_views.py
+async_urlpatterns = [
+    path('history/<str:user_id>', async_views.get_chat_history),
+    path('recent/<str:user_id>', async_views.get_recent_chats),
+    path('search', async_views.search_users),
+    path('toggle', async_views.toggle_chat),
+    path('delete_all', async_views.delete_conversation),
+    path('message/<str:message_id>', async_views.manage_message),
+    path('unread/total/<str:user_id>', async_views.get_total_unread),
+    path('presence', get_presence),
+    path('directory/invalidate', invalidate_directory),
+    path('directory/stats', get_directory_stats),
+]
+
+urlpatterns = async_urlpatterns if settings.ASYNC_VIEWS else sync_urlpatterns
@@ -1,13 +1,16 @@
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from .mongo_client import messages_collection, users_collection, conversations_collection, departments_collection, fix_id
+from .mongo_client import messages_collection, users_collection, conversations_collection, departments_collection, fix_id, pair_key
+from .mongo_client import users_read_collection, conversations_read_collection, departments_read_collection
+from . import directory, presence, search, sync
+from .receipts import mark_read
+from .auth import verify_token, token_cache
 from bson.objectid import ObjectId
-import re
 import datetime
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 import jwt
-import os
+import hmac
 from django.conf import settings
 from functools import wraps
 
@@ -20,22 +23,19 @@ def jwt_required(view_func):
             print("401: Missing or invalid Authorization header.")
             return Response({"error": "Unauthorized - Missing Token"}, status=401)
 
-        token = auth_header.split(' ')[1].strip('"').strip("'")
-        secret = settings.SECRET_KEY 
+        token = auth_header.split(' ')[1]
         
         try:
-            payload = jwt.decode(token, secret, algorithms=["HS256"])
-            
-            # FIX: Look for 'userId' first, which matches your Node.js authController
-            token_user_id = str(payload.get('userId', payload.get('id', payload.get('_id'))))
+            # Verified once per token, then cached until exp (chat/auth.py)
+            token_user_id = verify_token(token)
 
-            if token_user_id == 'None':
+            if token_user_id is None:
                 print("401: Token missing user ID payload")
                 return Response({"error": "Unauthorized - Invalid Token Payload"}, status=401)
 
             requested_user_id = kwargs.get('user_id') or request.GET.get('user_id') or request.data.get('admin_id')
             if requested_user_id and str(requested_user_id) != token_user_id:
-                user = users_collection.find_one({"_id": ObjectId(token_user_id)})
+                user = directory.get_user(token_user_id)
                 if not user or user.get('role') != 'Admin':
                     print(f"403: User {token_user_id} tried to access {requested_user_id}")
                     return Response({"error": "Forbidden - Access Denied"}, status=403)
@@ -52,57 +52,135 @@ def jwt_required(view_func):
         return view_func(request, *args, **kwargs)
     return _wrapped_view
 
+# --- SHARED HANDLERS: the same view bodies also run as async views (chat/async_views.py) ---
+shared_handlers = {}
+
+def shared_handler(view_func):
+    """ Register a @jwt_required view body under its name for chat/async_views.py """
+    shared_handlers[view_func.__name__] = view_func
+    return view_func
+
+def notify(request, user_id, event):
+    """ Fan `event` out to user_<id>. Async views collect these and await them after the body returns. """
+    outbox = getattr(request, 'outbox', None)
+    if outbox is not None:
+        outbox.append((user_id, event))
+    else:
+        async_to_sync(presence.send_to_user)(get_channel_layer(), user_id, event)
+
 # --- HELPER: Fetch Department Name ---
 def enrich_user(user_doc):
     if not user_doc: return None
     dept_id = user_doc.get('department')
-    dept_name = ""
-    if dept_id:
-        try:
-            dept_doc = departments_collection.find_one({"_id": ObjectId(dept_id)})
-            if dept_doc:
-                dept_name = dept_doc.get('name', '') 
-        except: pass 
-    user_doc['department_name'] = dept_name
+    user_doc['department_name'] = directory.get_department_name(dept_id) if dept_id else ""
     return fix_id(user_doc)
 
+# --- HELPER: Batch-load users with their Department Name ---
+def fetch_users_with_departments(user_filter, read_heavy=False):
+    """ Users matching `user_filter` joined to their department name, in ONE aggregation.
+    Returns {user_id_str: enriched user doc} in natural order. """
+    users_coll = users_read_collection if read_heavy else users_collection
+    departments_coll = departments_read_collection if read_heavy else departments_collection
+    pipeline = [
+        {"$match": user_filter},
+        {"$project": {"password": 0, "AccessKey": 0}},
+        {"$lookup": {"from": "departments", "localField": "department", "foreignField": "_id", "as": "dept_docs"}},
+    ]
+    users = {}
+    string_dept_users = []
+    for doc in users_coll.aggregate(pipeline):
+        dept_docs = doc.pop('dept_docs', [])
+        doc['department_name'] = dept_docs[0].get('name', '') if dept_docs else ''
+        # $lookup can't match a department stored as a string id - resolve those in one batch below
+        if not dept_docs and isinstance(doc.get('department'), str) and ObjectId.is_valid(doc['department']):
+            string_dept_users.append(doc)
+        users[str(doc['_id'])] = doc
+
+    if string_dept_users:
+        dept_ids = list({ObjectId(u['department']) for u in string_dept_users})
+        names = {str(d['_id']): d.get('name', '') for d in departments_coll.find({"_id": {"$in": dept_ids}}, {"name": 1})}
+        for u in string_dept_users:
+            u['department_name'] = names.get(u['department'], '')
+
+    return {uid: fix_id(doc) for uid, doc in users.items()}
+
+def to_object_ids(ids):
+    return [ObjectId(i) for i in ids if ObjectId.is_valid(str(i))]
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+def iso_timestamp(ts):
+    if isinstance(ts, datetime.datetime):
+        if ts.tzinfo is None: ts = ts.replace(tzinfo=datetime.timezone.utc)
+        ts = ts.isoformat()
+    return ts
+
+def serialize_message(doc):
+    data = {
+        "id": str(doc['_id']), 
+        "sender": doc['sender_id'],
+        "message": doc['message'],
+        "timestamp": iso_timestamp(doc['timestamp'])
+    }
+    if doc.get('edited_at'):
+        data["edited_at"] = iso_timestamp(doc['edited_at'])
+    return data
+
+def parse_history_cursor(value, after=False):
+    """ Message id or ISO timestamp -> (timestamp, ObjectId) keyset position """
+    if not value:
+        return None
+    if ObjectId.is_valid(value):
+        doc = messages_collection.find_one({"_id": ObjectId(value)}, {"timestamp": 1})
+        if not doc:
+            raise ValueError("Unknown message cursor")
+        return doc['timestamp'], doc['_id']
+    try:
+        ts = datetime.datetime.fromisoformat(value.replace(' ', '+'))
+    except ValueError:
+        raise ValueError("Cursor must be a message id or ISO timestamp")
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=datetime.timezone.utc)
+    # Pair it with an id past every real one so the timestamp itself is the boundary
+    return ts, ObjectId("f" * 24 if after else "0" * 24)
+
 @api_view(['GET'])
+@shared_handler
 @jwt_required
 def get_recent_chats(request, user_id):
-    # 1. Fetch Existing Conversations
-    cursor = conversations_collection.find({"participants": user_id}).sort("updated_at", -1)
-    results = []
-    existing_partner_ids = set()
+    # 0. Nothing changed since the client's copy: 304 without reading conversations
+    version, bumped_at = sync.read_version(user_id)
+    etag = sync.make_etag(request, user_id, version, with_directory=True)
+    if sync.is_fresh(request, etag):
+        return Response(status=304, headers=sync.cache_headers(etag))
+    # Quiet users can be served from a secondary (MONGO_READ_HEAVY_PREFERENCE)
+    read_heavy = sync.secondary_safe(bumped_at)
+
+    # ?since=<sync>: only conversations changed after that, no auto-populated entries
+    since = request.GET.get('since')
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    conv_filter = {"participants": user_id}
+    if since:
+        try:
+            conv_filter["changed_at"] = {"$gt": sync.parse_since(since)}
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
 
-    for conv in cursor:
+    # 1. Fetch Existing Conversations
+    conversations = list((conversations_read_collection if read_heavy else conversations_collection)
+                         .find(conv_filter).sort("updated_at", -1))
+    existing_partner_ids = []
+    for conv in conversations:
         other_id = conv['participants'][0] if conv['participants'][0] != user_id else conv['participants'][1]
-        existing_partner_ids.add(other_id)
-        user_doc = users_collection.find_one({"_id": ObjectId(other_id)}, {"password": 0, "AccessKey": 0})
-        
-        if user_doc:
-            unread = messages_collection.count_documents({
-                "sender_id": other_id,
-                "receiver_id": user_id,
-                "is_read": False,
-                "deleted_by": {"$ne": user_id} 
-            })
-            
-            results.append({
-                "conversation_id": str(conv['_id']),
-                "user": enrich_user(user_doc),
-                "last_message": conv.get('last_message', ''),
-                "updated_at": conv.get('updated_at'),
-                "is_disabled": conv.get('is_disabled', False),
-                "unread_count": unread
-            })
+        conv['other_id'] = other_id
+        existing_partner_ids.append(other_id)
+
+    current_user = directory.get_user(user_id)
 
     # 2. Auto-Populate Sidebar based on Role & Department (Robust ObjectId Check)
-    try:
-        current_user = users_collection.find_one({"_id": ObjectId(user_id)})
-    except:
-        current_user = None
-    
-    if current_user:
+    user_filters = [{"_id": {"$in": to_object_ids(existing_partner_ids)}}]
+    if current_user and not since:
         role = current_user.get('role')
         dept = current_user.get('department')
 
@@ -113,60 +191,71 @@ def get_recent_chats(request, user_id):
 
         # --- LOGIC 1: Employee sees their Department Head(s) ---
         if role in ['Employee', 'employee'] and dept:
-            # Fetch ALL Department Heads (Handles duplicates or co-heads)
-            dept_heads = users_collection.find({
-                "department": dept_query, 
-                "role": "Department Head"
-            }, {"password": 0, "AccessKey": 0})
-            
-            for head in dept_heads:
-                head_id_str = str(head['_id'])
-                # Only add if not already in conversation list and not self
-                if head_id_str not in existing_partner_ids and head_id_str != user_id:
-                    results.insert(0, {
-                        "conversation_id": f"new_{head_id_str}",
-                        "user": enrich_user(head),
-                        "last_message": "Start conversation with Dept Head",
-                        "updated_at": datetime.datetime.now().isoformat(),
-                        "is_disabled": False,
-                        "unread_count": 0
-                    })
+            user_filters.append({"department": dept_query, "role": "Department Head"})
 
         # --- LOGIC 2: Dept Head sees ALL Employees in Dept ---
         elif role == 'Department Head' and dept:
-            employees = users_collection.find({
-                "department": dept_query,
-                "role": {"$in": ["Employee", "employee"]}
-            }, {"password": 0, "AccessKey": 0})
-
-            for emp in employees:
-                emp_id_str = str(emp['_id'])
-                if emp_id_str not in existing_partner_ids and emp_id_str != user_id:
-                    results.append({
-                        "conversation_id": f"new_{emp_id_str}",
-                        "user": enrich_user(emp),
-                        "last_message": "Tap to chat",
-                        "updated_at": datetime.datetime.now().isoformat(),
-                        "is_disabled": False,
-                        "unread_count": 0
-                    })
-
-    return Response(results)
+            user_filters.append({"department": dept_query, "role": {"$in": ["Employee", "employee"]}})
+
+    # 3. One round-trip for every user on the sidebar (unread badges live on the conversation)
+    users = fetch_users_with_departments({"$or": user_filters}, read_heavy=read_heavy)
+
+    results = []
+    for conv in conversations:
+        user_doc = users.get(conv['other_id'])
+        if user_doc:
+            results.append({
+                "conversation_id": str(conv['_id']),
+                "user": user_doc,
+                "last_message": conv.get('last_message', ''),
+                "updated_at": conv.get('updated_at'),
+                "is_disabled": conv.get('is_disabled', False),
+                "unread_count": conv.get('unread_counts', {}).get(user_id, 0)
+            })
+
+    # Anyone left came from the role/department filter (partners are all in existing_partner_ids)
+    existing = set(existing_partner_ids)
+    for uid, user_doc in users.items():
+        # Only add if not already in conversation list and not self
+        if uid in existing or uid == user_id:
+            continue
+        if current_user.get('role') == 'Department Head':
+            results.append({
+                "conversation_id": f"new_{uid}",
+                "user": user_doc,
+                "last_message": "Tap to chat",
+                "updated_at": datetime.datetime.now().isoformat(),
+                "is_disabled": False,
+                "unread_count": 0
+            })
+        else:
+            results.insert(0, {
+                "conversation_id": f"new_{uid}",
+                "user": user_doc,
+                "last_message": "Start conversation with Dept Head",
+                "updated_at": datetime.datetime.now().isoformat(),
+                "is_disabled": False,
+                "unread_count": 0
+            })
+
+    if since:
+        return Response({"conversations": results, "sync": sync.sync_cursor(started_at)}, headers=sync.cache_headers(etag))
+    return Response(results, headers=sync.cache_headers(etag))
 
 @api_view(['GET'])
+@shared_handler
 @jwt_required
 def search_users(request):
     query = request.GET.get('q', '')
     current_user_id = request.GET.get('user_id')
     if not query or not current_user_id: return Response([])
 
-    try:
-        current_user = users_collection.find_one({"_id": ObjectId(current_user_id)})
-    except:
-        return Response([])
-        
+    current_user = directory.get_user(current_user_id)
     if not current_user: return Response([])
 
+    if settings.USER_SEARCH_INDEX:
+        return Response(search.user_index.search(current_user, query, exclude_id=current_user_id, limit=10))
+
     role = current_user.get('role', 'Employee')
     dept = current_user.get('department')
     
@@ -211,19 +300,20 @@ def search_users(request):
         }
 
     projection = {"firstName": 1, "lastName": 1, "role": 1, "profilePhoto": 1, "email": 1, "department": 1, "employeeId": 1}
-    cursor = users_collection.find(final_filter, projection).limit(10)
+    cursor = users_read_collection.find(final_filter, projection).limit(10)
     users = [enrich_user(u) for u in cursor]
     return Response(users)
 
 @api_view(['POST'])
+@shared_handler
 @jwt_required
 def toggle_chat(request):
     admin_id = request.data.get('admin_id') 
     target_user_id = request.data.get('target_user_id')
     action = request.data.get('action') 
 
-    requester = users_collection.find_one({"_id": ObjectId(admin_id)})
-    target = users_collection.find_one({"_id": ObjectId(target_user_id)})
+    requester = directory.get_user(admin_id)
+    target = directory.get_user(target_user_id)
     if not requester or not target: return Response({"error": "User not found"}, status=404)
 
     req_role = requester.get('role', 'Employee')
@@ -242,82 +332,144 @@ def toggle_chat(request):
     if can_block:
         is_disabled = (action == 'disable')
         conversations_collection.update_one(
-            { "participants": { "$all": [admin_id, target_user_id] } },
-            { "$set": { "is_disabled": is_disabled } },
+            { "pair_key": pair_key(admin_id, target_user_id) },
+            {
+                "$set": { "is_disabled": is_disabled, "changed_at": datetime.datetime.now(datetime.timezone.utc) },
+                "$setOnInsert": { "participants": [admin_id, target_user_id] }
+            },
             upsert=True
         )
-        channel_layer = get_channel_layer()
+        sync.bump(admin_id, target_user_id)
         event = {"type": "chat_status_update", "is_disabled": is_disabled, "participants": [admin_id, target_user_id]}
-        async_to_sync(channel_layer.group_send)(f"user_{target_user_id}", event)
-        async_to_sync(channel_layer.group_send)(f"user_{admin_id}", event)
+        notify(request, target_user_id, event)
+        notify(request, admin_id, event)
         return Response({"success": True, "status": action})
 
     return Response({"error": "Unauthorized"}, status=403)
 
 # --- GET MESSAGES (UPDATED to return ID) ---
 @api_view(['GET'])
+@shared_handler
 @jwt_required
 def get_chat_history(request, user_id):
     other_user_id = request.GET.get('other_user')
     if not other_user_id: return Response([], status=400)
 
-    # Mark as READ (Only visible ones)
-    messages_collection.update_many(
-        {
-            "sender_id": other_user_id, 
-            "receiver_id": user_id, 
-            "is_read": False,
-            "deleted_by": {"$ne": user_id}
-        },
-        {"$set": {"is_read": True}}
-    )
+    version = sync.get_version(user_id)
+    etag = sync.make_etag(request, user_id, version)
+    if sync.is_fresh(request, etag):
+        return Response(status=304, headers=sync.cache_headers(etag))
+    started_at = datetime.datetime.now(datetime.timezone.utc)
 
-    conv = conversations_collection.find_one({
-        "participants": { "$all": [user_id, other_user_id] }
-    })
+    conv = conversations_collection.find_one({"pair_key": pair_key(user_id, other_user_id)})
     is_disabled = conv.get('is_disabled', False) if conv else False
-
-    # Fetch Messages NOT deleted by me
+    # SOFT DELETE: Messages up to my "clear chat" watermark are hidden from me
+    cleared_at = (conv or {}).get('cleared_at', {}).get(user_id)
+    visible = {"timestamp": {"$gt": cleared_at}} if cleared_at else {}
+
+    # Mark as READ: advance my read watermark to the newest message and notify the sender
+    if conv and conv.get('unread_counts', {}).get(user_id):
+        receipt = mark_read(user_id, other_user_id)
+        if receipt:
+            notify(request, other_user_id, {"type": "chat_read", **receipt})
+            # mark_read bumped my version by one; messages below are read after it
+            etag = sync.make_etag(request, user_id, version + 1)
+    headers = sync.cache_headers(etag)
+
+    # Fetch Messages NOT cleared by me
     query = {
         "$or": [
             {"sender_id": user_id, "receiver_id": other_user_id},
             {"sender_id": other_user_id, "receiver_id": user_id}
         ],
-        "deleted_by": {"$ne": user_id} # <--- SOFT DELETE FILTER
+        **visible
     }
-    
-    cursor = messages_collection.find(query).sort("timestamp", 1)
-    results = []
-    for doc in cursor:
-        ts = doc['timestamp']
-        if isinstance(ts, datetime.datetime):
-            if ts.tzinfo is None: ts = ts.replace(tzinfo=datetime.timezone.utc)
-            ts = ts.isoformat()
-        results.append({
-            "id": str(doc['_id']), 
-            "sender": doc['sender_id'],
-            "message": doc['message'],
-            "timestamp": ts
-        })
+
+    # --- DELTA: ?since=<sync> -> new/edited messages, deletions, my clear watermark ---
+    since = request.GET.get('since')
+    if since:
+        try:
+            since_ts = sync.parse_since(since)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+        changed = {"$and": [query, {"$or": [{"timestamp": {"$gt": since_ts}}, {"edited_at": {"$gt": since_ts}}]}]}
+        cursor = messages_collection.find(changed).sort([("timestamp", 1), ("_id", 1)])
+        return Response({
+            "messages": [serialize_message(doc) for doc in cursor],
+            "deleted": sync.deleted_since(pair_key(user_id, other_user_id), since_ts),
+            "cleared_at": iso_timestamp(cleared_at),
+            "is_disabled": is_disabled,
+            "sync": sync.sync_cursor(started_at)
+        }, headers=headers)
+
+    # --- KEYSET PAGINATION: ?limit=N[&before=<id|iso>][&after=<id|iso>] ---
+    # Without any of these params the full history is returned (legacy clients).
+    paginated = any(k in request.GET for k in ('limit', 'before', 'after'))
+    if not paginated:
+        cursor = messages_collection.find(query).sort("timestamp", 1)
+        return Response({
+            "messages": [serialize_message(doc) for doc in cursor],
+            "is_disabled": is_disabled
+        }, headers=headers)
+
+    try:
+        limit = min(max(int(request.GET.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+        after = request.GET.get('after')
+        position = parse_history_cursor(after or request.GET.get('before'), after=bool(after))
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
+
+    # Walk the (timestamp, _id) index away from the cursor; newest page first by default
+    direction = 1 if after else -1
+    if position:
+        op = "$gt" if after else "$lt"
+        ts, oid = position
+        query = {"$and": [query, {"$or": [
+            {"timestamp": {op: ts}},
+            {"timestamp": ts, "_id": {op: oid}}
+        ]}]}
+
+    docs = list(messages_collection.find(query).sort([("timestamp", direction), ("_id", direction)]).limit(limit + 1))
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    if direction == -1:
+        docs.reverse()
+
+    results = [serialize_message(doc) for doc in docs]
+    # before -> oldest id on the page (scroll back); after -> newest id (catch up)
+    next_cursor = None
+    if has_more and results:
+        next_cursor = results[-1]["id"] if after else results[0]["id"]
 
     return Response({
         "messages": results,
-        "is_disabled": is_disabled
-    })
-    
+        "is_disabled": is_disabled,
+        "has_more": has_more,
+        "next_cursor": next_cursor
+    }, headers=headers)
+
 @api_view(['GET'])
+@shared_handler
 @jwt_required
 def get_total_unread(request, user_id):
     """ API to get total unread messages for Dashboard Badge (Exclude deleted) """
-    count = messages_collection.count_documents({
-        "receiver_id": user_id,
-        "is_read": False,
-        "deleted_by": {"$ne": user_id}
-    })
-    return Response({"count": count})
+    version, bumped_at = sync.read_version(user_id)
+    etag = sync.make_etag(request, user_id, version)
+    if sync.is_fresh(request, etag):
+        return Response(status=304, headers=sync.cache_headers(etag))
+
+    # Sum the per-conversation counters instead of scanning the message history
+    conversations = conversations_read_collection if sync.secondary_safe(bumped_at) else conversations_collection
+    totals = list(conversations.aggregate([
+        {"$match": {"participants": user_id}},
+        {"$group": {"_id": None, "count": {"$sum": f"$unread_counts.{user_id}"}}}
+    ]))
+    count = totals[0]['count'] if totals else 0
+    return Response({"count": count}, headers=sync.cache_headers(etag))
 
 # --- NEW: DELETE CONVERSATION ---
 @api_view(['DELETE'])
+@shared_handler
 @jwt_required
 def delete_conversation(request):
     """ SOFT DELETE: Clear chat for requesting user only """
@@ -327,33 +479,31 @@ def delete_conversation(request):
     if not user_id or not other_user_id:
         return Response({"error": "Missing parameters"}, status=400)
 
-    # Add user_id to 'deleted_by' array instead of removing document
-    messages_collection.update_many(
-        {
-            "$or": [
-                {"sender_id": user_id, "receiver_id": other_user_id},
-                {"sender_id": other_user_id, "receiver_id": user_id}
-            ]
-        },
-        {"$addToSet": {"deleted_by": user_id}}
+    # Record a per-user watermark instead of touching every message:
+    # history only shows this user messages newer than cleared_at.<user_id>
+    now_aware = datetime.datetime.now(datetime.timezone.utc)
+    conversations_collection.update_one(
+        {"pair_key": pair_key(user_id, other_user_id)},
+        {"$set": {f"cleared_at.{user_id}": now_aware, f"unread_counts.{user_id}": 0, "changed_at": now_aware}}
     )
+    sync.bump(user_id)
     
     # We DO NOT clear the conversation 'last_message' because the other user still sees it.
     
     # Broadcast event to clear LOCAL screen only
-    channel_layer = get_channel_layer()
     event = {
         "type": "chat_activity",
         "action": "clear_chat",
         "initiator_id": user_id, # Only clear for this user
         "participants": [user_id, other_user_id]
     }
-    async_to_sync(channel_layer.group_send)(f"user_{user_id}", event)
+    notify(request, user_id, event)
 
     return Response({"success": True})
 
 # --- NEW: EDIT/DELETE SINGLE MESSAGE ---
 @api_view(['PUT', 'DELETE'])
+@shared_handler
 @jwt_required
 def manage_message(request, message_id):
     user_id = request.GET.get('user_id') # Auth check
@@ -369,11 +519,27 @@ def manage_message(request, message_id):
     if msg['sender_id'] != user_id:
         return Response({"error": "Unauthorized"}, status=403)
 
-    channel_layer = get_channel_layer()
     receiver_id = msg['receiver_id']
 
     if request.method == 'DELETE':
+        now_aware = datetime.datetime.now(datetime.timezone.utc)
         messages_collection.delete_one({"_id": ObjectId(message_id)})
+        sync.record_deleted(msg, pair_key(user_id, receiver_id), now_aware)
+        if not msg.get('is_read'):
+            # Only counted if the receiver hadn't read or cleared the chat past it
+            conversations_collection.update_one(
+                {
+                    "pair_key": pair_key(user_id, receiver_id),
+                    f"unread_counts.{receiver_id}": {"$gt": 0},
+                    "$and": [
+                        {"$or": [
+                            {f"{field}.{receiver_id}": {"$exists": False}},
+                            {f"{field}.{receiver_id}": {"$lt": msg['timestamp']}}
+                        ]} for field in ("cleared_at", "last_read_at")
+                    ]
+                },
+                {"$inc": {f"unread_counts.{receiver_id}": -1}, "$set": {"changed_at": now_aware}}
+            )
         
         # Broadcast Delete
         event = {
@@ -381,8 +547,8 @@ def manage_message(request, message_id):
             "action": "delete_message",
             "message_id": message_id
         }
-        async_to_sync(channel_layer.group_send)(f"user_{receiver_id}", event)
-        async_to_sync(channel_layer.group_send)(f"user_{user_id}", event)
+        notify(request, receiver_id, event)
+        notify(request, user_id, event)
 
     elif request.method == 'PUT':
         new_text = request.data.get('message')
@@ -390,7 +556,7 @@ def manage_message(request, message_id):
         
         messages_collection.update_one(
             {"_id": ObjectId(message_id)},
-            {"$set": {"message": new_text}}
+            {"$set": {"message": new_text, "edited_at": datetime.datetime.now(datetime.timezone.utc)}}
         )
 
         # Broadcast Edit
@@ -400,7 +566,56 @@ def manage_message(request, message_id):
             "message_id": message_id,
             "new_text": new_text
         }
-        async_to_sync(channel_layer.group_send)(f"user_{receiver_id}", event)
-        async_to_sync(channel_layer.group_send)(f"user_{user_id}", event)
+        notify(request, receiver_id, event)
+        notify(request, user_id, event)
+
+    sync.bump(user_id, receiver_id)
+    return Response({"success": True})
+
+# --- DIRECTORY CACHE HOOKS (called by the Node backend) ---
+@api_view(['POST'])
+def invalidate_directory(request):
+    """
+    Drop cached user/department docs after a role or department change. Callers: an Admin's
+    JWT, or the backend with DIRECTORY_SERVICE_TOKEN. Only this worker's caches are dropped;
+    others catch up within DIRECTORY_CACHE_TTL (use DIRECTORY_WATCH_CHANGES to reach them all).
+    """
+    token = settings.DIRECTORY_SERVICE_TOKEN
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return apply_directory_invalidation(request)
+    return admin_invalidate_directory(request)
 
-    return Response({"success": True})
\ No newline at end of file
+@jwt_required
+def admin_invalidate_directory(request):
+    user = directory.get_user(request.authenticated_user_id)
+    if not user or user.get('role') != 'Admin':
+        return Response({"error": "Forbidden - Access Denied"}, status=403)
+    return apply_directory_invalidation(request)
+
+def apply_directory_invalidation(request):
+    user_ids = request.data.get('user_ids') or []
+    department_ids = request.data.get('department_ids') or []
+    if request.data.get('user_id'): user_ids.append(request.data['user_id'])
+    if request.data.get('department_id'): department_ids.append(request.data['department_id'])
+
+    for uid in user_ids:
+        directory.invalidate_user(uid)
+    for dept_id in department_ids:
+        directory.invalidate_department(dept_id)
+    return Response({"success": True})
+
+@api_view(['GET'])
+@jwt_required
+def get_directory_stats(request):
+    """ Hit/miss counters for sizing DIRECTORY_CACHE_* and the token cache, plus search index size (Admin only) """
+    user = directory.get_user(request.authenticated_user_id)
+    if not user or user.get('role') != 'Admin':
+        return Response({"error": "Forbidden - Access Denied"}, status=403)
+    return Response({**directory.stats(), "search": search.user_index.stats(), "tokens": token_cache.stats()})
+
+@api_view(['GET'])
+@jwt_required
+def get_presence(request):
+    """ ?ids=a,b,c -> {id: {"online": bool, "last_seen": iso or null}} for the sidebar, one read """
+    user_ids = [uid for uid in request.GET.get('ids', '').split(',') if uid][:presence.MAX_USERS]
+    return Response(presence.lookup(user_ids) if user_ids else {})
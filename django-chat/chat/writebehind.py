@@ -0,0 +1,222 @@
+"""
+Write-behind persistence for chat messages (MESSAGE_WRITE_BEHIND=True).
+
+Instead of one insert_one plus one conversation upsert per message, the
+consumer hands messages to a per-worker queue that is flushed with a
+single insert_many and a single bulk_write of conversation upserts every
+WRITE_BEHIND_BATCH_SIZE messages or WRITE_BEHIND_FLUSH_MS milliseconds,
+whichever comes first.
+
+Message ids are generated up front, so with WRITE_BEHIND_DURABLE_ACK off
+the sender echo goes out immediately; with it on (default), `submit`
+only returns once the batch holding the message is written. A message
+the batch insert rejects fails on its own; the rest of the batch still
+reaches its conversations.
+
+The queue is drained on server shutdown: on the ASGI lifespan shutdown
+event (`lifespan`, routed in server/asgi.py) or, under daphne, which sends
+no lifespan events, from a reactor shutdown trigger while the loop still
+runs. An atexit hook writes whatever is left synchronously as a last resort.
+"""
+import asyncio
+import atexit
+import sys
+import threading
+from bson.objectid import ObjectId
+from django.conf import settings
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from . import sync
+from .mongo_client import messages_collection, conversations_collection, run_mongo, pair_key
+
+
+def write_batch(docs):
+    """
+    Persist a batch of message docs and fold the ones inserted into their
+    conversations. Blocking. Returns {index in docs: error} for the rejected ones.
+    """
+    failed = {}
+    try:
+        messages_collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        # ordered=False: everything not listed in writeErrors was inserted
+        failed = {err["index"]: err.get("errmsg", "write error") for err in e.details.get("writeErrors", [])}
+        if not failed:
+            raise
+        docs = [doc for i, doc in enumerate(docs) if i not in failed]
+        if not docs:
+            return failed
+
+    # One upsert per conversation: latest text/time wins, unread increments add up
+    convs = {}
+    for doc in docs:
+        key = pair_key(doc["sender_id"], doc["receiver_id"])
+        conv = convs.setdefault(key, {"doc": doc, "participants": [doc["sender_id"], doc["receiver_id"]], "unread": {}})
+        if doc["timestamp"] >= conv["doc"]["timestamp"]:
+            conv["doc"] = doc
+        conv["unread"][doc["receiver_id"]] = conv["unread"].get(doc["receiver_id"], 0) + 1
+
+    ops = [
+        UpdateOne(
+            {"pair_key": key},
+            {
+                "$set": {"last_message": conv["doc"]["message"], "updated_at": conv["doc"]["timestamp"],
+                         "changed_at": conv["doc"]["timestamp"]},
+                "$inc": {f"unread_counts.{uid}": n for uid, n in conv["unread"].items()},
+                "$setOnInsert": {"participants": conv["participants"], "is_disabled": False}
+            },
+            upsert=True
+        )
+        for key, conv in convs.items()
+    ]
+    conversations_collection.bulk_write(ops, ordered=False)
+    sync.bump(*(uid for doc in docs for uid in (doc["sender_id"], doc["receiver_id"])))
+    return failed
+
+
+_STOP = object()
+
+
+class MessageWriter:
+
+    def __init__(self, batch_size, flush_ms, max_queue, durable_ack):
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000.0
+        self.durable_ack = durable_ack
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.in_flight = []
+        self.lock = threading.Lock()
+        self.task = self.loop.create_task(self.run())
+        _drain_on_reactor_shutdown(self)
+
+    async def submit(self, sender_id, receiver_id, message_text, now_aware):
+        """ Queue a message; returns its id (after it is written, with durable ack) """
+        doc = {
+            "_id": ObjectId(),
+            "sender_id": sender_id,
+            "receiver_id": receiver_id,
+            "message": message_text,
+            "timestamp": now_aware,
+            "is_read": False
+        }
+        # Only a durable ack waits on the write; nobody would retrieve a failure otherwise
+        written = self.loop.create_future() if self.durable_ack else None
+        # Blocks the sender (not the worker) while the queue is full
+        await self.queue.put((doc, written))
+        if written is not None:
+            await written
+        return str(doc["_id"])
+
+    async def run(self):
+        stopping = False
+        while not stopping:
+            batch = [await self.queue.get()]
+            deadline = self.loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                if batch[-1] is _STOP:
+                    # Shutting down: don't sit out the rest of the flush interval
+                    break
+            if _STOP in batch:
+                batch.remove(_STOP)
+                stopping = True
+            if batch:
+                await self.flush(batch)
+
+    async def flush(self, batch):
+        with self.lock:
+            self.in_flight = batch
+        try:
+            failed = await run_mongo(write_batch, [doc for doc, _ in batch])
+            errors = {i: OperationFailure(message) for i, message in failed.items()}
+            if errors:
+                print(f"Write-behind rejected {len(errors)} of {len(batch)} messages: {next(iter(failed.values()))}")
+        except Exception as e:
+            print(f"Write-behind flush of {len(batch)} messages failed: {e}")
+            errors = dict.fromkeys(range(len(batch)), e)
+        finally:
+            with self.lock:
+                self.in_flight = []
+        for i, (_, written) in enumerate(batch):
+            if written is None or written.done():
+                continue
+            if i in errors:
+                written.set_exception(errors[i])
+            else:
+                written.set_result(None)
+
+    async def drain(self):
+        """ Write everything queued so far and stop the flush loop """
+        if not self.task.done():
+            await self.queue.put(_STOP)
+            await self.task
+
+    def drain_sync(self):
+        """ Last resort at interpreter exit: the loop is gone, write with plain pymongo """
+        docs = []
+        with self.lock:
+            docs += [doc for doc, _ in self.in_flight]
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not _STOP:
+                docs.append(item[0])
+        if docs:
+            try:
+                failed = write_batch(docs)
+                print(f"Write-behind drained {len(docs) - len(failed)} messages at shutdown ({len(failed)} rejected)")
+            except Exception as e:
+                print(f"Write-behind lost {len(docs)} messages at shutdown: {e}")
+
+
+_writer = None
+
+
+def get_message_writer():
+    """ The writer for the running event loop (one per worker) """
+    global _writer
+    if _writer is None or _writer.loop is not asyncio.get_running_loop() or _writer.task.done():
+        _writer = MessageWriter(
+            batch_size=settings.WRITE_BEHIND_BATCH_SIZE,
+            flush_ms=settings.WRITE_BEHIND_FLUSH_MS,
+            max_queue=settings.WRITE_BEHIND_MAX_QUEUE,
+            durable_ack=settings.WRITE_BEHIND_DURABLE_ACK,
+        )
+    return _writer
+
+
+async def lifespan(scope, receive, send):
+    """ ASGI lifespan handler: drain the write-behind queue on server shutdown """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _writer is not None and _writer.loop is asyncio.get_running_loop():
+                await _writer.drain()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def _drain_on_reactor_shutdown(writer):
+    """ Under daphne, drain before the Twisted reactor (and with it the loop) stops """
+    # Never import the reactor ourselves: that would install the default one
+    reactor = sys.modules.get("twisted.internet.reactor")
+    if reactor is None or not reactor.running:
+        return
+    from twisted.internet.defer import Deferred
+    reactor.addSystemEventTrigger(
+        "before", "shutdown", lambda: Deferred.fromFuture(asyncio.ensure_future(writer.drain(), loop=writer.loop))
+    )
+
+
+@atexit.register
+def _drain_at_exit():
+    if _writer is not None:
+        _writer.drain_sync()
@@ -5,13 +5,21 @@ import django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
 django.setup()
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from chat.middleware import JWTAuthMiddleware  # <--- Import this
 from chat.routing import websocket_urlpatterns # Ensure you have routing.py
+from chat.indexes import check_required_indexes
+from chat.writebehind import lifespan
+
+if settings.MONGO_REQUIRE_INDEXES:
+    check_required_indexes()
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
+    # Servers that speak lifespan get the write-behind queue drained on shutdown
+    "lifespan": lifespan,
     "websocket": JWTAuthMiddleware(  # <--- Wrap URLRouter with this
         URLRouter(
             websocket_urlpatterns
@@ -34,6 +34,13 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Prometheus text on GET /metrics (chat/metrics.py); read once at startup
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'False') == 'True'
+# Optional bearer token the scraper must send
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+if METRICS_ENABLED:
+    MIDDLEWARE.insert(0, 'chat.metrics.MetricsMiddleware')
+
 ROOT_URLCONF = 'server.urls'
 
 TEMPLATES = [
@@ -67,6 +74,102 @@ DATABASES = {
 MONGO_URI = os.getenv('MONGODB_URL')
 MONGO_DB_NAME = 'test'
 
+# Client options (chat/mongo_client.py builds the client on first use)
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv('MONGO_MAX_IDLE_TIME_MS', '0'))        # 0 = never close idle connections
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', '20000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '30000'))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', '0'))      # 0 = no timeout
+# Wire compression, in order of preference, e.g. "zstd,snappy,zlib" ('' = off)
+MONGO_COMPRESSORS = os.getenv('MONGO_COMPRESSORS', '')
+
+# Where recent chats, unread totals and the search index read from: primary, primaryPreferred,
+# secondary, secondaryPreferred or nearest. Secondaries more than MONGO_MAX_STALENESS_S behind
+# are skipped (90 is the server's minimum), and users whose chats changed within that window
+# still read from the primary so their ETags stay exact.
+MONGO_READ_HEAVY_PREFERENCE = os.getenv('MONGO_READ_HEAVY_PREFERENCE', 'primary')
+MONGO_MAX_STALENESS_S = int(os.getenv('MONGO_MAX_STALENESS_S', '90'))
+
+# Threads reserved for pymongo calls made by the WebSocket consumer.
+# 0 runs them inline on the event loop (only useful for benchmarking).
+MONGO_EXECUTOR_WORKERS = int(os.getenv('MONGO_EXECUTOR_WORKERS', '32'))
+
+# Serve the chat REST endpoints with async views (chat/async_views.py). Only pays off
+# under ASGI (daphne); under WSGI each request would get its own event loop instead.
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False') == 'True'
+
+# Seconds to coalesce WebSocket mark_read frames per conversation before writing
+READ_RECEIPT_DEBOUNCE = float(os.getenv('READ_RECEIPT_DEBOUNCE', '0.5'))
+
+# Batch message inserts per worker (chat/writebehind.py) instead of writing each one
+MESSAGE_WRITE_BEHIND = os.getenv('MESSAGE_WRITE_BEHIND', 'False') == 'True'
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', '200'))
+WRITE_BEHIND_FLUSH_MS = float(os.getenv('WRITE_BEHIND_FLUSH_MS', '20'))
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv('WRITE_BEHIND_MAX_QUEUE', '10000'))
+# Only echo to the sender (and deliver) once the batch holding the message is written
+WRITE_BEHIND_DURABLE_ACK = os.getenv('WRITE_BEHIND_DURABLE_ACK', 'True') == 'True'
+
+# Refuse to start the ASGI app while indexes from chat/indexes.py are missing
+MONGO_REQUIRE_INDEXES = os.getenv('MONGO_REQUIRE_INDEXES', 'False') == 'True'
+
+# User/department directory cache (chat/directory.py)
+DIRECTORY_CACHE_USERS = int(os.getenv('DIRECTORY_CACHE_USERS', '10000'))
+DIRECTORY_CACHE_DEPARTMENTS = int(os.getenv('DIRECTORY_CACHE_DEPARTMENTS', '1000'))
+DIRECTORY_CACHE_TTL = int(os.getenv('DIRECTORY_CACHE_TTL', '60')) # seconds
+# Follow a change stream on users/departments (needs a replica set)
+DIRECTORY_WATCH_CHANGES = os.getenv('DIRECTORY_WATCH_CHANGES', 'False') == 'True'
+# Bearer token the Node backend sends to POST directory/invalidate ('' = Admin JWTs only)
+DIRECTORY_SERVICE_TOKEN = os.getenv('DIRECTORY_SERVICE_TOKEN', '')
+
+# Days a deleted message is still reported to ?since= delta syncs
+SYNC_TOMBSTONE_DAYS = int(os.getenv('SYNC_TOMBSTONE_DAYS', '30'))
+
+# Reconnect replay (ws/chat/?since= or ?last_id=): messages per frame, and the most
+# replayed before the client is told to reload instead
+REPLAY_BATCH_SIZE = int(os.getenv('REPLAY_BATCH_SIZE', '100'))
+REPLAY_MAX_MESSAGES = int(os.getenv('REPLAY_MAX_MESSAGES', '1000'))
+
+# Opt-in outbound batching (ws/chat/?batch=1): frames are held this many ms, or until
+# OUTBOUND_BATCH_MAX are queued, and sent as one JSON array. At most OUTBOUND_MAX_QUEUE
+# frames and OUTBOUND_MAX_BYTES of encoded frames (JSON counted in characters) wait per
+# socket, a batch counting until send() returns for it. Past either, OUTBOUND_SLOW_POLICY
+# drops new frames (the client gets {"type": "overflow"}) or closes the socket with code 4008.
+OUTBOUND_BATCH_WINDOW_MS = int(os.getenv('OUTBOUND_BATCH_WINDOW_MS', '10'))
+OUTBOUND_BATCH_MAX = int(os.getenv('OUTBOUND_BATCH_MAX', '50'))
+OUTBOUND_MAX_QUEUE = int(os.getenv('OUTBOUND_MAX_QUEUE', '1000'))
+OUTBOUND_MAX_BYTES = int(os.getenv('OUTBOUND_MAX_BYTES', '1048576'))
+OUTBOUND_SLOW_POLICY = os.getenv('OUTBOUND_SLOW_POLICY', 'drop')
+
+# Inbound WebSocket limits (chat/ratelimit.py): token buckets refilled RATE per second up to
+# BURST, one per socket for every frame and one per user (all their sockets in this worker)
+# for chat messages; a RATE of 0 turns that bucket off. Frames over a limit are answered with
+# {"type": "error", "code": "rate_limited", "retry_after": seconds}. At most INBOUND_MAX_QUEUE
+# accepted frames wait per socket while earlier ones are handled; the rest get code "busy".
+WS_SOCKET_RATE = float(os.getenv('WS_SOCKET_RATE', '20'))
+WS_SOCKET_BURST = int(os.getenv('WS_SOCKET_BURST', '40'))
+WS_USER_RATE = float(os.getenv('WS_USER_RATE', '5'))
+WS_USER_BURST = int(os.getenv('WS_USER_BURST', '20'))
+INBOUND_MAX_QUEUE = int(os.getenv('INBOUND_MAX_QUEUE', '50'))
+# Users whose bucket is kept; the least recently active are evicted past this
+RATE_LIMIT_USERS = int(os.getenv('RATE_LIMIT_USERS', '10000'))
+
+# Presence (chat/presence.py): seconds between socket heartbeats, and how long a
+# socket counts as online without one (covers workers that die without disconnecting)
+PRESENCE_HEARTBEAT = int(os.getenv('PRESENCE_HEARTBEAT', '30'))
+PRESENCE_TIMEOUT = int(os.getenv('PRESENCE_TIMEOUT', '90'))
+
+# Seconds a socket reuses a check_chat_permission decision (0 = check every message)
+PERMISSION_CACHE_TTL = int(os.getenv('PERMISSION_CACHE_TTL', '300'))
+
+# Verified JWTs remembered until exp, capped at this many seconds (chat/auth.py)
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', '10000'))
+AUTH_TOKEN_CACHE_TTL = int(os.getenv('AUTH_TOKEN_CACHE_TTL', '300'))
+
+# search_users from the in-memory prefix index (chat/search.py) instead of $regex scans
+USER_SEARCH_INDEX = os.getenv('USER_SEARCH_INDEX', 'True') == 'True'
+USER_SEARCH_REFRESH = int(os.getenv('USER_SEARCH_REFRESH', '300')) # seconds between full rebuilds
+
 # Channel Layer (In-Memory for Dev)
 CHANNEL_LAYERS = {
     "default": {
@@ -74,6 +177,19 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Several Daphne workers on one host: fan out over Unix sockets (chat/layers.py)
+if os.getenv('CHANNEL_LAYER') == 'unix':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chat.layers.UnixSocketChannelLayer",
+            "CONFIG": {
+                "path": os.getenv('CHANNEL_LAYER_PATH', '/tmp/chat-channel-layer'),
+                "group_expiry": int(os.getenv('CHANNEL_LAYER_GROUP_EXPIRY', '86400')),
+                "capacity": 1000,
+            }
+        }
+    }
+
 CORS_ALLOWED_ORIGINS = [
     "https://employee-management-system-mauve-sigma.vercel.app", # Your Production Frontend
     "http://localhost:5173", # Local development
@@ -16,8 +16,10 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from chat.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/chat/', include('chat.urls')), # Delegates all chat URLs to the app
+    path('metrics', metrics_view), # Prometheus scrape (404 unless METRICS_ENABLED)
 ]